@@ -1,4 +1,5 @@
 from typing import Optional
+import numpy as np
 import typer
 
 from occupy_lib import estimate   # for terminal use
@@ -13,6 +14,150 @@ def version_callback(value: bool):
         print(f"OccuPy: {__version__}")
         raise typer.Exit()
 
+def sweep_values(
+        value
+):
+    """
+    The values of a modification option, which may be a single value or a comma-separated sweep (e.g. "2,4,8")
+
+    :param value:   number, string or list of numbers
+    :return:        list of floats
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [float(v) for v in value.split(',') if v.strip()]
+    if np.ndim(value) == 0:
+        return [float(value)]
+    return [float(v) for v in value]
+
+
+def sigmoid_sweep(
+        sigmoid,
+        pivot: float = None
+):
+    """
+    The (power, pivot) pairs of the sigmoid option, e.g. "3:0.1,3:0.3". A power without pivot, or with a pivot of
+    None, uses --pivot.
+
+    :param sigmoid:     number, string or list of numbers or (power, pivot) pairs
+    :param pivot:       pivot to use when not given with the power
+    :return:            list of (power, pivot)
+    """
+    if sigmoid is None:
+        return []
+    if isinstance(sigmoid, str):
+        sigmoid = sigmoid.split(',')
+    elif np.ndim(sigmoid) == 0:
+        sigmoid = [sigmoid]
+
+    pairs = []
+    for v in sigmoid:
+        if isinstance(v, str):
+            v = v.strip()
+            if not v:
+                continue
+            v = v.split(':')
+        if np.ndim(v) == 0:
+            v = [v]
+        if len(v) == 1 or v[1] is None:
+            pairs.append((float(v[0]), pivot))
+        else:
+            pairs.append((float(v[0]), float(v[1])))
+    return pairs
+
+
+def modification_sweep(
+        options
+):
+    """
+    All modifications requested by the options, leaving out those that do nothing (power 1)
+
+    :param options:     occupy_options
+    :return:            dict with lists of amplification powers (ampl), attenuation powers (attn), and sigmoid
+                        (power, pivot) pairs (sigm)
+    """
+    sweep = {
+        'ampl': [g for g in sweep_values(options.amplify) if g > 1],
+        'attn': [g for g in sweep_values(options.attenuate) if g > 1],
+        'sigm': [(g, p) for g, p in sigmoid_sweep(options.sigmoid, options.pivot) if g > 1]
+    }
+
+    # Each value of a sweep is written to a file of its own, named by its label. Sigmoid powers without any pivot
+    # cannot be labelled, and are refused by the estimate
+    for kind, values in sweep.items():
+        labels = [modification_label(kind, v, sweep=True) for v in values if kind != 'sigm' or v[1] is not None]
+        if len(set(labels)) < len(labels):
+            raise ValueError(f'** fail ** Repeated values in the {kind} sweep: {", ".join(labels)}')
+    return sweep
+
+
+def modification_label(
+        kind: str,
+        value,
+        sweep: bool = False
+):
+    """
+    The label of a modification in output file names, e.g. ampl_2.0 or sigm_3.0-0.10
+
+    Values of a sweep are labelled without rounding (e.g. ampl_1.75 or sigm_3-0.1), so that different values do
+    not share a label.
+
+    :param kind:    ampl, attn or sigm
+    :param value:   power, or (power, pivot) for sigm
+    :param sweep:   label a value of a sweep
+    :return:        label
+    """
+    if sweep:
+        if kind == 'sigm':
+            return f'sigm_{value[0]:g}-{value[1]:g}'
+        return f'{kind}_{value:g}'
+    if kind == 'sigm':
+        return f'sigm_{value[0]:.1f}-{value[1]:.2f}'
+    return f'{kind}_{value:.1f}'
+
+
+def parse_gamma_sweep(value: str):
+    """
+    Parse and check --amplify/--attenuate, which may be a comma-separated sweep of powers
+    """
+    try:
+        values = sweep_values(value)
+    except ValueError:
+        raise typer.BadParameter(f'expected a number or comma-separated numbers, not {value}')
+    if len(values) == 0 or np.min(values) < 1:
+        raise typer.BadParameter(f'powers must be 1 or larger, not {value}')
+    labels = [modification_label('ampl', v, sweep=True) for v in values]
+    if len(set(labels)) < len(labels):
+        raise typer.BadParameter(f'powers must not be repeated, not {value}')
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+def parse_sigmoid_sweep(value: str):
+    """
+    Check --sigmoid, which may be a comma-separated sweep of powers, or power:pivot pairs
+
+    The value is kept as given, and parsed along with --pivot by modification_sweep.
+    """
+    try:
+        pairs = sigmoid_sweep(value)
+    except ValueError:
+        raise typer.BadParameter(f'expected a power, or comma-separated powers or power:pivot pairs, not {value}')
+    if len(pairs) == 0 or np.min([g for g, _ in pairs]) < 1:
+        raise typer.BadParameter(f'powers must be 1 or larger, not {value}')
+    for _, p in pairs:
+        if p is not None and not 0.01 <= p <= 0.99:
+            raise typer.BadParameter(f'pivots must be on [0.01,0.99], not {value}')
+
+    # Powers without a pivot use --pivot, which is not known yet, so are only compared to each other here
+    labels = [modification_label('sigm', (g, p), sweep=True) if p is not None else f'{g:g}' for g, p in pairs]
+    if len(set(labels)) < len(labels):
+        raise typer.BadParameter(f'powers or power:pivot pairs must not be repeated, not {value}')
+    return value
+
+
 class occupy_options:
     def __init__(self,
         input_map: str = None,
@@ -54,7 +199,17 @@ class occupy_options:
         quiet: bool =False,
         help_all : bool = False,
         version : bool = False,
-        gui = False
+        gui = False,
+        threads : int = 1,
+        precision : str = None,
+        cache_dir : str = None,
+        cache_size : float = 2000,
+        memory_limit : float = None,
+        roi_mask : str = None,
+        auto_roi : bool = False,
+        roi_pad : float = 20.0,
+        sym : str = None,
+        target_labels : str = None
 ):
         self.input_map = input_map
         self.resolution = resolution
@@ -94,6 +249,16 @@ class occupy_options:
         self.help_all = help_all
         self.version = version
         self.gui = gui
+        self.threads = threads
+        self.precision = precision
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.memory_limit = memory_limit
+        self.roi_mask = roi_mask
+        self.auto_roi = auto_roi
+        self.roi_pad = roi_pad
+        self.sym = sym
+        self.target_labels = target_labels
 
 def parse_and_run(
         # Basic input --------------------------------------------------------------------------------------------------
@@ -109,22 +274,22 @@ def parse_and_run(
             help="The lowest resolution of resolvable content input map.",
             min=0.0
         ),
-        amplify: float = typer.Option(
-            1.0,
+        amplify: str = typer.Option(
+            "1.0",
             "--amplify", "-am",
-            help="Alter partial occupancies, to make more or less equal to full occupancy?",
-            min=1.0
+            help="Alter partial occupancies, to make more or less equal to full occupancy? Comma-separate several values (2,4,8) to make one output for each",
+            callback=parse_gamma_sweep
         ),
-        attenuate: float = typer.Option(
-            1.0,
+        attenuate: str = typer.Option(
+            "1.0",
             "--attenuate", "-at",
-            help="Attenuate partial occupancies, to weaken lower occupancies",
-            min=1.0
+            help="Attenuate partial occupancies, to weaken lower occupancies. Comma-separate several values (2,4) to make one output for each",
+            callback=parse_gamma_sweep
         ),
-        sigmoid: float = typer.Option(
-            1.0,
-            help="Power value for sigmoid scale modification [0,1]",
-            min=1.0
+        sigmoid: str = typer.Option(
+            "1.0",
+            help="Power value for sigmoid scale modification [0,1]. Comma-separate several values, optionally with their own pivot (3:0.1,3:0.3), to make one output for each",
+            callback=parse_sigmoid_sweep
         ),
         pivot: float = typer.Option(
             0.01,
@@ -265,6 +430,60 @@ def parse_and_run(
             "--emdb","--emdb-id",
             help="Fetch the main map from an EMDB entry and use as input"
         ),
+        threads: int = typer.Option(
+            1,
+            "--threads",
+            min=1,
+            help="Number of threads to use for scale estimation and FFTs"
+        ),
+        precision: str = typer.Option(
+            None,
+            "--precision",
+            help="Process in single or double precision [single/double] (default: as stored in the input map)"
+        ),
+        cache_dir: str = typer.Option(
+            None,
+            "--cache-dir",
+            help="Directory in which to keep scale estimates, to re-use when only the map modification changes"
+        ),
+        cache_size: float = typer.Option(
+            2000,
+            "--cache-size",
+            min=0,
+            help="Maximum total size of the --cache-dir [MB]. The least recently used estimates are removed first"
+        ),
+        memory_limit: float = typer.Option(
+            None,
+            "--memory-limit",
+            min=1,
+            help="Process large maps at full sampling instead of down-scaling to --max-box, using about this much working memory [MB]. Full-size maps are kept in temporary files"
+        ),
+        roi_mask: str = typer.Option(
+            None,
+            "--roi-mask",
+            help="Map defining a region of interest. Only its padded bounding box is estimated and modified [.mrc NxNxN]"
+        ),
+        auto_roi: bool = typer.Option(
+            False,
+            "--auto-roi",
+            help="Only estimate and modify the padded bounding box of content, from --solvent-def, --target-mask or a threshold of the input"
+        ),
+        roi_pad: float = typer.Option(
+            20.0,
+            "--roi-pad",
+            min=0,
+            help="Padding of the region of interest [Å]"
+        ),
+        sym: str = typer.Option(
+            None,
+            "--sym",
+            help="Point-group symmetry of the map (C<n>, D<n>, T, O or I), to only estimate the scale of its asymmetric unit. Approximate for groups whose axes do not map the voxel grid onto itself (e.g. C3, C6, D3, I)"
+        ),
+        target_labels: str = typer.Option(
+            None,
+            "--target-labels",
+            help="Map of integer labels, to estimate the occupancy of each labelled region [.mrc NxNxN]"
+        ),
         verbose: bool = typer.Option(
             False,
             "--verbose",
@@ -293,48 +512,35 @@ def parse_and_run(
             help="Print version info and exit"
         )
 ):
-    scale_mode = 'res'
-    if lp_scale:
-        scale_mode = 'occ'
-
-    options = occupy_options(
-        input_map,
-        resolution,
-        amplify,
-        attenuate,
-        sigmoid,
-        pivot,
-        tau,
-        kernel_size,
-        kernel_radius,
-        tile_size,
-        lowpass_input,
-        lowpass_output,
-        exclude_solvent,
-        max_box,
-        hedge_confidence,
-        solvent_def,
-        scale_limit,
-        scale_mode,
-        nlrc,
-        hist_match,
-        target_mask,
-        output_map,
-        keep_output_path,
-        plot,
-        save_all_maps,
-        chimerax,
-        chimerax_silent,
-        show_chimerax,
-        min_vis_scale,
-        s0,
-        lp_scale,
-        omit_confidence,
-        emdb_id,
-        verbose,
-        quiet,
-        help_all,
-        version
-    )
+    options = options_from_params(locals())
 
     estimate.occupy_run(options)
+
+
+def options_from_params(params: dict):
+    """
+    Make occupy_options from the command-line parameters of parse_and_run
+
+    :param params:  parameter names and values of parse_and_run
+    :return:        occupy_options
+    """
+    params = dict(params)
+    params['scale_mode'] = 'res'
+    if params['lp_scale']:
+        params['scale_mode'] = 'occ'
+
+    return occupy_options(**params)
+
+
+def options_from_args(argv: list):
+    """
+    Parse occupy command-line arguments into occupy_options, without running anything
+
+    :param argv:    command-line arguments, as for occupy
+    :return:        occupy_options
+    """
+    cli = typer.Typer(add_completion=False)
+    cli.command()(parse_and_run)
+    ctx = typer.main.get_command(cli).make_context('occupy', list(argv))
+
+    return options_from_params(ctx.params)
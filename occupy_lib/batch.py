@@ -0,0 +1,262 @@
+import os
+import io
+import csv
+import glob
+import time
+import contextlib
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import typer
+
+from occupy_lib import estimate, args
+
+
+summary_fields = ['input_map', 'output_dir', 'status', 'max_val', 'variability_limit', 'confidence_limit', 'target_occupancy', 'time']
+
+# Options that name files or directories, and so must not depend on the per-map working directory
+path_options = ['input_map', 'solvent_def', 'target_mask', 'target_labels', 'roi_mask', 'cache_dir']
+
+
+def expand_inputs(
+        inputs: str
+):
+    """
+    Find the input maps of a batch, from a glob pattern or a list file with one map per line
+
+    Lines of a list file that are empty or start with # are ignored. Relative paths in a list file are taken
+    relative to the list file.
+
+    :param inputs:  glob pattern, or list file name
+    :return:        list of input map file names
+    """
+    if os.path.isfile(inputs) and Path(inputs).suffix not in ['.mrc', '.map']:
+        parent = Path(inputs).parent
+        maps = []
+        with open(inputs) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    maps.append(str(parent / line))
+        return maps
+
+    return sorted(glob.glob(inputs))
+
+
+def map_dir_names(
+        maps: list
+):
+    """
+    Name the per-map output directories of a batch, after the input maps
+
+    Maps whose file names are the same (e.g. in different directories) get the index of the map in the batch
+    appended, so that no two maps share an output directory.
+
+    :param maps:    input map file names
+    :return:        list of directory names, one per map
+    """
+    stems = [Path(m).stem for m in maps]
+    names = []
+    for i, stem in enumerate(stems):
+        name = stem if stems.count(stem) == 1 else f'{stem}_{i}'
+        while name in names or (name != stem and name in stems):
+            name = f'{name}_{i}'
+        names.append(name)
+    return names
+
+
+def set_memory_limit(
+        memory_limit: float = None
+):
+    """
+    Limit the address space of the current process to what it uses now, plus a budget.
+
+    This is meant to run once the worker has imported everything, so that the budget is what is available for
+    processing. A map that needs more fails with a MemoryError, instead of making the machine swap.
+
+    :param memory_limit:    budget [MB], or None for no limit
+    """
+    if memory_limit is None:
+        return
+    import resource  # Not on windows
+
+    current = 0
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+
+    limit = current + int(memory_limit * 2 ** 20)
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def run_one(
+        input_map: str,
+        argv: list,
+        map_dir: str
+):
+    """
+    Run occupy on one map of a batch, in a directory of its own
+
+    Relative paths in the arguments are taken relative to the directory the batch is run from, not the per-map
+    directory.
+
+    :param input_map:   input map file name
+    :param argv:        occupy command-line arguments, applied to every map
+    :param map_dir:     per-map directory, to run in
+    :return:            summary row (dict)
+    """
+    row = dict.fromkeys(summary_fields)
+    row['input_map'] = input_map
+    row['output_dir'] = str(map_dir)
+
+    Path(map_dir).mkdir(parents=True, exist_ok=True)
+
+    cwd = os.getcwd()
+    t0 = time.perf_counter()
+    try:
+        options = args.options_from_args(argv)
+        options.input_map = input_map
+        for name in path_options:
+            if getattr(options, name) is not None:
+                setattr(options, name, os.path.abspath(getattr(options, name)))
+        os.chdir(map_dir)
+
+        # Workers share the terminal, so keep per-map output in the map directory
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            result = estimate.occupy_run(options)
+        with open(f'stdout_{Path(input_map).stem}.txt', 'w') as f:
+            f.write(out.getvalue())
+
+        row['status'] = 'ok'
+        row['max_val'] = float(result.max_val)
+        row['variability_limit'] = float(result.variability_limit)
+        row['confidence_limit'] = float(result.confidence_limit)
+        if result.target_occupancy is not None:
+            row['target_occupancy'] = float(result.target_occupancy)
+    except MemoryError:
+        row['status'] = 'failed: out of memory'
+    except Exception as e:
+        row['status'] = f'failed: {type(e).__name__}: {e}'
+    finally:
+        os.chdir(cwd)
+
+    row['time'] = time.perf_counter() - t0
+    return row
+
+
+def run_batch(
+        inputs: str,
+        argv: list = None,
+        jobs: int = 1,
+        worker_memory: float = None,
+        output_dir: str = '.',
+        quiet: bool = False
+):
+    """
+    Run occupy on many maps in a pool of processes, and write a summary table
+
+    Each worker process imports everything once, and then processes maps one at a time. Each map gets its own
+    output directory in output_dir, named after the map (with its index in the batch appended if several maps
+    have the same name). The summary is written to occupy_batch_summary.csv.
+
+    :param inputs:          glob pattern, or list file name
+    :param argv:            occupy command-line arguments, applied to every map
+    :param jobs:            number of worker processes
+    :param worker_memory:   memory budget of each worker, on top of its imports [MB]
+    :param output_dir:      directory for per-map directories and the summary
+    :param quiet:           do not print progress
+    :return:                summary rows, in input order
+    """
+    if argv is None:
+        argv = []
+
+    maps = expand_inputs(inputs)
+    if len(maps) == 0:
+        raise ValueError(f'** fail ** no input maps found for {inputs}')
+
+    # Fail early on bad options, rather than once per map
+    args.options_from_args(argv)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    rows = []
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=set_memory_limit,
+            initargs=(worker_memory,)
+    ) as pool:
+        map_dirs = [Path(output_dir) / name for name in map_dir_names(maps)]
+        futures = [pool.submit(run_one, m, argv, d) for m, d in zip(maps, map_dirs)]
+        for m, future in zip(maps, futures):
+            row = future.result()
+            rows.append(row)
+            if not quiet:
+                print(f'{row["time"]:8.1f}s  {m}  {row["status"]}')
+
+    summary_name = Path(output_dir) / 'occupy_batch_summary.csv'
+    with open(summary_name, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=summary_fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    if not quiet:
+        n_ok = sum(row['status'] == 'ok' for row in rows)
+        print(f'Processed {n_ok}/{len(rows)} maps, summary in {summary_name}')
+
+    return rows
+
+
+def parse_and_run_batch(
+        ctx: typer.Context,
+        inputs: str = typer.Argument(
+            ...,
+            help="Input maps, as a quoted glob pattern (\"maps/*.mrc\") or a file listing one map per line"
+        ),
+        jobs: int = typer.Option(
+            1,
+            "--jobs", "-j",
+            min=1,
+            help="Number of maps to process in parallel"
+        ),
+        worker_memory: float = typer.Option(
+            None,
+            "--worker-memory",
+            help="Memory available to each parallel job for processing [MB]. Maps that need more fail, and are reported as such"
+        ),
+        output_dir: str = typer.Option(
+            '.',
+            "--output-dir", "-o",
+            help="Directory in which to put one output directory per map, and the summary"
+        ),
+        quiet: bool = typer.Option(
+            False,
+            "--quiet",
+            help="No extraneous output"
+        )
+):
+    """
+    Run occupy on many maps. Any other options are passed on to occupy, and used for every map.
+    """
+    argv = list(ctx.args)
+    if quiet:
+        argv.append('--quiet')
+    run_batch(
+        inputs,
+        argv,
+        jobs=jobs,
+        worker_memory=worker_memory,
+        output_dir=output_dir,
+        quiet=quiet
+    )
+
+
+def app(argv: list = None):
+    cli = typer.Typer(add_completion=False)
+    cli.command(context_settings={"allow_extra_args": True, "ignore_unknown_options": True})(parse_and_run_batch)
+    cli(args=argv, prog_name='occupy batch')
@@ -0,0 +1,335 @@
+import tempfile
+
+import numpy as np
+import scipy.fft as spfft
+
+from occupy_lib import map_tools
+
+
+class Workspace:
+    """
+    Allocates the full-size arrays of a run, and sets how much of them is processed at a time
+
+    Without a memory limit, arrays are kept in memory, as usual. With a memory limit, every full-size array is
+    memory-mapped to an (unnamed) temporary file in the default temporary directory (see TMPDIR), and the
+    processing is done in slabs along the first axis that fit the limit. Slabs that need their neighbourhood, as
+    for the max-filter, are padded by the kernel extent. Low-pass filters are applied as separable transforms,
+    one slab at a time along each axis, and give the same result as transforming the whole map at once.
+
+    :param memory_limit:    approximate working memory [MB], or None to process everything in memory
+    """
+
+    def __init__(
+            self,
+            memory_limit: float = None
+    ):
+        self.memory_limit = memory_limit
+
+    @property
+    def out_of_core(self):
+        return self.memory_limit is not None
+
+    def empty(
+            self,
+            shape,
+            dtype=np.float32
+    ):
+        """
+        A new full-size array, as np.empty
+
+        :param shape:   array shape
+        :param dtype:   array dtype
+        :return:        array, memory-mapped if out-of-core
+        """
+        if not self.out_of_core:
+            return np.empty(shape, dtype=dtype)
+        # The file is already unlinked, and the mapping keeps it until the array is no longer used
+        with tempfile.TemporaryFile() as f:
+            return np.memmap(f, dtype=dtype, mode='w+', shape=tuple(shape))
+
+    def slab(
+            self,
+            shape,
+            bytes_per_voxel: int,
+            halo: int = 0
+    ):
+        """
+        Thickness along the first axis of the slabs to process at a time
+
+        :param shape:               full array shape
+        :param bytes_per_voxel:     working memory per voxel of a slab, including its halo
+        :param halo:                padding of each slab on either side
+        :return:                    slab thickness
+        """
+        if not self.out_of_core:
+            return shape[0]
+        plane = int(np.prod(shape[1:]))
+        thickness = int(self.memory_limit * 2 ** 20 // (bytes_per_voxel * plane)) - 2 * halo
+        if thickness < 1:
+            raise ValueError(
+                f'** fail ** --memory-limit {self.memory_limit} MB is too small to process slabs of {shape[1:]} pixels')
+        return int(np.min([thickness, shape[0]]))
+
+    def chunk_elements(
+            self,
+            shape,
+            bytes_per_voxel: int
+    ):
+        """
+        Number of elements to process at a time, for functions that take chunk_elements
+
+        :param shape:               full array shape
+        :param bytes_per_voxel:     working memory per voxel
+        :return:                    number of elements
+        """
+        plane = int(np.prod(shape[1:]))
+        return int(np.min([2 ** 22, self.slab(shape, bytes_per_voxel) * plane]))
+
+    def slabs(
+            self,
+            shape,
+            bytes_per_voxel: int
+    ):
+        """
+        Slices of the slabs along the first axis to process at a time
+
+        :param shape:               full array shape
+        :param bytes_per_voxel:     working memory per voxel
+        :return:                    list of slices
+        """
+        slab = self.slab(shape, bytes_per_voxel)
+        return [slice(i, i + slab) for i in range(0, shape[0], slab)]
+
+    def radial_mask(
+            self,
+            size: int,
+            radius: float
+    ):
+        """
+        Spherical mask, as map_tools.create_radial_mask(size, dim=3, radius=radius)
+
+        :param size:    array size
+        :param radius:  radius of the mask
+        :return:        boolean array
+        """
+        if not self.out_of_core:
+            return map_tools.create_radial_mask(size, dim=3, radius=radius)
+
+        idx = np.arange(size, dtype=np.int32)
+        out = self.empty((size, size, size), dtype=bool)
+        for sl in self.slabs(out.shape, bytes_per_voxel=16):
+            out[sl] = radial_mask_block(size, radius, idx[sl, None, None], idx[None, :, None], idx[None, None, :])
+        return out
+
+    def lowpass(
+            self,
+            data: np.ndarray,
+            resolution: float,
+            voxel_size: float,
+            workers: int = 1
+    ):
+        """
+        Low-pass a cubic 3D array, as map_tools.lowpass(data, resolution, voxel_size=voxel_size)
+
+        :param data:        input array
+        :param resolution:  spatial cutoff [Å]
+        :param voxel_size:  voxel size [Å]
+        :param workers:     number of workers for the FFT
+        :return:            low-passed array, output voxel size
+        """
+        if not self.out_of_core:
+            return map_tools.lowpass(data, resolution, voxel_size=voxel_size, workers=workers)
+
+        n = np.shape(data)[0]
+        keep_shells = int(np.floor((n * voxel_size) / resolution))
+        out_voxel_size = np.copy(voxel_size)
+        if 2 * keep_shells > n:
+            # Nothing to low-pass
+            return data, out_voxel_size
+
+        # The same (square-cropped radial) window as map_tools.Spectrum
+        window = shifted_window(n, radius=keep_shells + 1, box=keep_shells)
+        return spectral_filter(data, window, self, workers=workers), out_voxel_size
+
+    def lowpass_map(
+            self,
+            data: np.ndarray,
+            cutoff: float = None,
+            voxel_size: float = 1.0,
+            keep_scale: bool = False,
+            workers: int = 1
+    ):
+        """
+        Low-pass a cubic 3D array, as map_tools.lowpass_map (without resampling)
+
+        :param data:        input array
+        :param cutoff:      spatial cutoff [Å]
+        :param voxel_size:  voxel size [Å]
+        :param keep_scale:  keep the mean and maximum of the input
+        :param workers:     number of workers for the FFT
+        :return:            low-passed array
+        """
+        if not self.out_of_core:
+            return map_tools.lowpass_map(data, cutoff, voxel_size, keep_scale=keep_scale, workers=workers)
+        if cutoff is None:
+            return data
+
+        n = np.shape(data)[0]
+        ref_scale = np.max(data)
+        cutoff_level = int(np.floor(2 * (n / (cutoff / voxel_size))))
+        r_data = spectral_filter(data, shifted_window(n, radius=cutoff_level), self, workers=workers)
+
+        if keep_scale:
+            m = np.mean(r_data)
+            factor = ref_scale / np.max(r_data)
+            for sl in self.slabs(r_data.shape, bytes_per_voxel=8):
+                r_data[sl] -= m
+                r_data[sl] *= factor
+                r_data[sl] += m
+        return r_data
+
+
+def radial_mask_block(
+        size: int,
+        radius: float,
+        x: np.ndarray,
+        y: np.ndarray,
+        z: np.ndarray
+):
+    """
+    Part of map_tools.create_radial_mask(size, dim=3, radius=radius), at the given (broadcastable) int32 indices
+
+    The arithmetic is the same, so that the parts are identical to the full mask.
+    """
+    center = np.float32((size - 1) / 2)
+    radius = np.float32(radius)
+    dist_from_center = (x - center) ** 2 + (y - center) ** 2 + (z - center) ** 2
+    return np.sqrt(dist_from_center.astype(np.float32)) <= radius
+
+
+def shifted_window(
+        n: int,
+        radius: float,
+        box: int = None
+):
+    """
+    Radial low-pass window of a half-spectrum, as used on centered (shifted) spectra by map_tools
+
+    The window is returned as a function of unshifted (FFT-order) indices along the three axes, so that it can be
+    evaluated for any part of an unshifted half-spectrum.
+
+    :param n:       full (not half) spectrum length
+    :param radius:  radius of map_tools.radial_window
+    :param box:     also only keep the central [-box, box) along the first two axes and [0, box] along the last
+    :return:        function of (z, y, x) index arrays, returning a broadcast boolean window
+    """
+    mid = n // 2
+
+    def window(z, y, x):
+        # Indices in the centered spectrum, and in the full mask that radial_window is cut from
+        z = ((z + mid) % n).astype(np.int32)
+        y = ((y + mid) % n).astype(np.int32)
+        x = np.asarray(x, dtype=np.int32)
+        w = radial_mask_block(n, radius, z, y, x + mid - 1)
+        if box is not None:
+            w = w & (z >= mid - box) & (z < mid + box)
+            w = w & (y >= mid - box) & (y < mid + box)
+            w = w & (x <= box)
+        return w
+
+    return window
+
+
+def spectral_filter(
+        data: np.ndarray,
+        window,
+        workspace: Workspace,
+        workers: int = 1
+):
+    """
+    Multiply the half-spectrum of a cubic 3D array by a window, and transform back, one slab at a time
+
+    The 3D transform is separable. The last two axes are transformed one slab along the first axis at a time, and
+    the first axis one slab along the second axis at a time. The spectrum is kept in a full-size array from the
+    workspace, so only slabs are ever in memory. The result is the same as with rfftn and irfftn.
+
+    :param data:        input array
+    :param window:      function of (z, y, x) index arrays, see shifted_window
+    :param workspace:   Workspace, which allocates the spectrum and output
+    :param workers:     number of workers for the FFT
+    :return:            filtered array
+    """
+    n = np.shape(data)[0]
+    h = n // 2 + 1
+    c_type = np.result_type(data.dtype, np.complex64)
+    f_data = workspace.empty((n, n, h), dtype=c_type)
+    out = workspace.empty(np.shape(data), dtype=np.result_type(data.dtype, np.float32))
+
+    # Complex slabs, with intermediates
+    slab = workspace.slab(np.shape(data), bytes_per_voxel=4 * np.dtype(c_type).itemsize)
+    idx = np.arange(n)
+
+    with spfft.set_workers(workers):
+        for i in range(0, n, slab):
+            f = spfft.rfft(data[i:i + slab], axis=2)
+            f_data[i:i + slab] = spfft.fft(f, axis=1, overwrite_x=True)
+
+        for j in range(0, n, slab):
+            f = spfft.fft(f_data[:, j:j + slab], axis=0)
+            f *= window(idx[:, None, None], idx[None, j:j + slab, None], np.arange(h)[None, None, :])
+            f_data[:, j:j + slab] = spfft.ifft(f, axis=0, overwrite_x=True)
+
+        for i in range(0, n, slab):
+            f = spfft.ifft(f_data[i:i + slab], axis=1)
+            out[i:i + slab] = spfft.irfft(f, n=n, axis=2, overwrite_x=True)
+
+    return out
+
+
+def smallest_variance_region(
+        data: np.ndarray,
+        region: np.ndarray,
+        consider: np.ndarray,
+        workspace: Workspace
+):
+    """
+    As solvent.smallest_variance_region, one slab at a time
+
+    :param data:        input array
+    :param region:      region (mask) definition
+    :param consider:    boolean mask of the voxels to consider
+    :param workspace:   Workspace, which allocates the output
+    :return:            boolean array, the region or its inverse within consider
+    """
+    slabs = workspace.slabs(np.shape(data), bytes_per_voxel=32)
+
+    # Variance inside and outside the region, combined across slabs (Chan et al.)
+    stats = np.zeros((2, 3))
+    for sl in slabs:
+        inside = region[sl] > 0.9
+        c = consider[sl]
+        data_in = np.multiply(data[sl], c)
+        for k, sel in enumerate([inside & c, ~inside & c]):
+            values = data_in[sel].astype(np.float64)
+            if values.size == 0:
+                continue
+            n, mean, m2 = stats[k]
+            c_mean = np.mean(values)
+            c_m2 = np.sum((values - c_mean) ** 2)
+            delta = c_mean - mean
+            stats[k] = [n + values.size,
+                        mean + delta * values.size / (n + values.size),
+                        m2 + c_m2 + delta ** 2 * n * values.size / (n + values.size)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # No voxels gives nan, as np.var
+        region_var, region_inv_var = stats[:, 2] / stats[:, 0]
+
+    out = workspace.empty(np.shape(data), dtype=bool)
+    for sl in slabs:
+        inside = region[sl] > 0.9
+        if region_var < region_inv_var:
+            # Solvent will have smaller variance, so we return the region covering the solvent
+            out[sl] = inside & consider[sl]
+        else:
+            out[sl] = ~inside & consider[sl]
+    return out
@@ -0,0 +1,182 @@
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from occupy_lib import args
+
+# Options that change the estimated scale, confidence or solvent model. Options that only change how the
+# estimate is used (amplify, attenuate, sigmoid, nlrc, output lowpass,...) are not part of the key.
+key_options = [
+    'lowpass_input',
+    'kernel_size',
+    'kernel_radius',
+    'tau',
+    'tile_size',
+    'max_box',
+    'scale_mode',
+    's0',
+    'hedge_confidence',
+    'precision',
+    'sym'
+]
+
+# Cached entries of the estimate, see estimate.estimate_scale
+cached_keys = [
+    'scale',
+    'max_val',
+    'tiles_raw',
+    'tile_index',
+    'variability_limit',
+    'confidence',
+    'mapping',
+    'histogram',
+    'sol_limits',
+    'solvent_parameters'
+]
+
+
+def estimate_key(
+        data: np.ndarray,
+        voxel_size: float,
+        options: args.occupy_options,
+        solvent_def: np.ndarray = None
+):
+    """
+    Content hash of everything that the scale estimate of a map depends on
+
+    :param data:            input map
+    :param voxel_size:      voxel size of the input map [Å]
+    :param options:         options of the run, with all estimation settings calculated
+    :param solvent_def:     solvent definition map (optional)
+    :return:                hex digest
+    """
+    h = hashlib.sha256()
+    h.update(f'occupy {args.__version__}'.encode())
+
+    data = np.ascontiguousarray(data)
+    h.update(f'{data.dtype.str} {data.shape} {float(voxel_size):.6f}'.encode())
+    h.update(memoryview(data).cast('B'))
+
+    for name in key_options:
+        h.update(f'{name}={getattr(options, name)!r};'.encode())
+
+    if solvent_def is not None:
+        solvent_def = np.ascontiguousarray(solvent_def)
+        h.update(f'solvent_def {solvent_def.dtype.str} {solvent_def.shape}'.encode())
+        h.update(memoryview(solvent_def).cast('B'))
+
+    return h.hexdigest()
+
+
+def entry_name(
+        cache_dir: str,
+        key: str
+):
+    return Path(cache_dir) / f'occupy_{key}.npz'
+
+
+def load(
+        cache_dir: str,
+        key: str
+):
+    """
+    Load a cached estimate, if there is one
+
+    :param cache_dir:   cache directory
+    :param key:         key from estimate_key
+    :return:            dict of the estimate, or None
+    """
+    file_name = entry_name(cache_dir, key)
+    if not file_name.is_file():
+        return None
+
+    try:
+        with np.load(file_name) as f:
+            estimated = {k: f[k] for k in f.files}
+    except (OSError, ValueError):
+        # Unreadable entries are simply estimated again
+        return None
+
+    # Entries written by an earlier version may lack some of the estimate
+    if any(k not in estimated for k in cached_keys if k != 'histogram'):
+        return None
+
+    # Mark as recently used
+    os.utime(file_name)
+
+    for k in ['tiles_raw', 'tile_index']:
+        if estimated[k].size == 0:
+            estimated[k] = None
+    estimated['max_val'] = estimated['max_val'].item()
+    estimated['variability_limit'] = estimated['variability_limit'].item()
+    estimated['histogram'] = (estimated.pop('histogram_counts'), estimated.pop('histogram_edges'))
+    return estimated
+
+
+def store(
+        cache_dir: str,
+        key: str,
+        estimated: dict,
+        max_size: float = None
+):
+    """
+    Store an estimate, and evict the least recently used entries if the cache is too large
+
+    :param cache_dir:   cache directory
+    :param key:         key from estimate_key
+    :param estimated:   dict of the estimate, as from estimate.estimate_scale
+    :param max_size:    maximum total size of the cache [MB]
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    entry = {k: estimated[k] for k in cached_keys if k != 'histogram'}
+    for k in ['tiles_raw', 'tile_index']:
+        if entry[k] is None:
+            entry[k] = np.zeros(0)
+    entry['histogram_counts'], entry['histogram_edges'] = estimated['histogram']
+
+    # Write to a temporary file first, so that concurrent runs never see a partial entry
+    fd, tmp_name = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **entry)
+        os.replace(tmp_name, entry_name(cache_dir, key))
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    if max_size is not None:
+        evict(cache_dir, max_size)
+
+
+def evict(
+        cache_dir: str,
+        max_size: float
+):
+    """
+    Remove the least recently used entries until the cache is no larger than max_size
+
+    :param cache_dir:   cache directory
+    :param max_size:    maximum total size of the cache [MB]
+    """
+    entries = []
+    for file_name in Path(cache_dir).glob('occupy_*.npz'):
+        try:
+            stat = file_name.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file_name))
+
+    total = sum(e[1] for e in entries)
+    for _, size, file_name in sorted(entries):
+        if total <= max_size * 2 ** 20:
+            break
+        try:
+            file_name.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
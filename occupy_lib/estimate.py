@@ -1,62 +1,485 @@
+import copy
+import csv
+import io
 import os
+import warnings
 import numpy as np
 import mrcfile as mf
 from pathlib import Path
 
-from occupy_lib import map_tools, occupancy, vis, solvent, extras, args   # for terminal use
+from occupy_lib import map_tools, occupancy, vis, solvent, extras, args, cache, bricks, symmetry   # for terminal use
 
 from skimage.exposure import match_histograms
 
 
-def occupy_run(options: args.occupy_options):
+class OccupyResult:
     """
-    OccuPy takes a cryo-EM reconstruction produced by averaging and estimates a self-normative local map scaling.
-    It can also locally alter confident partial occupancies.
+    The output of estimate_arrays
+
+    Scale and confidence are at the processing size, which is smaller than the input if it was larger than
+    --max-box. Modified maps are at the input size. With a region of interest, maps are pasted back into the full
+    box, except scale and confidence if the region was down-scaled for processing, which then only cover the region.
     """
 
-    if options.help_all:
-        extras.help_all()
+    def __init__(self):
+        self.scale = None                   # Estimated local scale [0,1]
+        self.confidence = None              # Confidence of content (not solvent) [0,1]
+        self.solvent_parameters = None      # Fitted solvent model
+        self.solvent_limits = None          # Detected solvent limits
+        self.max_val = None                 # The value at full scale
+        self.variability_limit = None       # Scale of full-occupancy regions with full variability
+        self.confidence_limit = None        # The lowest scale we can be confident about
+        self.target_occupancy = None        # Estimated occupancy in the target mask, if given
+        self.label_occupancies = None       # Estimated occupancy of each label of the target labels, if given
+        self.roi = None                     # Region of interest the estimate was restricted to, if any (map_tools.Roi)
+        self.tiles = None                   # Tiles used for scale normalization, in input coordinates [Å]
+        self.tile_index = None              # Percentile of every tile, at the processing size [pix] (see occupancy.TileScan.index)
+        self.voxel_size = None              # Voxel size of the processed data [Å]
+        self.modified = {}                  # Modified maps, keyed by modification (ampl/attn/sigm/solExcl)
+        self.confidence_mapping = None      # Confidence as a function of value, on the histogram bins
+        self.histogram = None               # Histogram of the data used to fit the solvent model
+        self.warnings = None                # Warnings to relay to the user
+        self.log = ''                       # Log of settings and detected limits
+        self.options = None                 # Options of the run, with all settings that were not given calculated
+
+
+class FileSink:
+    """
+    Writes the maps produced by estimate_arrays to .mrc files, with headers matching the input map
 
-    if options.input_map is None:
-        if options.emdb_id is None:
-            exit(1)  # TODO surely a better way to do nothing with no options. Invoke help?
+    The written file names are kept in self.written, keyed like OccupyResult.modified, with 'scale' and 'conf'.
+
+    The header of the input map is read once, and every output file is written once with its final header.
+
+    :param options:     options of the run, which define the input map and output names
+    :param parent:      header of the input map, if already read (optional)
+    """
+
+    def __init__(
+            self,
+            options: args.occupy_options,
+            parent: map_tools.ParentHeader = None
+    ):
+        if parent is None:
+            parent = map_tools.ParentHeader(options.input_map)
+        self.parent = parent
+        self.verbose = options.verbose
+        self.options = options
+
+        # Remove path for output, and force .mrc
+        self.new_name = f'{Path(Path(options.input_map).name).stem}.mrc'
+
+        self.output_prefix = ''
+        if options.keep_output_path:
+            self.output_prefix = f'{Path(options.input_map).parent}/'
+
+        self.base_out_name = f'{self.new_name}'
+        if options.exclude_solvent:
+            self.base_out_name = f'solExcl_{self.new_name}'
+
+        self.written = {}
+
+    def file_name(
+            self,
+            key: str
+    ):
+        """
+        The output file name for a given output
+
+        Modified maps are keyed ampl, attn and sigm, or by their label (e.g. ampl_4) when sweeping several values.
+
+        :param key:     scale, conf, ampl, attn, sigm, a modification label, solExcl, downscaled or lowpass
+        :return:        file name
+        """
+        o = self.options
+        kind = key.split('_')[0]
+        if kind in ['ampl', 'attn', 'sigm']:
+            label = key
+            if key == kind:
+                label = args.modification_label(kind, args.modification_sweep(o)[kind][0])
+            return f'{self.output_prefix}{label}_{self.base_out_name}'
+        if key == 'scale':
+            if o.s0:
+                return f'scale_naive_{o.scale_mode}_{self.new_name}'
+            return f'{self.output_prefix}scale_{o.scale_mode}_{self.new_name}'
+        elif key == 'conf':
+            return f'{self.output_prefix}conf_{self.new_name}'
+        elif key == 'solExcl':
+            return f'{self.output_prefix}{self.base_out_name}'
+        elif key == 'downscaled':
+            return 'downscaled.mrc'
+        elif key == 'lowpass':
+            return f'lowpass_{self.new_name}'
+        raise ValueError(f'Unknown output {key}')
+
+    def write(
+            self,
+            key: str,
+            data: np.ndarray,
+            extra_header: str = None,
+            log=None,
+            parent: map_tools.ParentHeader = None
+    ):
+        """
+        Write an output map
+
+        :param key:             which output, see file_name
+        :param data:            data to write
+        :param extra_header:    String for output header                            (optional)
+        :param log:             Log-file handle                                     (optional)
+        :param parent:          header to write with, if not that of the input map  (optional)
+        :return:                the written file name
+        """
+        file_name = self.file_name(key)
+        map_tools.new_mrc(
+            data,
+            file_name,
+            parent=self.parent if parent is None else parent,
+            verbose=self.verbose,
+            extra_header=extra_header,
+            log=log
+        )
+        self.written[key] = file_name
+        return file_name
+
+
+def finalize_modification(
+        modified: dict,
+        options: args.occupy_options,
+        voxel_size: float,
+        output_size: int = None,
+        reference: np.ndarray = None,
+        value_range: np.ndarray = None,
+        workspace: bricks.Workspace = None
+):
+    """
+    Low-pass and resample modified maps to the output size, and match the input range
+
+    Solvent suppression is done by occupancy.modify_many, in the same pass as the modification. All maps are
+    low-passed and resampled together, with one batched forward and inverse transform.
+
+    :param modified:        modified and solvent-suppressed maps (dict)
+    :param options:         options of the run
+    :param voxel_size:      voxel size of the processing data [Å]
+    :param output_size:     size to resample to, if processing was downscaled
+    :param reference:       input map, to match the histogram of
+    :param value_range:     range of the input map, to clip to
+    :param workspace:       allocates full-size arrays, and sets slab sizes  (optional)
+    :return:                final modified maps (dict)
+    """
+    modified = dict(modified)
+
+    if workspace is not None and workspace.out_of_core:
+        # Each map is filtered on its own, one slab at a time, and clipped in place. There is no resampling.
+        for key in modified:
+            if options.lowpass_output is not None:
+                modified[key], _ = workspace.lowpass(
+                    modified[key],
+                    options.lowpass_output,
+                    voxel_size=voxel_size,
+                    workers=options.threads
+                )
+            for sl in workspace.slabs(np.shape(modified[key]), bytes_per_voxel=8):
+                np.clip(modified[key][sl], value_range[0], value_range[1], out=modified[key][sl])
+        return modified
+
+    # -- Low-pass filter output --
+    # If the input map was larger than the maximum processing size, we need to get back the bigger size as output.
+    # Both are done with a single inverse transform.
+    if options.lowpass_output is not None or output_size is not None:
+        # Maps are batched by precision, so that none is promoted
+        batches = {}
+        for key, data in modified.items():
+            batches.setdefault(data.dtype, []).append(key)
+        for keys in batches.values():
+            stack = np.stack([modified.pop(key) for key in keys])
+            stack, _ = map_tools.Spectrum(stack, workers=options.threads, stacked=True).lowpass(
+                resolution=options.lowpass_output,
+                voxel_size=voxel_size,
+                output_size=output_size,
+                square=output_size is not None
+            )
+            for key, data in zip(keys, stack):
+                modified[key] = data
+            del stack
+
+    # -- Match output range --
+    # inverse filtering can create a few spurious pixels that
+    # ruin the dynamic range compared to the input. This is mostly
+    # aesthetic.
+    # TODO Compare power spectrum of input out put to examine spectral effect
+    # TODO also check the average change in pixel value, anf how it relates to power spectral change
+    for key, data in modified.items():
+        if options.hist_match:
+            modified[key] = match_histograms(
+                data,
+                reference=reference
+            )  # Output is no longer input + stuff, i.e. good part is now something else.
         else:
-            options.input_map = map_tools.fetch_EMDB(options.emdb_id)
-            if options.scale_mode is None:
-                options.scale_mode = 'res'
+            modified[key] = map_tools.clip_to_range(
+                data,
+                range=value_range
+            )
+    # TODO  -  Test histogram-matching of low-occupancy regions with high-occupancy as reference?
+
+    return modified
+
+
+def estimate_scale(
+        in_data: np.ndarray,
+        voxel_size: float,
+        scale_kernel: np.ndarray,
+        options: args.occupy_options,
+        solvent_def: np.ndarray = None,
+        sink: FileSink = None,
+        log=None,
+        workspace: bricks.Workspace = None,
+        sym_source: np.ndarray = None
+):
+    """
+    Estimate the solvent model, local scale and confidence of the processing data
+
+    Everything returned except scale_data only depends on the input and the estimation settings, see cache.py
+
+    :param in_data:         input map at the processing size
+    :param voxel_size:      voxel size of the processing data [Å]
+    :param scale_kernel:    kernel for the scale estimation
+    :param options:         options of the run, with all settings calculated
+    :param solvent_def:     solvent definition map at the processing size   (optional)
+    :param sink:            writes intermediate maps with --save-all-maps   (optional)
+    :param log:             log-file handle                                 (optional)
+    :param workspace:       allocates full-size arrays, and sets slab sizes   (optional)
+    :param sym_source:      symmetry-equivalent voxels, see symmetry.asymmetric_unit (optional)
+    :return:                dict of estimated arrays and values
+    """
+    if workspace is None:
+        workspace = bricks.Workspace()
 
-    if options.plot:
-        import matplotlib.pyplot as plt
+    # ----- LOW-PASS SETTINGS ---------
 
+    use_lp = False
+    if options.scale_mode=='occ':
+        use_lp=True
 
+    # Neither the scale nor the solvent estimation modify their input, so these are views of the input or low-pass
+    scale_data = in_data
+    if options.lowpass_input > 2 * voxel_size:
 
-    # Remove path for output
-    new_name = Path(options.input_map).name
-    # Force .mrc for output
-    new_name = f'{Path(new_name).stem}.mrc'
-    doc = ''
+        lp_data, _ = workspace.lowpass(
+            in_data,
+            options.lowpass_input,
+            voxel_size=voxel_size,
+            workers=options.threads
+        )
+        if options.save_all_maps and sink is not None:
+            sink.write('lowpass', lp_data, log=log)
+        if use_lp:
+            scale_data = lp_data
+            if options.verbose:
+                print('Using low-passed input to estimate scale')
+        else:
+            if options.verbose:
+                print('Using raw input to estimate scale')
+
+        sol_data = lp_data
+        del lp_data
+
+    else:
+        sol_data = in_data
+
+    # --------------- SOLVENT ESTIMATION -------------------------------------------------------
+
+    nd_processing = np.shape(in_data)[0]
+    radius = int(nd_processing // 2)
+    mask = workspace.radial_mask(nd_processing, radius=radius)
+    levels = 1000
+    if solvent_def is not None:
+        assert solvent_def.shape == sol_data.shape
+
+        # Make a mask from the solvent definition.
+        # People might provide a mask that covers the solvent or content, we will use it as makes most sense
+        if workspace.out_of_core:
+            solvent_region = bricks.smallest_variance_region(sol_data, solvent_def, mask, workspace)
+        else:
+            solvent_region = solvent.smallest_variance_region(
+                sol_data,  # data
+                solvent_def,  # solvent def
+                mask  # radial mask
+            )
+
+        solvent_hist = map_tools.Histogram(sol_data, n_lev=levels, mask=solvent_region)
+    else:
+        assert sol_data.shape == mask.shape
+        solvent_hist = map_tools.Histogram(sol_data, n_lev=levels, mask=mask)
+
+    # Estimate the solvent model
+    sol_limits, solvent_parameters = solvent.fit_solvent_to_histogram(
+        solvent_hist,
+        plot=options.plot,
+        n_lev=levels
+    )
+
+    # --------------- SCALE ESTIMATION ------------------------------------------------------
+
+    scale, max_val, tiles_raw, tile_index, tiles = occupancy.get_map_scale(
+        scale_data,
+        scale_kernel=scale_kernel,
+        tau=options.tau,
+        s0=options.s0,
+        tile_size=options.tile_size,
+        scale_mode=options.scale_mode,
+        threads=options.threads,
+        verbose=options.verbose,
+        block=int(np.min([32, workspace.slab(np.shape(scale_data), 16, halo=np.max(scale_kernel.shape) // 2)])),
+        out=workspace.empty(np.shape(scale_data), dtype=scale_data.dtype),
+        source=sym_source
+    )
+
+    # Get the average pixel value across all regions with full scale
+    # This is an estimate of the density, which we can convert back to a scale,
+    # which in turn signifies the expected scale at full occupancy AND full variability/flex
+    # The varaibility limit is thus the expected scale if some thing at full occupancy is completely
+    # incoherent due to e.g. flexibility
+    if workspace.out_of_core:
+        full_sum, full_n = 0.0, 0
+        for sl in workspace.slabs(np.shape(scale), bytes_per_voxel=8):
+            full = scale_data[sl][scale[sl] == 1]
+            full_sum += np.sum(full, dtype=np.float64)
+            full_n += full.size
+        if full_n == 0:
+            # As np.mean of no voxels in memory
+            warnings.warn('No voxels are at full scale, so the variability limit is undefined', RuntimeWarning)
+            variability_limit = np.nan
+        else:
+            variability_limit = full_sum / full_n / max_val
+    else:
+        variability_limit = np.mean(scale_data[scale == 1]) / max_val
+
+    # --------------- CONFIDENCE ESTIMATION ------------------------------------------------------
+
+    # The same histogram gives the confidence mapping and is kept for plotting
+    sol_hist = map_tools.Histogram(sol_data, n_lev=levels)
+    confidence, mapping = occupancy.estimate_confidence(
+        sol_data,
+        solvent_parameters,
+        hedge_confidence=options.hedge_confidence,
+        histogram=sol_hist,
+        chunk_elements=workspace.chunk_elements(np.shape(sol_data), bytes_per_voxel=32),
+        out=workspace.empty(np.shape(sol_data), dtype=np.float32)
+    )
+
+    # clean sol_data asap
+    a, b = sol_hist.density, sol_hist.edges
+    del sol_data
+
+    return {
+        'scale': scale,
+        'max_val': max_val,
+        'tiles_raw': tiles_raw,
+        'tile_index': tile_index,
+        'tiles': tiles,
+        'variability_limit': variability_limit,
+        'confidence': confidence,
+        'mapping': mapping,
+        'histogram': (a, b),
+        'sol_limits': sol_limits,
+        'solvent_parameters': solvent_parameters,
+        'scale_data': scale_data
+    }
+
+
+def target_tiles(
+        estimated: dict,
+        options: args.occupy_options
+):
+    """
+    The tiles of the scale estimate, to find s_max of a target mask or labels at their own tau
+
+    With --s0 there was no tile scan, so the tiles are laid out as the scan would have.
+
+    :param estimated:   output of estimate_scale, with the processed data
+    :param options:     options of the run
+    :return:            occupancy.TileScan
+    """
+    if estimated.get('tiles') is None:
+        estimated['tiles'] = occupancy.TileScan(
+            estimated['scale_data'],
+            20,
+            tile_sz=options.tile_size,
+            verbose=options.verbose
+        )
+    return estimated['tiles']
+
+
+def estimate_box(
+        data: np.ndarray,
+        voxel_size: float,
+        options: args.occupy_options,
+        solvent_def: np.ndarray = None,
+        target_mask: np.ndarray = None,
+        axis_order: np.ndarray = None,
+        offset: np.ndarray = None,
+        sink: FileSink = None,
+        roi: map_tools.Roi = None,
+        target_labels: np.ndarray = None
+):
+    """
+    Estimate the local scale and confidence of a whole map, and modify it, without any file input or output
+
+    This is estimate_arrays without a region of interest. When the data is a region cut out of a larger map,
+    roi is used for the log and to place the symmetry center (with --sym), and offset should include the start of
+    the region.
+
+    Settings that are not given in options (e.g. lowpass_input, kernel_size, kernel_radius, tau, lp_scale) are
+    calculated on a copy of the options, so that the same options can be used for many maps. The copy with all
+    settings calculated is returned as OccupyResult.options.
+
+    The input arrays are never modified, and may be read-only (e.g. memory-mapped). They are only copied where a
+    different precision is requested.
+
+    With options.memory_limit, maps larger than options.max_box are processed at full sampling rather than
+    downscaled. All full-size arrays, including those returned, are then memory-mapped to temporary files, and
+    processed in slabs that fit the limit (see bricks.Workspace).
+
+    :param data:            input map, cubic and even-sized
+    :param voxel_size:      voxel size of the input map [Å]
+    :param options:         options of the run
+    :param solvent_def:     solvent definition map, same size as the input        (optional)
+    :param target_mask:     mask of a region to estimate the occupancy of           (optional)
+    :param axis_order:      mapc, mapr, maps of the input, used for tile coordinates (optional)
+    :param offset:          nxstart, nystart, nzstart of the input                   (optional)
+    :param sink:            writes output maps as they are produced, e.g. FileSink  (optional)
+    :param roi:             region of the full map that the data was cut from       (optional)
+    :param target_labels:   integer labels of regions to estimate the occupancy of  (optional)
+    :return:                OccupyResult
+    """
+
+    result = OccupyResult()
 
-    output_prefix=''
-    if options.keep_output_path:
-        output_prefix = f'{Path(options.input_map).parent}/'
+    # Settings derived from this map (e.g. the kernel from its voxel size) must not carry over to the next one
+    options = copy.copy(options)
+    result.options = options
 
+    if axis_order is None:
+        axis_order = np.array([1, 2, 3])
+    if offset is None:
+        offset = np.zeros(3)
 
-    do_amplify = options.amplify > 1
-    do_attenuate = options.attenuate > 1
-    do_sigmoid = options.sigmoid > 1
+    # Each of amplify, attenuate and sigmoid may be a sweep of several values, which all share the estimation
+    sweep = args.modification_sweep(options)
+    do_amplify = len(sweep['ampl']) > 0
+    do_attenuate = len(sweep['attn']) > 0
+    do_sigmoid = len(sweep['sigm']) > 0
     do_exclude_solvent = options.exclude_solvent
     do_modify = do_amplify or do_attenuate or do_sigmoid
 
-    # Save amplified and/or solvent-suppressed output.'
-    base_out_name = f'{new_name}'
+    doc = ''
     if do_exclude_solvent:
-        base_out_name = f'solExcl_{new_name}'
         doc = f'solvent exclusion, {doc}'
 
-    if do_sigmoid and options.pivot is None:
+    if do_sigmoid and any(pivot is None for _, pivot in sweep['sigm']):
         raise ValueError("You have to provide --pivot to do sigmoid modification using --sigmoid ")
 
-
     if do_amplify or do_attenuate or do_sigmoid:
         # If modifying, then occupancy is probably desired, in which case it makes sense to use low-passed
         # input for scale estimation. But if --raw-scale (which sets lp_scale to false) is set, we don't override it
@@ -70,16 +493,28 @@ def occupy_run(options: args.occupy_options):
 
     assert options.lp_scale is not None  # Temp check
 
-    # --------------- READ INPUT ---------------------------------------------------------------
+    dtype = None
+    if options.precision is not None:
+        if options.precision == 'single':
+            dtype = np.float32
+        elif options.precision == 'double':
+            dtype = np.float64
+        else:
+            raise ValueError(f'** fail ** --precision must be single or double, not {options.precision}')
+
+    # Full-size arrays are memory-mapped and processed in slabs, if limiting the working memory
+    workspace = bricks.Workspace(options.memory_limit)
+    if workspace.out_of_core and options.hist_match:
+        raise ValueError('** fail ** --hist-match needs all of the output in memory, and cannot be used with --memory-limit')
+
+    # --------------- CHECK INPUT --------------------------------------------------------------
 
-    f_open = mf.open(options.input_map)
-    in_data = np.copy(f_open.data)
+    in_data = data
+    if dtype is not None:
+        in_data = in_data.astype(dtype, copy=False)
     nd = np.shape(in_data)
-    voxel_size_ori = voxel_size = np.copy(f_open.voxel_size.x)
-    range_ori = np.array([np.min(f_open.data),np.max(f_open.data)]) # header info is unreliable from e.g. relion_postprocess_localfiltered
-    axis_order = np.array([f_open.header['mapc'], f_open.header['mapr'], f_open.header['maps']])
-    offset_ori = np.array([f_open.header['nxstart'], f_open.header['nystart'], f_open.header['nzstart']])
-    f_open.close()
+    voxel_size_ori = voxel_size = np.copy(voxel_size)
+    range_ori = map_tools.value_range(data)  # header info is unreliable from e.g. relion_postprocess_localfiltered
 
     if not len(np.unique(in_data.shape)) == 1:
         raise ValueError(f'** fail ** input map is not cubic (pixel-extents: {nd})')
@@ -92,7 +527,8 @@ def occupy_run(options: args.occupy_options):
         print(f'Estimating local scale of {options.input_map}...')
     # --------------- LIMIT PROCESSING SIZE ----------------------------------------------------
 
-    downscale_processing = nd[0] > options.max_box
+    # Out-of-core processing keeps the full sampling
+    downscale_processing = nd[0] > options.max_box and not workspace.out_of_core
     factor = 1
     if downscale_processing:
         factor = options.max_box / nd[0]
@@ -102,18 +538,15 @@ def occupy_run(options: args.occupy_options):
             output_size=options.max_box,
             voxel_size=voxel_size_ori,
             square=True,
-            resample=True
+            resample=True,
+            workers=options.threads
         )
 
-        if options.save_all_maps:
+        if options.save_all_maps and sink is not None:
             # Save downscaled processing map
-            map_tools.new_mrc(
-                in_data.astype(np.float32),
-                "downscaled.mrc",
-                parent=options.input_map,
-                verbose=options.verbose,
-            )
+            sink.write('downscaled', in_data)
     nd_processing = np.shape(in_data)[0]
+    result.voxel_size = voxel_size
 
     # The radius of flattened solvent masking
     radius = int(nd_processing // 2)
@@ -129,7 +562,7 @@ def occupy_run(options: args.occupy_options):
             lower_limit_default = 3 * voxel_size  # 3 pixels
             options.lowpass_input = np.max([lower_limit_default, 8.0])  # 8 Å default unless large pixel size
         else:
-            lowpass_input = options.resolution  # Å
+            options.lowpass_input = options.resolution  # Å
     elif options.resolution is not None:
         if options.resolution < options.lowpass_input and options.resolution > 0 :
             print(
@@ -179,12 +612,13 @@ def occupy_run(options: args.occupy_options):
             print(
                 f'Using provided tau value of {options.tau:.4f} (recommend {tau_ana:.4f})')
 
-    log_name = f'log_{Path(options.input_map).stem}.txt'
-    f_log = open(log_name, 'w+')
+    f_log = io.StringIO()
     print(f'\n---------------I/O AND CALCULATED SETTINGS-------', file=f_log)
     print(f'Input    :\t     \t {options.input_map}', file=f_log)
     print(f'Pix      :\t[A]  \t {voxel_size_ori:.2f}', file=f_log)
     print(f'Box in   :\t[pix]\t {nd}', file=f_log)
+    if roi is not None:
+        print(f'ROI      :\t[pix]\t {roi.size} at {tuple(int(i) for i in roi.start)} of {roi.n}', file=f_log)
     print(f'Box proc :\t[pix]\t {np.shape(in_data)}', file=f_log)
     if downscale_processing:
         print(f'Pix proc :\t[A]  \t {voxel_size:.2f}', file=f_log)
@@ -203,120 +637,106 @@ def occupy_run(options: args.occupy_options):
     print(f'Scale lim:\t[0,1]\t {options.scale_limit:.3f}', file=f_log)
     if options.lowpass_output is not None:
         print(f'LP output:\t     \t {options.lowpass_output} (Include res-dep)', file=f_log)
-    #else:
-    #    options.lowpass_output = None
-
-    # ----- LOW-PASS SETTINGS ---------
-
-    use_lp = False
-    if options.scale_mode=='occ':
-        use_lp=True
-
-    scale_data = np.copy(in_data)
-    if options.lowpass_input > 2 * voxel_size:
-
-        lp_data, _ = map_tools.lowpass(
-            in_data,
-            options.lowpass_input,
-            voxel_size=voxel_size,
-            square=False,
-            resample=False
-        )
-        if options.save_all_maps:
-            map_tools.new_mrc(
-                lp_data,
-                f'lowpass_{new_name}',
-                parent=options.input_map,
-                verbose=options.verbose,
-                log=f_log
-            )
-        if use_lp:
-            scale_data = np.copy(lp_data)
-            if options.verbose:
-                print('Using low-passed input to estimate scale')
-        else:
-            if options.verbose:
-                print('Using raw input to estimate scale')
-
-        sol_data = np.copy(lp_data)
-        del lp_data
-
-    else:
-        sol_data = np.copy(in_data)
-
-    # We apply any estimations or solvent operation on the raw input (possibly down-sized)
-    if do_modify or do_exclude_solvent:
-        out_data = np.copy(in_data)
+    if options.precision is not None:
+        print(f'Precision:\t     \t {options.precision}', file=f_log)
+    if workspace.out_of_core:
+        print(f'Mem limit:\t[MB] \t {options.memory_limit} (out-of-core)', file=f_log)
 
     # --------------- PLOTTING STUFF------------------------------------------------------------
 
     if options.plot:
-        interactive_plot = False  # TODO sort this in flags, or omit.
-        global f, ax1, ax2
+        import matplotlib.pyplot as plt
         plt.close('all')
-        f = plt.figure()
-
-    # --------------- SOLVENT ESTIMATION -------------------------------------------------------
-
-    mask = map_tools.create_radial_mask(nd_processing, dim=3, radius=radius)
-    if options.solvent_def is not None:
-        s_open = mf.open(options.solvent_def)
-        sol_mask = np.copy(s_open.data)
-        s_open.close()
-
-        # Check same size as ori inout map (can be relaxed later)
-        if not sol_mask.shape == nd:
-            raise ValueError(
-                f'** fail ** input solvent definition map  size {sol_mask.shape} is not the same size as input map: {nd}')
-
-        if downscale_processing:
-            sol_mask, _ = map_tools.lowpass(
-                sol_mask,
-                output_size=options.max_box,
-                voxel_size=voxel_size_ori,
-                square=True,
-                resample=True
+        plt.figure()
+
+    # --------------- SOLVENT, SCALE AND CONFIDENCE ESTIMATION --------------------------------
+
+    # The estimate only depends on the input and estimation settings, so can be re-used when only modifying.
+    # Plots, intermediate maps and target masks need the full estimation, and cached estimates are loaded into memory.
+    cache_key = None
+    estimated = None
+    targeted = target_mask is not None or target_labels is not None
+    use_cache = not (options.plot or options.save_all_maps or targeted or workspace.out_of_core)
+    if options.cache_dir is not None and use_cache:
+        cache_key = cache.estimate_key(data, voxel_size_ori, options, solvent_def=solvent_def)
+        estimated = cache.load(options.cache_dir, cache_key)
+        if estimated is not None:
+            print(f'Cache    :\t     \t {cache_key[:16]} (re-used)', file=f_log)
+            if options.verbose:
+                print(f'Re-using cached scale estimate {cache_key[:16]}')
+
+    if estimated is None:
+        if solvent_def is not None:
+            if dtype is not None:
+                solvent_def = solvent_def.astype(dtype, copy=False)
+
+            # Check same size as ori inout map (can be relaxed later)
+            if not solvent_def.shape == nd:
+                raise ValueError(
+                    f'** fail ** input solvent definition map  size {solvent_def.shape} is not the same size as input map: {nd}')
+
+            if downscale_processing:
+                solvent_def, _ = map_tools.lowpass(
+                    solvent_def,
+                    output_size=options.max_box,
+                    voxel_size=voxel_size_ori,
+                    square=True,
+                    resample=True,
+                    workers=options.threads
+                )
+
+        # With symmetry, the scale is only estimated over the asymmetric unit, about the center of the full box
+        sym_source = None
+        if options.sym is not None and len(symmetry.point_group(options.sym)) > 1:
+            operators = symmetry.point_group(options.sym)
+            center = np.full(3, nd_processing / 2)
+            if roi is not None:
+                center = (roi.n / 2 - np.asarray(roi.start)) * factor
+            array_operators = symmetry.array_operators(operators, axis_order)
+            sym_source = symmetry.asymmetric_unit(
+                nd_processing,
+                array_operators,
+                center=center,
+                out=workspace.empty((nd_processing ** 3,), dtype=np.intp)
             )
-
-        assert sol_mask.shape == sol_data.shape
-
-        # Make a mask from the solvent definition.
-        # People might provide a mask that covers the solvent or content, we will use it as makes most sense
-        solvent_region = solvent.smallest_variance_region(
-            sol_data,  # data
-            sol_mask,  # solvent def
-            mask  # radial mask
+            print(f'Symmetry :\t     \t {options.sym} ({len(operators)} operators)', file=f_log)
+            if not symmetry.on_grid(array_operators, center):
+                sym_warn = f'** warn ** The {options.sym} symmetry operators do not map the voxel grid onto itself. \n** warn ** The scale is copied from the nearest symmetry-equivalent voxel, and is approximate\n'
+                print(sym_warn, file=f_log)
+                if not options.quiet:
+                    print(sym_warn)
+
+        estimated = estimate_scale(
+            in_data,
+            voxel_size,
+            scale_kernel,
+            options,
+            solvent_def=solvent_def,
+            sink=sink,
+            log=f_log,
+            workspace=workspace,
+            sym_source=sym_source
         )
 
-        h_data = sol_data[solvent_region].flatten()
-    else:
-        assert sol_data.shape == mask.shape
-        h_data = sol_data[mask].flatten()
-
-    # Estimate the solvent model
-    levels = 1000
-    sol_limits, solvent_parameters = solvent.fit_solvent_to_histogram(
-        h_data,
-        plot=options.plot,
-        n_lev=levels
-    )
-
-    # --------------- SCALE ESTIMATION ------------------------------------------------------
-
-    scale_map = f'{output_prefix}scale_{options.scale_mode}_{new_name}'
-    if options.s0:
-        scale_map = f'scale_naive_{options.scale_mode}_{new_name}'
-    scale, max_val, tiles_raw = occupancy.get_map_scale(
-        scale_data,
-        scale_kernel=scale_kernel,
-        tau=options.tau,
-        save_occ_map=scale_map,
-        s0=options.s0,
-        tile_size=options.tile_size,
-        scale_mode=options.scale_mode,
-        verbose=options.verbose
-    )
-    map_tools.adjust_to_parent(file_name=scale_map, parent=options.input_map)
+        if cache_key is not None:
+            cache.store(options.cache_dir, cache_key, estimated, max_size=options.cache_size)
+            print(f'Cache    :\t     \t {cache_key[:16]} (stored)', file=f_log)
+
+    scale = estimated['scale']
+    max_val = estimated['max_val']
+    tiles_raw = estimated['tiles_raw']
+    variability_limit = estimated['variability_limit']
+    confidence = estimated['confidence']
+    mapping = estimated['mapping']
+    sol_limits = estimated['sol_limits']
+    solvent_parameters = estimated['solvent_parameters']
+    a, b = estimated['histogram']
+    levels = len(a)
+
+    result.solvent_limits = sol_limits
+    result.solvent_parameters = solvent_parameters
+    result.histogram = (a, b)
+    result.confidence_mapping = mapping
 
     tiles = None
     if tiles_raw is not None:
@@ -328,36 +748,15 @@ def occupy_run(options: args.occupy_options):
             tiles[:, 2 - i] = tiles_raw[:, axis_order[i] - 1]
 
         # Add any offset in the input file coords (but not radius),  and make in original non-pix length.
-        tiles[:-1, :] = voxel_size_ori * (tiles[:-1, :] / factor + offset_ori)
+        tiles[:-1, :] = voxel_size_ori * (tiles[:-1, :] / factor + offset)
 
         # Set radius to original non-pix length as well
         tiles[-1, :] = voxel_size_ori * tiles[-1, :] / factor
 
         if options.verbose:
             print(f'Corrected tile max: {tiles[0, :]}')
-
-    # Get the average pixel value across all regions with full scale
-    # This is an estimate of the density, which we can convert back to a scale,
-    # which in turn signifies the expected scale at full occupancy AND full variability/flex
-    # The varaibility limit is thus the expected scale if some thing at full occupancy is completely
-    # incoherent due to e.g. flexibility
-    variability_limit = np.mean(scale_data[scale == 1]) / max_val
-
-    # --------------- CONFIDENCE ESTIMATION ------------------------------------------------------
-
-    confidence, mapping = occupancy.estimate_confidence(
-        sol_data,
-        solvent_parameters,
-        hedge_confidence=options.hedge_confidence,
-        n_lev=levels
-    )
-
-    # clean sol_data asap
-    #if options.plot:
-    a, b = np.histogram(sol_data, bins=levels, density=True)
-    del sol_data
-
-    warnings = None
+    result.tiles = tiles
+    result.tile_index = estimated['tile_index']
 
     # Find the lowest primary scale value that we can be confident about given the noise variance estimate.
     # This will be used to enforce a correction to the estimated scale.
@@ -372,42 +771,36 @@ def occupy_run(options: args.occupy_options):
         else:
             warnings = f'{warnings} check the solvent model'
         solvent.warn_bad(confidence_limit_index / levels, file=f_log, verbose=options.verbose, kernel_warn=kernel_warn, quiet=options.quiet)
+        result.warnings = warnings
 
     # Correct for noise distribution width.
     # This effectively resamples the estimation from [confidence_limit,1] to [0,1]
+    # In place, since the scale may be memory-mapped
     if options.nlrc:
-        scale = (scale - confidece_limit) / (1 - confidece_limit)
-        scale = np.clip(scale,0,1)
-        if scale_map is not None:
-            map_tools.new_mrc(
-                scale,
-                scale_map,
-                vox_sz=1.0,
-                verbose=options.verbose,
-                extra_header=f'occupy scale: {options.scale_mode}'
-            )
-        map_tools.adjust_to_parent(file_name=scale_map, parent=options.input_map)
+        scale -= confidece_limit
+        scale /= 1 - confidece_limit
+        np.clip(scale, 0, 1, out=scale)
+
+    if sink is not None:
+        scale_mode = options.scale_mode
+        if options.s0:
+            scale_mode = f'naive_{scale_mode}'
+        sink.write('scale', scale, extra_header=f'occupy scale: {scale_mode}')
 
     # Specific occupancy estimation using pixel map
-    if options.target_mask!=None:
-        mask_spec_open = mf.open(options.target_mask)
-        mask_spec_data = np.copy(mask_spec_open.data)
+    if target_mask is not None:
 
         # TODO check size etc
-        n_spec = np.shape(mask_spec_data)
+        n_spec = np.shape(target_mask)
 
         # A custom pixel-wise mask must consider statistics, and a specific tau
-        sel_pix = scale_data[mask_spec_data>0.5]
+        scale_data = estimated['scale_data']
+        sel_pix = scale_data[target_mask>0.5]
         n_spec_sel = len(sel_pix)
         tau_spec = occupancy.set_tau(n_v=n_spec_sel)
 
-        # Dummy scale estimate to get the max val at this tau
-        scale_dummy, max_val_spec, raw_tiles_dummy = occupancy.get_map_scale(
-            scale_data,
-            scale_kernel=scale_kernel,
-            tau=tau_spec,
-            verbose=options.verbose
-        )
+        # Only the max val at this tau is needed, not the scale itself, from the tiles of the scale estimate
+        max_val_spec, _ = target_tiles(estimated, options).s_max(tau_spec, threads=options.threads)
 
         # Calculate the occupancy given the established max_val_spec given the tau_spec
         spec_occ = np.max(sel_pix) / max_val_spec
@@ -417,317 +810,593 @@ def occupy_run(options: args.occupy_options):
             spec_occ = (spec_occ - confidece_limit) / (1 - confidece_limit)
             spec_occ = np.clip(spec_occ, 0, 1)
 
-        print(f'Targeted occupancy estimated to {spec_occ:.3f} using tau={tau_spec} from n_spec={n_spec_sel} pixels in the target mask')
+        print(f'Targeted occupancy estimated to {spec_occ:.3f} using tau={tau_spec:.4f} from n_spec={n_spec_sel} pixels in the target mask')
+        result.target_occupancy = spec_occ
+        del scale_data
 
-    del scale_data
+    # Occupancy of each labelled region, as for a target mask, with s_max found for all labels in one tile scan
+    if target_labels is not None:
+        if np.shape(target_labels) != nd:
+            raise ValueError(
+                f'** fail ** --target-labels size {np.shape(target_labels)} is not the same size as input map: {nd}')
+
+        scale_data = estimated['scale_data']
+        labels = target_labels
+        if downscale_processing:
+            # Labels can not be interpolated, so take the nearest voxel of each processed one
+            idx = ((np.arange(nd_processing) + 0.5) / factor).astype(int)
+            labels = labels[np.ix_(idx, idx, idx)]
 
+        tiles_spec = target_tiles(estimated, options)
+        label_occ = occupancy.label_occupancies(scale_data, labels, tiles_spec, threads=options.threads)
 
+        if options.nlrc:
+            # Correct for noise distribution width.
+            label_occ['occupancy'] = np.clip(
+                (label_occ['occupancy'] - confidece_limit) / (1 - confidece_limit), 0, 1)
 
+        print(f'Targeted occupancy estimated for {len(label_occ["label"])} labels of the target labels', file=f_log)
+        for label, n_v, tau, occ in zip(label_occ['label'], label_occ['n_voxels'], label_occ['tau'], label_occ['occupancy']):
+            print(f'  Label {label:<6d}\t: \t {occ:.3f} using tau={tau:.4f} from {n_v} pixels', file=f_log)
+        result.label_occupancies = label_occ
+        del scale_data, labels
 
-    fake_solvent = None  # Will not  add fake solvent during amplify
+    del estimated
 
-    ampl_name = None
-    attn_name = None
-    sigm_name = None
+    # Outputs are resampled back to the input size if processing was downscaled
+    output_size = None
+    if downscale_processing:
+        output_size = nd[0]
 
     if options.omit_confidence:
-        confidence = np.ones_like(confidence)
+        confidence = workspace.empty(np.shape(confidence), dtype=confidence.dtype)
+        confidence.fill(1)
+
+    save_modified_map = options.save_all_maps and sink is not None
+
+    # All requested modifications are made in one pass, and then low-passed and resampled together.
+    # When sweeping several values of a modification, each output is keyed by its label instead (e.g. ampl_4)
+    modifications = {}
+    headers = {}
+    for gamma in sweep['ampl']:
+        key = 'ampl' if len(sweep['ampl']) == 1 else args.modification_label('ampl', gamma, sweep=True)
+        # Will not add fake solvent during amplify
+        modifications[key] = {'amplify_gamma': gamma}
+        headers[key] = f'ampl {gamma:.1f}, {doc}'
+
+    def draw_fake_solvent():
+        shape = (nd_processing,) * 3
+        return solvent.random_solvent(
+            nd_processing,
+            solvent_parameters,
+            dtype=dtype,
+            out=workspace.empty(shape, dtype=np.float64 if dtype is None else dtype),
+            chunk_elements=workspace.chunk_elements(shape, bytes_per_voxel=16)
+        )
+
+    # Swept variants share the same fake solvent, so that they differ only by the modification
+    fake_solvent = None
+    if do_attenuate and not options.exclude_solvent:
+        # If we are not excluding solvent, then we will add some back when we attenuate
+        fake_solvent = draw_fake_solvent()
+        # TODO:
+        # what is the correct scaling factor of the variance here????
+        # also spectral properties
+
+    for gamma in sweep['attn']:
+        key = 'attn' if len(sweep['attn']) == 1 else args.modification_label('attn', gamma, sweep=True)
+        modifications[key] = {'attenuate_gamma': gamma, 'fake_solvent': fake_solvent}
+        headers[key] = f'attn {gamma:.1f}, {doc}'
+
+    fake_solvent = None
+    if do_sigmoid and not options.exclude_solvent:
+        # If we are not excluding solvent, then we will add some back when we attenuate
+        fake_solvent = draw_fake_solvent()
+        # TODO: sigmoid noise comp
 
-    if do_amplify:
-        ampl = occupancy.modify(
-            out_data,  # Amplify raw input data (no low-pass apart from down-scaling, if that)
-            scale,  # The estimated scale to use for amplification
-            amplify_gamma=options.amplify,  # The exponent for amplification / attenuation
+    for gamma, pivot in sweep['sigm']:
+        key = 'sigm' if len(sweep['sigm']) == 1 else args.modification_label('sigm', (gamma, pivot), sweep=True)
+        modifications[key] = {'sigmoid_gamma': gamma, 'sigmoid_pivot': pivot, 'fake_solvent': fake_solvent}
+        headers[key] = f'sigm {gamma:.1f} {pivot:.2f}, {doc}'
+
+    if do_modify:
+        modified = occupancy.modify_many(
+            in_data,  # Modify raw input data (no low-pass apart from down-scaling, if that)
+            scale,  # The estimated scale to use for modification
+            modifications,
             scale_threshold=options.scale_limit,
-            save_modified_map=options.save_all_maps,
-            verbose=options.verbose
+            save_modified_map=save_modified_map,
+            confidence=confidence,  # Supress modification of solvent
+            unmodified=in_data,  # Add back solvent from raw input (full res)
+            exclude_solvent=options.exclude_solvent,  # Only add back if not excluding solvent
+            verbose=options.verbose,
+            parent=sink.parent if save_modified_map else None,
+            chunk_elements=workspace.chunk_elements(np.shape(in_data), bytes_per_voxel=16 * (len(modifications) + 4)),
+            empty=workspace.empty
         )
+        del modifications, fake_solvent
 
-        if options.save_all_maps:
-            map_tools.adjust_to_parent(file_name='modification_ampl.mrc', parent=options.input_map)
+        modified = finalize_modification(
+            modified,
+            options,
+            voxel_size,
+            output_size=output_size,
+            reference=data,
+            value_range=range_ori,
+            workspace=workspace
+        )
+
+        # Save amplified, attenuated and/or sigmoid-modified output.
+        for key, header in headers.items():
+            result.modified[key] = modified.pop(key)
+            if sink is not None:
+                sink.write(key, result.modified[key], extra_header=header)
+        del modified
 
+    if not do_modify and do_exclude_solvent:
         # -- Supress solvent amplification --
         # Confidence-based mask of amplified content.
         # Solvent is added back unless excluded
-        ampl = solvent.suppress(
-            ampl,  # Supress the amplified output data
-            in_data,  # Add back solvent from raw input (full res)
-            confidence,  # The confidence mask to supress amplification
-            do_exclude_solvent,  # Only add back if not excluding solvent
-            verbose=options.verbose
-        )
+        if workspace.out_of_core:
+            if options.verbose:
+                print('Using confidence based on solvent model to suppress modified solvent.')
+            solExcl_only = workspace.empty(np.shape(in_data), dtype=np.result_type(in_data, confidence))
+            for sl in workspace.slabs(np.shape(in_data), bytes_per_voxel=32):
+                solExcl_only[sl] = solvent.suppress(in_data[sl], in_data[sl], confidence[sl], do_exclude_solvent)
+        else:
+            solExcl_only = solvent.suppress(
+                in_data,  # Supress the amplified output data
+                in_data,  # Add back solvent from raw input (full res)
+                confidence,  # The confidence mask to supress amplification
+                do_exclude_solvent,  # Only add back if not excluding solvent
+                verbose=options.verbose
+            )
 
         # -- Low-pass filter output --
-        if options.lowpass_output is not None:
-            ampl, _ = map_tools.lowpass(
-                ampl,
-                resolution=options.lowpass_output,
-                voxel_size=voxel_size
-            )
+        solExcl_only = workspace.lowpass_map(
+            solExcl_only,
+            options.lowpass_output,
+            voxel_size,
+            keep_scale=True,
+            workers=options.threads
+        )
 
         # If the input map was larger than the maximum processing size, we need to get back the bigger size as output
         if downscale_processing:
-            ampl, _ = map_tools.lowpass(
-                ampl,
-                output_size=nd[0],
+            solExcl_only, _ = map_tools.lowpass(
+                solExcl_only,
+                output_size=output_size,
                 square=True,
-                resample=True
+                resample=True,
+                workers=options.threads
             )
 
-        # -- Match output range --
-        # inverse filtering can create a few spurious pixels that
-        # ruin the dynamic range compared to the input. This is mostly
-        # aesthetic.
-        # TODO Compare power spectrum of input out put to examine spectral effect
-        # TODO also check the average change in pixel value, anf how it relates to power spectral change
-        if options.hist_match:
-            f_open = mf.open(options.input_map)
-            ampl = match_histograms(
-                ampl,
-                reference=f_open.data
-            )  # Output is no longer input + stuff, i.e. good part is now something else.
-            f_open.close()
-        else:
-            ampl = map_tools.clip_to_range(
-                ampl,
-                range=range_ori
-            )
+        # Save solvent-suppressed output.
+        result.modified['solExcl'] = solExcl_only
+        if sink is not None:
+            sink.write('solExcl', solExcl_only, extra_header=f'{doc}')
 
-        # TODO  -  Test histogram-matching of low-occupancy regions with high-occupancy as reference?
+        del solExcl_only
 
-        ampl_name = f'{output_prefix}ampl_{options.amplify:.1f}_{base_out_name}'
-        ampl_doc = f'ampl {options.amplify:.1f}, {doc}'
+    #if options.save_all_maps:
+    if sink is not None:
+        sink.write('conf', confidence, log=f_log)
 
-        map_tools.new_mrc(
-            ampl.astype(np.float32),
-            ampl_name,
-            parent=options.input_map,
-            verbose=options.verbose,
-            extra_header=ampl_doc
-        )
+    print(f'\n------------------------------------Detected limits-------', file=f_log)
+    print(f'Content at 1% of solvent  \t: \t {sol_limits[2]:.3f}', file=f_log)
+    print(f'Solvent drop to 0% (edge) \t: \t {sol_limits[3]:.3f}', file=f_log)
+    print(f'Solvent peak        \t    \t: \t {solvent_parameters[1]:.3f}', file=f_log)
+    print(f'Full scale          \t    \t: \t {max_val:.3f}', file=f_log)
+    print(f'Variability_limit   \t    \t: \t {variability_limit:.3f}', file=f_log)
+    print(f'Primary conf. limit \t    \t: \t {confidece_limit:.3f}', file=f_log)
 
-        del ampl
-
-    if do_attenuate:
-        if not options.exclude_solvent:
-            # If we are not excluding solvent, then we will add some back when we attenuate
-            fake_solvent = np.random.randn(nd_processing, nd_processing, nd_processing)
-            fake_solvent = solvent_parameters[1] + solvent_parameters[2] * fake_solvent
-            # TODO:
-            # what is the correct scaling factor of the variance here????
-            # also spectral properties
-
-        attn = occupancy.modify(
-            out_data,  # Amplify raw input data (no low-pass apart from down-scaling, if that)
-            scale,  # The estimated scale to use for amplification
-            attenuate_gamma=options.attenuate,  # The exponent for amplification / attenuation
-            fake_solvent=fake_solvent,
-            scale_threshold=options.scale_limit,
-            save_modified_map=options.save_all_maps,
-            verbose=options.verbose
-        )
+    result.scale = scale
+    result.confidence = confidence
+    result.max_val = max_val
+    result.variability_limit = variability_limit
+    result.confidence_limit = confidece_limit
+    result.log = f_log.getvalue()
 
-        # -- Supress solvent amplification --
-        # Confidence-based mask of amplified content.
-        # Solvent is added back unless excluded
-        attn = solvent.suppress(
-            attn,  # Supress the amplified output data
-            in_data,  # Add back solvent from raw input (full res)
-            confidence,  # The confidence mask to supress amplification
-            do_exclude_solvent,  # Only add back if not excluding solvent
-            verbose=options.verbose
-        )
+    return result
 
-        # -- Low-pass filter output --
-        if options.lowpass_output is not None:
-            attn, _ = map_tools.lowpass(
-                attn,
-                options.lowpass_output,
-                voxel_size
-            )
 
-        # If the input map was larger than the maximum processing size, we need to get back the bigger size as output
-        if downscale_processing:
-            attn, _ = map_tools.lowpass(
-                attn,
-                output_size=nd[0],
-                square=True,
-                resample=True
-            )
+class RoiSink:
+    """
+    Writes the maps of a region of interest through the sink of the full map, pasted back into the full box
 
-        # -- Match output range --
-        # inverse filtering can create a few spurious pixels that
-        # ruin the dynamic range compared to the input. This is mostly
-        # aesthetic.
-        # TODO Compare power spectrum of input out put to examine spectral effect
-        # TODO also check the average change in pixel value, anf how it relates to power spectral change
-        if options.hist_match:
-            f_open = mf.open(input_map)
-            attn = match_histograms(
-                attn,
-                reference=f_open.data
-            )  # Output is no longer input + stuff, i.e. good part is now something else.
-            f_open.close()
-        else:
-            attn = map_tools.clip_to_range(
-                attn,
-                range=range_ori
-            )
-        # TODO  -  Test histogram-matching of low-occupancy regions with high-occupancy as reference?
+    Scale, confidence and modified maps at the size of the region are pasted into the full box. Other maps, and any
+    at a down-scaled processing size, are written for the region only, with a header that places them in the box.
+
+    :param sink:    sink of the full map, e.g. FileSink
+    :param roi:     map_tools.Roi
+    :param fill:    value, or full map, to fill in outside the region of modified maps
+    :param empty:   allocates the full maps, as np.empty
+    """
+
+    def __init__(
+            self,
+            sink: FileSink,
+            roi: map_tools.Roi,
+            fill=0,
+            empty=np.empty
+    ):
+        self.sink = sink
+        self.roi = roi
+        self.fill = fill
+        self.empty = empty
+        self.parent = sink.parent.crop(roi.start, roi.size)
+        self.written = sink.written
+
+    def write(
+            self,
+            key: str,
+            data: np.ndarray,
+            extra_header: str = None,
+            log=None
+    ):
+        kind = key.split('_')[0]
+        if np.shape(data) != (self.roi.size,) * 3 or kind not in ['scale', 'conf', 'ampl', 'attn', 'sigm', 'solExcl']:
+            return self.sink.write(key, data, extra_header=extra_header, log=log, parent=self.parent)
+
+        fill = 0 if kind in ['scale', 'conf'] else self.fill
+        data = self.roi.paste(data, fill=fill, empty=self.empty)
+        return self.sink.write(key, data, extra_header=extra_header, log=log)
+
+
+def region_of_interest(
+        data: np.ndarray,
+        voxel_size: float,
+        options: args.occupy_options,
+        roi_mask: np.ndarray = None,
+        solvent_def: np.ndarray = None,
+        target_mask: np.ndarray = None
+):
+    """
+    The region of interest to restrict the estimation and modification to, if any
+
+    With a roi_mask, this is the padded bounding box of the mask. With options.auto_roi, it is that of the content
+    defined by the solvent definition, else the target mask, else a threshold of the low-passed input well above
+    the solvent noise.
+
+    :param data:            input map
+    :param voxel_size:      voxel size of the input map [Å]
+    :param options:         options of the run
+    :param roi_mask:        mask defining the region of interest, same size as the input   (optional)
+    :param solvent_def:     solvent definition map, same size as the input                  (optional)
+    :param target_mask:     mask of a region to estimate the occupancy of                   (optional)
+    :return:                map_tools.Roi, or None to process the whole box
+    """
+    if roi_mask is None and not options.auto_roi:
+        return None
 
-        # Save amplified and/or solvent-suppressed output.
-        attn_name = f'{output_prefix}attn_{options.attenuate:.1f}_{base_out_name}'
-        attn_doc = f'attn {options.attenuate:.1f}, {doc}'
+    n = np.shape(data)[0]
+    pad = int(np.ceil(options.roi_pad / voxel_size))
+    workspace = bricks.Workspace(options.memory_limit)
+    chunk_elements = workspace.chunk_elements(np.shape(data), bytes_per_voxel=16)
 
-        map_tools.new_mrc(
-            attn.astype(np.float32),
-            attn_name,
-            parent=options.input_map,
-            verbose=options.verbose,
-            extra_header=attn_doc
+    threshold = 0.5
+    if roi_mask is not None:
+        if np.shape(roi_mask) != np.shape(data):
+            raise ValueError(
+                f'** fail ** --roi-mask size {np.shape(roi_mask)} is not the same size as input map: {np.shape(data)}')
+        content = roi_mask
+    elif solvent_def is not None:
+        # The solvent definition may cover the solvent or the content, as in estimate_scale
+        consider = workspace.radial_mask(n, radius=n // 2)
+        if workspace.out_of_core:
+            solvent_region = bricks.smallest_variance_region(data, solvent_def, consider, workspace)
+        else:
+            solvent_region = solvent.smallest_variance_region(data, solvent_def, consider)
+        content = workspace.empty(np.shape(data), dtype=bool)
+        for sl in workspace.slabs(np.shape(data), bytes_per_voxel=16):
+            content[sl] = consider[sl] & ~solvent_region[sl]
+    elif target_mask is not None:
+        if np.shape(target_mask) != np.shape(data):
+            raise ValueError('** fail ** --auto-roi from a --target-mask needs it to be the size of the input map')
+        content = target_mask
+    else:
+        # Most of the map is solvent, so the median and its absolute deviation are those of the solvent noise
+        content, _ = workspace.lowpass(
+            data,
+            np.max([8.0, 3 * voxel_size]),
+            voxel_size=voxel_size,
+            workers=options.threads
+        )
+        median = np.median(content)
+        threshold = median + 6 * 1.4826 * np.median(np.abs(content - median))
+
+    # The tile scan of the scale estimation needs at least 31 voxels along each axis
+    return map_tools.roi_from_mask(content, pad=pad, threshold=threshold, min_size=32, chunk_elements=chunk_elements)
+
+
+def estimate_arrays(
+        data: np.ndarray,
+        voxel_size: float,
+        options: args.occupy_options,
+        solvent_def: np.ndarray = None,
+        target_mask: np.ndarray = None,
+        axis_order: np.ndarray = None,
+        offset: np.ndarray = None,
+        sink: FileSink = None,
+        roi_mask: np.ndarray = None,
+        target_labels: np.ndarray = None
+):
+    """
+    Estimate the local scale and confidence of a map, and modify it, without any file input or output
+
+    Settings that are not given in options (e.g. lowpass_input, kernel_size, kernel_radius, tau, lp_scale) are
+    calculated on a copy of the options, so that the same options can be used for many maps. The copy with all
+    settings calculated is returned as OccupyResult.options.
+
+    With a region of interest (roi_mask or options.auto_roi, see region_of_interest), only that cube is cut out of
+    the input, estimated and modified. The results are pasted back into the full box, with zero scale and
+    confidence outside the region, and the unmodified input there (or zero, if excluding solvent).
+
+    :param data:            input map, cubic and even-sized
+    :param voxel_size:      voxel size of the input map [Å]
+    :param options:         options of the run
+    :param solvent_def:     solvent definition map, same size as the input        (optional)
+    :param target_mask:     mask of a region to estimate the occupancy of           (optional)
+    :param axis_order:      mapc, mapr, maps of the input, used for tile coordinates (optional)
+    :param offset:          nxstart, nystart, nzstart of the input                   (optional)
+    :param sink:            writes output maps as they are produced, e.g. FileSink  (optional)
+    :param roi_mask:        mask defining a region of interest, same size as input  (optional)
+    :param target_labels:   integer labels of regions to estimate the occupancy of, same size as input (optional)
+    :return:                OccupyResult
+    """
+    roi = region_of_interest(
+        data,
+        voxel_size,
+        options,
+        roi_mask=roi_mask,
+        solvent_def=solvent_def,
+        target_mask=target_mask
+    )
+    if roi is None or roi.size == roi.n:
+        return estimate_box(
+            data,
+            voxel_size,
+            options,
+            solvent_def=solvent_def,
+            target_mask=target_mask,
+            axis_order=axis_order,
+            offset=offset,
+            sink=sink,
+            target_labels=target_labels
         )
 
-        del attn
+    if target_mask is not None and np.shape(target_mask) != np.shape(data):
+        raise ValueError('** fail ** --target-mask must be the size of the input map to use a region of interest')
+    if target_labels is not None and np.shape(target_labels) != np.shape(data):
+        raise ValueError('** fail ** --target-labels must be the size of the input map to use a region of interest')
+
+    if axis_order is None:
+        axis_order = np.array([1, 2, 3])
+    if offset is None:
+        offset = np.zeros(3)
+
+    # Tile coordinates are in the axes of the input file, so the start of the region is added in those
+    roi_offset = np.array(offset, dtype=float)
+    for i in np.arange(3):
+        roi_offset[2 - i] += roi.start[axis_order[i] - 1]
+
+    empty = bricks.Workspace(options.memory_limit).empty
+    fill = 0 if options.exclude_solvent else data
+    if sink is not None:
+        sink = RoiSink(sink, roi, fill=fill, empty=empty)
+
+    result = estimate_box(
+        roi.crop(data),
+        voxel_size,
+        options,
+        solvent_def=None if solvent_def is None else roi.crop(solvent_def),
+        target_mask=None if target_mask is None else roi.crop(target_mask),
+        axis_order=axis_order,
+        offset=roi_offset,
+        sink=sink,
+        roi=roi,
+        target_labels=None if target_labels is None else roi.crop(target_labels)
+    )
 
-    if do_sigmoid:
-        #if not options.exclude_solvent:
-        # TODO: sigmoid noise comp
+    # Back into the full box. Scale and confidence at a down-scaled processing size only cover the region.
+    for key in result.modified:
+        result.modified[key] = roi.paste(result.modified[key], fill=fill, empty=empty)
+    if np.shape(result.scale) == (roi.size,) * 3:
+        result.scale = roi.paste(result.scale, empty=empty)
+        result.confidence = roi.paste(result.confidence, empty=empty)
+    result.roi = roi
 
-        if not options.exclude_solvent:
-            # If we are not excluding solvent, then we will add some back when we attenuate
-            fake_solvent = np.random.randn(nd_processing, nd_processing, nd_processing)
-            fake_solvent = solvent_parameters[1] + solvent_parameters[2] * fake_solvent
-
-            # TODO:
-            # what is the correct scaling factor of the variance here????
-            # also spectral properties
-
-        sigm = occupancy.modify(
-            out_data,  # Amplify raw input data (no low-pass apart from down-scaling, if that)
-            scale,  # The estimated scale to use for amplification
-            sigmoid_gamma=options.sigmoid,  # The exponent for sigmoid
-            sigmoid_pivot=options.pivot,
-            fake_solvent=fake_solvent,
-            scale_threshold=options.scale_limit,
-            save_modified_map=options.save_all_maps,
-            verbose=options.verbose
-        )
+    return result
 
-        # -- Supress solvent amplification --
-        # Confidence-based mask of amplified content.
-        # Solvent is added back unless excluded
-        sigm = solvent.suppress(
-            sigm,  # Supress the amplified output data
-            in_data,  # Add back solvent from raw input (full res)
-            confidence,  # The confidence mask to supress amplification
-            do_exclude_solvent,  # Only add back if not excluding solvent
-            verbose=options.verbose
-        )
 
-        # -- Low-pass filter output --
-        if options.lowpass_output is not None:
-            sigm, _ = map_tools.lowpass(
-                sigm,
-                options.lowpass_output,
-                voxel_size
-            )
+def plot_confidence(
+        result: OccupyResult,
+        options: args.occupy_options
+):
+    """
+    Complete and save the solvent model plot with the estimated confidence, and plot the modification
 
-        # If the input map was larger than the maximum processing size, we need to get back the bigger size as output
-        if downscale_processing:
-            sigm, _ = map_tools.lowpass(
-                sigm,
-                output_size=nd[0],
-                square=True,
-                resample=True
-            )
+    :param result:      output of estimate_arrays, run with options.plot
+    :param options:     options of the run
+    """
+    import matplotlib.pyplot as plt
 
-        # -- Match output range --
-        # inverse filtering can create a few spurious pixels that
-        # ruin the dynamic range compared to the input. This is mostly
-        # aesthetic.
-        # TODO Compare power spectrum of input out put to examine spectral effect
-        # TODO also check the average change in pixel value, anf how it relates to power spectral change
-        if options.hist_match:
-            f_open = mf.open(options.input_map)
-            sigm = match_histograms(
-                sigm,
-                reference=f_open.data
-            )  # Output is no longer input + stuff, i.e. good part is now something else.
-            f_open.close()
-        else:
-            sigm = map_tools.clip_to_range(
-                sigm,
-                range=range_ori
-            )
-        # TODO  -  Test histogram-matching of low-occupancy regions with high-occupancy as reference?
+    interactive_plot = False  # TODO sort this in flags, or omit.
 
-        # Save amplified and/or solvent-suppressed output.
-        sigm_name = f'{output_prefix}sigm_{options.sigmoid:.1f}-{options.pivot:.2f}_{base_out_name}'
-        sigm_doc = f'sigm {options.sigmoid:.1f} {options.pivot:.2f}, {doc}'
+    sweep = args.modification_sweep(options)
+    do_amplify = len(sweep['ampl']) > 0
+    do_attenuate = len(sweep['attn']) > 0
+    do_modify = do_amplify or do_attenuate or len(sweep['sigm']) > 0
 
-        map_tools.new_mrc(
-            sigm.astype(np.float32),
-            sigm_name,
-            parent=options.input_map,
-            verbose=options.verbose,
-            extra_header=sigm_doc
-        )
+    a, b = result.histogram
+    mapping = result.confidence_mapping
 
-        del sigm
+    f = plt.gcf()
+    f.set_size_inches(12, 2.52)
+    ax1 = f.axes[0]
 
-    solExcl_only_name = None
-    if not do_modify and do_exclude_solvent:
-        # -- Supress solvent amplification --
-        # Confidence-based mask of amplified content.
-        # Solvent is added back unless excluded
-        solExcl_only = solvent.suppress(
-            out_data,  # Supress the amplified output data
-            in_data,  # Add back solvent from raw input (full res)
-            confidence,  # The confidence mask to supress amplification
-            do_exclude_solvent,  # Only add back if not excluding solvent
-            verbose=options.verbose
-        )
+    if options.solvent_def is not None:
+        ax1.plot(b[:-1], a, 'gray', label='unmasked data')
+    ax1.plot(b[:-1], np.clip(mapping, ax1.get_ylim()[0], 1.0), 'r', label='confidence')
+    if options.hedge_confidence is not None:
+        ax1.plot(b[:-1], np.clip(mapping ** options.hedge_confidence, ax1.get_ylim()[0], 1.0), ':r',
+                              label='hedged confidence')
+
+    # It would be nice to plot this, but this is on the lp (sol_data) hist
+    # plt.plot([max_val,max_val],ax1.get_ylim(),'k-',label='full scale')
+
+    ax1.legend(bbox_to_anchor=(1, 1), loc="upper left",prop={'size': 11})
+    plt.subplots_adjust(
+        top=0.94,
+        bottom=0.154,
+        left=0.062,
+        right=0.688)
+    #f.tight_layout(rect=[0, 0, 1.05, 1.05])
+
+    save_name = options.input_map
+    has_solvent_def = None
+    if options.solvent_def is not None:
+        has_solvent_def = Path(options.solvent_def).stem
 
-        # -- Low-pass filter output --
-        solExcl_only = map_tools.lowpass_map(
-            solExcl_only,
-            options.lowpass_output,
-            voxel_size,
-            keep_scale=True
-        )
+    vis.save_fig(
+        save_name,
+        extra_specifier=has_solvent_def
+    )
 
-        # If the input map was larger than the maximum processing size, we need to get back the bigger size as output
-        if downscale_processing:
-            solExcl_only, _ = map_tools.lowpass(
-                solExcl_only,
-                output_size=nd[0],
-                square=True,
-                resample=True
-            )
+    if interactive_plot:
+        plt.show()
+
+    n_lines = 5
+    n_elements = 1000
+    col = plt.cm.binary(np.linspace(0.3, 0.7, n_lines + 1))
+
+    if options.pivot is not None:
+        f2 = plt.figure()
+        x = np.linspace(0, 1, n_elements)
+        plt.plot(x, x, color=col[0], label=f'gamma=1')
+        vals = 1 + np.sqrt(options.pivot) * 2 ** np.arange(n_lines)  # just values that shows some range depending on mu.
+        _, ys = occupancy.scale_mapping_sigmoids(np.full(n_lines, options.pivot), vals, n_elements)
+        for i, (val, y) in enumerate(zip(vals, ys)):
+            plt.plot(x, y, color=col[i + 1], label=f'gamma={val:.2f}')
+        # The actual values used
+        for gamma, pivot in sweep['sigm']:
+            mapping = occupancy.scale_mapping('sigm', gamma, pivot=pivot, n=n_elements)
+            plt.plot(mapping.x, mapping.y, '--', color='green', label=f'gamma={gamma}, pivot={pivot}')
+        plt.legend()
+        plt.savefig("sigmoid_modification.png")
+    elif do_modify:
+        f3 = plt.figure()
+        x = np.linspace(0, 1, n_elements)
+        col_ampl = plt.cm.Blues(np.linspace(0.3, 0.7, n_lines))
+        col_attn = plt.cm.Reds(np.linspace(0.3, 0.7, n_lines))
+        for i in np.arange(n_lines):
+            k = 2 ** i
+            if do_amplify:
+                plt.plot(x, x ** (1 / k), color=col_ampl[i], label=f'ampl gamma={int(k)}')
+            if do_attenuate:
+                plt.plot(x, x ** k, color=col_attn[i], label=f'attn gamma={int(k)}')
+        for gamma in sweep['ampl']:
+            mapping = occupancy.scale_mapping('ampl', gamma, n=n_elements)
+            plt.plot(mapping.x, mapping.y, color='green', label=f'ampl gamma={gamma}')
+        for gamma in sweep['attn']:
+            mapping = occupancy.scale_mapping('attn', gamma, n=n_elements)
+            plt.plot(mapping.x, mapping.y, color='blue', label=f'attn gamma={gamma}')
 
-        # Save solvent-suppressed output.
-        solExcl_only_name = f'{output_prefix}{base_out_name}'
-        solExcl_only_doc = f'{doc}'
+        plt.legend()
+        plt.savefig("gamma_modification.png")
 
-        map_tools.new_mrc(
-            solExcl_only.astype(np.float32),
-            solExcl_only_name,
-            parent=options.input_map,
-            verbose=options.verbose,
-            extra_header=solExcl_only_doc
-        )
+    if interactive_plot:
+        plt.show()
 
-        del solExcl_only
+
+def occupy_run(options: args.occupy_options):
+    """
+    OccuPy takes a cryo-EM reconstruction produced by averaging and estimates a self-normative local map scaling.
+    It can also locally alter confident partial occupancies.
+
+    This reads the input from file, runs estimate_arrays and writes all output files.
+    """
+
+    if options.help_all:
+        extras.help_all()
+
+    if options.input_map is None:
+        if options.emdb_id is None:
+            exit(1)  # TODO surely a better way to do nothing with no options. Invoke help?
+        else:
+            options.input_map = map_tools.fetch_EMDB(options.emdb_id)
+            if options.scale_mode is None:
+                options.scale_mode = 'res'
+
+    # --------------- READ INPUT ---------------------------------------------------------------
+
+    # Maps are memory-mapped, and only copied by the stages that need to
+    in_map = map_tools.InputMap(options.input_map)
+
+    sol_map = None
+    if options.solvent_def is not None:
+        sol_map = map_tools.InputMap(options.solvent_def)
+
+    mask_spec_map = None
+    if options.target_mask is not None:
+        mask_spec_map = map_tools.InputMap(options.target_mask)
+
+    roi_map = None
+    if options.roi_mask is not None:
+        roi_map = map_tools.InputMap(options.roi_mask)
+
+    labels_map = None
+    if options.target_labels is not None:
+        labels_map = map_tools.InputMap(options.target_labels)
+
+    # --------------- ESTIMATE AND MODIFY ------------------------------------------------------
+
+    sink = FileSink(options, parent=in_map.parent)
+    try:
+        result = estimate_arrays(
+            in_map.data,
+            in_map.voxel_size,
+            options,
+            solvent_def=None if sol_map is None else sol_map.data,
+            target_mask=None if mask_spec_map is None else mask_spec_map.data,
+            axis_order=in_map.axis_order,
+            offset=in_map.offset,
+            sink=sink,
+            roi_mask=None if roi_map is None else roi_map.data,
+            target_labels=None if labels_map is None else labels_map.data
+        )
+    finally:
+        for input_map in [in_map, sol_map, mask_spec_map, roi_map, labels_map]:
+            if input_map is not None:
+                input_map.close()
 
     # ----------------OUTPUT FILES AND PLOTTING -------------------------------------------------
-    #if options.save_all_maps:
-    map_tools.new_mrc(
-        confidence.astype(np.float32),
-        f'{output_prefix}conf_{new_name}',
-        parent=options.input_map,
-        verbose=options.verbose,
-        log=f_log
-    )
+
+    log_name = f'log_{Path(options.input_map).stem}.txt'
+    with open(log_name, 'w') as f_log:
+        f_log.write(result.log)
+
+    if result.label_occupancies is not None:
+        labels_name = f'target_labels_{Path(options.input_map).stem}.csv'
+        label_fields = list(result.label_occupancies.keys())
+        with open(labels_name, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=label_fields)
+            writer.writeheader()
+            for row in zip(*result.label_occupancies.values()):
+                writer.writerow(dict(zip(label_fields, [v.item() for v in row])))
+        if options.verbose:
+            print(f'Wrote the occupancy of each target label to {labels_name}')
+
+    # When sweeping, the visualization shows the first value of each modification
+    modified_names = {}
+    for key, file_name in sink.written.items():
+        modified_names.setdefault(key.split('_')[0], file_name)
+    scale_map = sink.written['scale']
+    ampl_name = modified_names.get('ampl')
+    attn_name = modified_names.get('attn')
+    sigm_name = modified_names.get('sigm')
+    solExcl_only_name = sink.written.get('solExcl')
+    threshold_maps = (result.max_val + result.solvent_limits[3]) / 2.0
 
     # If auto-opening, must write the file for it
     if options.show_chimerax:
@@ -741,11 +1410,11 @@ def occupy_run(options: args.occupy_options):
             attn_map=attn_name,
             sigm_map=sigm_name,
             solExcl_only_map=solExcl_only_name,
-            threshold_maps=(max_val + sol_limits[3]) / 2.0,
-            threshold_scale=variability_limit,
+            threshold_maps=threshold_maps,
+            threshold_scale=result.variability_limit,
             min_scale=options.min_vis_scale,
-            tiles=tiles,
-            warnings=warnings
+            tiles=result.tiles,
+            warnings=result.warnings
         )
 
     if options.chimerax_silent:
@@ -755,103 +1424,20 @@ def occupy_run(options: args.occupy_options):
             ampl_map=ampl_name,
             attn_map=attn_name,
             sigm_map=sigm_name,
-            threshold_map=(max_val + sol_limits[3]) / 2.0,
-            threshold_scale=variability_limit,
+            threshold_maps=threshold_maps,
+            threshold_scale=result.variability_limit,
             min_scale=options.min_vis_scale,
             silent=True,
-            warnings=warnings
+            warnings=result.warnings
         )
 
     if options.plot:
-        f = plt.gcf()
-        f.set_size_inches(12, 2.52)
-        ax1 = f.axes[0]
-
-        if options.solvent_def is not None:
-            ax1.plot(b[:-1], a, 'gray', label='unmasked data')
-        ax1.plot(b[:-1], np.clip(mapping, ax1.get_ylim()[0], 1.0), 'r', label='confidence')
-        if options.hedge_confidence is not None:
-            ax1.plot(b[:-1], np.clip(mapping ** options.hedge_confidence, ax1.get_ylim()[0], 1.0), ':r',
-                                  label='hedged confidence')
-
-        # It would be nice to plot this, but this is on the lp (sol_data) hist
-        # plt.plot([max_val,max_val],ax1.get_ylim(),'k-',label='full scale')
-
-        ax1.legend(bbox_to_anchor=(1, 1), loc="upper left",prop={'size': 11})
-        plt.subplots_adjust(
-            top=0.94,
-            bottom=0.154,
-            left=0.062,
-            right=0.688)
-        #f.tight_layout(rect=[0, 0, 1.05, 1.05])
-
-        save_name = options.input_map
-        has_solvent_def = None
-        if options.solvent_def is not None:
-            has_solvent_def = Path(options.solvent_def).stem
-
-        vis.save_fig(
-            save_name,
-            extra_specifier=has_solvent_def
-        )
-
-        if interactive_plot:
-            plt.show()
-
-        n_lines = 5
-        n_elements = 1000
-        col = plt.cm.binary(np.linspace(0.3, 0.7, n_lines + 1))
-
-        if options.pivot is not None:
-            f2 = plt.figure()
-            x = np.linspace(0, 1, n_elements)
-            plt.plot(x, x, color=col[0], label=f'gamma=1')
-            for i in np.arange(n_lines):
-                t = options.pivot
-                val = 1 + np.sqrt(t) * 2 ** i  # just values that shows some range depending on mu.
-                _, y = occupancy.scale_mapping_sigmoid(options.pivot, val, n_elements)
-                plt.plot(x, y, color=col[i + 1], label=f'gamma={val:.2f}')
-            # The actual value used
-            _, y = occupancy.scale_mapping_sigmoid(options.pivot, options.amplify, n_elements)
-            plt.plot(x, y, '--', color='green', label=f'gamma={options.amplify}')
-            plt.legend()
-            plt.savefig("sigmoid_modification.png")
-        elif do_modify:
-            f3 = plt.figure()
-            x = np.linspace(0, 1, n_elements)
-            col_ampl = plt.cm.Blues(np.linspace(0.3, 0.7, n_lines))
-            col_attn = plt.cm.Reds(np.linspace(0.3, 0.7, n_lines))
-            for i in np.arange(n_lines):
-                k = 2 ** i
-                if do_amplify:
-                    plt.plot(x, x ** (1 / k), color=col_ampl[i], label=f'ampl gamma={int(k)}')
-                if do_attenuate:
-                    plt.plot(x, x ** k, color=col_attn[i], label=f'attn gamma={int(k)}')
-            if do_amplify:
-                plt.plot(x, x ** (1 / options.amplify), color='green', label=f'ampl gamma={options.amplify}')
-            if do_attenuate:
-                plt.plot(x, x ** options.attenuate, color='blue', label=f'attn gamma={options.amplify}')
-
-            plt.legend()
-            plt.savefig("gamma_modification.png")
-
-        if interactive_plot:
-            plt.show()
-
-    print(f'\n------------------------------------Detected limits-------', file=f_log)
-    print(f'Content at 1% of solvent  \t: \t {sol_limits[2]:.3f}', file=f_log)
-    print(f'Solvent drop to 0% (edge) \t: \t {sol_limits[3]:.3f}', file=f_log)
-    print(f'Solvent peak        \t    \t: \t {solvent_parameters[1]:.3f}', file=f_log)
-    print(f'Full scale          \t    \t: \t {max_val:.3f}', file=f_log)
-    print(f'Variability_limit   \t    \t: \t {variability_limit:.3f}', file=f_log)
-    print(f'Primary conf. limit \t    \t: \t {confidece_limit:.3f}', file=f_log)
+        plot_confidence(result, options)
 
-    f_log.close()
     if options.verbose:
-        f_log = open(log_name, 'r')
-        print(f_log.read())
-        f_log.close()
+        print(result.log)
 
+    do_modify = any(len(values) > 0 for values in args.modification_sweep(options).values())
     if options.gui:
         print(f'\n  -*- Use chimeraX to view output -*- \n')
     else:
@@ -884,4 +1470,4 @@ def occupy_run(options: args.occupy_options):
                     print(f'\nTo generate thumbnails of your output, run: ')
                     print(f'\nchimerax --offscreen {chimx_file_silent}\n')
 
-    return 0
\ No newline at end of file
+    return result
@@ -38,6 +38,10 @@ If set, confident partial occupancies will be attenuated by applying a gamma-fac
 Theory:			input = full * S   <=>   full  =  input  * S^-1
 Implemented:	attenuated = full * S^(gamma) = input * S^((gamma) - 1)
 
+--amplify, --attenuate and --sigmoid can all be given several comma-separated values, e.g.
+	--amplify 2,4,8 --attenuate 2,4 --sigmoid 3:0.1,3:0.3
+in which case the scale is estimated once, and one output map is written for each value. Sigmoid values are given as power:pivot, or as a power only to use --pivot.
+
 
 --gamma/-g
 The power [1<] of scale modification. Any number larger than 1. This is used for Either or both of the options --amplify/-am and/or --attenuate/at. At each voxel the local scale S is estimated. The theoretical full-scale map is calculated by dividing by S (multiplying by S^-1). This map is then further modified by the estimated partial scale S of the input map:
@@ -114,6 +118,36 @@ Two modes of scale normalization are implemented. By default, SW is used, which
 --lp-scale/--raw-scale, --occupancy
 The low-pass frequency is determined from the --lowpass/-lp and --resolution/-r flags. By default, the 
 
+--threads
+Number of threads used to estimate the scale and to low-pass filter. For scale estimation, the map is split into slabs along its first axis, which are processed in parallel. The result is identical to that of a single thread.
+
+--precision
+Process all volumes in single (float32) or double (float64) precision. By default, the precision of the input map is kept, which is single for maps stored as 32-bit floats. Single precision uses half the memory of double precision, and is recommended for large maps.
+
+--cache-dir
+A directory in which to store the estimated scale, confidence and solvent model. The stored estimate is re-used by any later run on the same input map with the same estimation settings (e.g. --lowpass, --kernel, --tau, --tile-size, --max-box, --lp-scale), so that trying different --amplify, --attenuate or --sigmoid values does not estimate the scale again. Runs with --plot, --save-all-maps, --target-mask or --target-labels always estimate the scale.
+
+--cache-size
+The maximum total size of the --cache-dir [MB]. When it is exceeded, the least recently used estimates are removed.
+
+--memory-limit
+Process maps larger than --max-box at their full sampling, instead of down-scaling them, using about this much working memory [MB]. All full-size maps are then kept in temporary files (in TMPDIR), and processed in slabs that fit the limit, so the temporary directory needs room for several copies of the map. The output is the same as processing the full map in memory, but --hist-match and --cache-dir are not used.
+
+--roi-mask
+A map (e.g. a mask of the particle) defining a region of interest. The scale is only estimated, and the map only modified, within the padded bounding box of the voxels above 0.5, which is cut out of the input as a cube. The results are pasted back into the full box, with zero scale and confidence outside the region, and the unmodified input there (or zero, if excluding solvent). Maps at a down-scaled processing size are written for the region only. The solvent model is fit within the region as well, so the padding should include some solvent. This is much faster for maps that are mostly solvent, e.g. with elongated or off-centre particles.
+
+--auto-roi
+As --roi-mask, with the region of interest found automatically: the content defined by --solvent-def, else the --target-mask (which must then be the size of the input), else the voxels of the low-passed input that are well above the solvent noise.
+
+--roi-pad
+The padding of the region of interest on all sides [Å].
+
+--sym
+The point-group symmetry of the input map: C<n>, D<n>, T, O or I. The n-fold axis of C<n> and D<n> is along z, and D<n> has a 2-fold axis along x. T and I have 2-fold axes along x, y and z (the 2-2-2 orientation), and O has 4-fold axes along x, y and z. The symmetry center is the center of the box. The local scale is then only estimated within the asymmetric unit, and copied to all symmetry-equivalent voxels, which is faster for higher symmetries. The confidence and modification are still computed for every voxel, since they depend on the local density rather than its surroundings. Outside the sphere inscribed in the box (or the region of interest), where not all symmetry mates are inside the box, the scale is taken from near the edge of the sphere. Symmetry operators that do not map the sampling grid onto itself (3-, 5- and 6-fold axes other than those of T and O, e.g. C3, C5, C6, D3 and I, or a symmetry center between voxels, e.g. in a down-scaled region of interest) copy the scale from the nearest voxel, so the result is approximate and differs somewhat from estimating without --sym. A warning is then given. Only C<n> and D<n> with n = 1, 2 or 4, T and O, about the center of the box, are exact (within the inscribed sphere).
+
+--target-labels
+A map of integer labels (e.g. segments or chains) of the same size as the input, with 0 for unlabelled voxels. The occupancy of each labelled region is estimated as for --target-mask, using a tau set by the number of voxels in the region, and written to target_labels_<input>.csv. The full-scale reference of all labels is found in a single scan over the tiles.
+
 --verbose/--quiet
 Print information during use
 
@@ -4,6 +4,9 @@ import mrcfile as mf
 import wget
 import gzip
 import os
+import copy
+import functools
+import warnings
 from pathlib import Path
 
 import scipy.fft as spfft
@@ -66,14 +69,304 @@ def create_radial_mask(
 
     return out
 
+class ParentHeader:
+    """
+    The header fields of a parent map that output maps are adjusted to, read once and shared by all outputs
+
+    :param parent:  parent file name, or an open mrc-file
+    """
+
+    def __init__(
+            self,
+            parent
+    ):
+        close = False
+        if not isinstance(parent, mf.mrcfile.MrcFile):
+            parent = mf.mmap(parent, mode='r')
+            close = True
+
+        self.nx = int(parent.header['nx'])
+        self.nxstart = int(parent.header['nxstart'])
+        self.voxel_size = float(parent.voxel_size.x)
+        self.axis_order = [int(parent.header[ax]) for ax in ['mapc', 'mapr', 'maps']]
+
+        # Per-axis start (x, y, z) of a cropped header, see crop
+        self.nstart = None
+
+        if close:
+            parent.close()
+
+    def crop(
+            self,
+            start: np.ndarray,
+            size: int
+    ):
+        """
+        The header of a cubic region of the parent box, for output maps that only cover that region
+
+        :param start:   first index of the region along each (array) axis
+        :param size:    edge length of the region [pix]
+        :return:        ParentHeader
+        """
+        cropped = copy.copy(self)
+        cropped.nx = int(size)
+        # Array axes are (section, row, column), header starts are (column, row, section)
+        cropped.nstart = tuple(self.nxstart + int(i) for i in np.flip(start))
+        return cropped
+
+    def apply(
+            self,
+            file_handle: mf.mrcfile.MrcFile
+    ):
+        """
+        Adjust an open mrc-file to coincide with the parent, i.e. overlap their boxes by adjusting voxel-size and offset
+
+        :param file_handle:   File-handle of the mrc-file to adjust
+        """
+
+        # Relative scaling
+        factor = self.nx / file_handle.header['nx']
+
+        # Adjust
+        file_handle.voxel_size = self.voxel_size * factor
+        if self.nstart is None:
+            file_handle.nstart = int(round(self.nxstart / factor))
+        else:
+            file_handle.nstart = tuple(int(round(i / factor)) for i in self.nstart)
+
+        # Ensure axis ordering
+        file_handle.header['mapc'], file_handle.header['mapr'], file_handle.header['maps'] = self.axis_order
+
+
+class InputMap:
+    """
+    A map file opened for reading, memory-mapped so that data is only read from disk where and when it is used
+
+    The data is a read-only view of the file, which stages that do not modify their input can use directly. Any
+    stage that writes in place must make its own copy. Close the map once the data is no longer used.
+
+    :param file_name:   map file name
+    """
+
+    def __init__(
+            self,
+            file_name: str
+    ):
+        self.file_name = file_name
+        self._handle = mf.mmap(file_name, mode='r')
+        self.data = self._handle.data
+
+        # Kept in the precision of the header
+        self.voxel_size = np.copy(self._handle.voxel_size.x)
+        header = self._handle.header
+        self.axis_order = np.array([header['mapc'], header['mapr'], header['maps']])
+        self.offset = np.array([header['nxstart'], header['nystart'], header['nzstart']])
+        self.parent = ParentHeader(self._handle)
+
+    def close(self):
+        self.data = None
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Roi:
+    """
+    A cubic region of interest within a cubic map, e.g. the padded bounding box of a mask (see roi_from_mask)
+
+    :param start:   first index of the region along each axis
+    :param size:    edge length of the region [pix]
+    :param n:       edge length of the full map [pix]
+    """
+
+    def __init__(
+            self,
+            start: np.ndarray,
+            size: int,
+            n: int
+    ):
+        self.start = np.array(start, dtype=int)
+        self.size = int(size)
+        self.n = int(n)
+
+    @property
+    def slices(self):
+        return tuple(slice(i, i + self.size) for i in self.start)
+
+    def crop(
+            self,
+            data: np.ndarray
+    ):
+        """
+        The region of a full map, as a view
+
+        :param data:    full map
+        :return:        cropped view of data
+        """
+        assert np.shape(data) == (self.n,) * 3, "Map is not the size of the full box of the region"
+        return data[self.slices]
+
+    def paste(
+            self,
+            data: np.ndarray,
+            fill=0,
+            empty=np.empty,
+            chunk_elements: int = 2 ** 22
+    ):
+        """
+        Paste a map of the region back into the full box
+
+        :param data:            map of the region
+        :param fill:            value, or full map, to fill in outside the region
+        :param empty:           allocates the full map, as np.empty (e.g. memory-mapped)
+        :param chunk_elements:  approximate number of elements to fill at a time
+        :return:                full map, in the dtype of data
+        """
+        assert np.shape(data) == (self.size,) * 3, "Map is not the size of the region"
+        out = empty((self.n,) * 3, dtype=data.dtype)
+        if np.ndim(fill) == 0:
+            out.fill(fill)
+        else:
+            slab = max(1, chunk_elements // (self.n ** 2))
+            for i in range(0, self.n, slab):
+                out[i:i + slab] = fill[i:i + slab]
+        out[self.slices] = data
+        return out
+
+
+def roi_from_mask(
+        mask: np.ndarray,
+        pad: int = 0,
+        threshold: float = 0.5,
+        min_size: int = 0,
+        chunk_elements: int = 2 ** 22
+):
+    """
+    The padded bounding box of a mask, as a cubic and even-sized region of interest
+
+    The region is centered on the bounding box, but shifted to stay inside the full box.
+
+    :param mask:            cubic mask
+    :param pad:             padding on all sides of the bounding box [pix]
+    :param threshold:       voxels above this value are in the mask
+    :param min_size:        smallest edge length of the region [pix]
+    :param chunk_elements:  approximate number of voxels to threshold at a time
+    :return:                Roi
+    """
+    n = np.shape(mask)[0]
+    assert np.shape(mask) == (n,) * 3, "Mask is not cubic"
+
+    # Projections of the mask along each axis, one slab at a time
+    occupied = np.zeros((3, n), dtype=bool)
+    slab = max(1, chunk_elements // (n ** 2))
+    for i in range(0, n, slab):
+        inside = mask[i:i + slab] > threshold
+        occupied[0, i:i + slab] = np.any(inside, axis=(1, 2))
+        occupied[1] |= np.any(inside, axis=(0, 2))
+        occupied[2] |= np.any(inside, axis=(0, 1))
+    if not np.any(occupied):
+        raise ValueError('** fail ** The region of interest is empty')
+
+    low = np.array([np.argmax(o) for o in occupied])
+    high = np.array([n - np.argmax(o[::-1]) for o in occupied])
+
+    size = int(np.max([np.max(high - low) + 2 * int(pad), min_size]))
+    size = int(np.min([size + size % 2, n]))
+    start = np.clip((low + high - size) // 2, 0, n - size)
+    return Roi(start, size, n)
+
+
+def value_range(
+        data: np.ndarray,
+        chunk_elements: int = 2 ** 22
+):
+    """
+    Minimum and maximum of an array, in one pass over slabs along its first axis
+
+    As np.min and np.max, both are NaN if any value is.
+
+    :param data:            input array
+    :param chunk_elements:  approximate number of elements to process at a time
+    :return:                array [min, max]
+    """
+    data = np.atleast_1d(data)
+    slab = max(1, chunk_elements // max(1, data[0].size))
+    low = high = None
+    has_nan = False
+    for i in range(0, len(data), slab):
+        chunk = data[i:i + slab]
+        c_low, c_high = np.min(chunk), np.max(chunk)
+        has_nan = has_nan or np.isnan(c_low)
+        low = c_low if low is None else np.fmin(low, c_low)
+        high = c_high if high is None else np.fmax(high, c_high)
+    if has_nan:
+        low, high = np.nan, np.nan
+    return np.array([low, high])
+
+
+def write_slabs(
+        out: np.ndarray,
+        data: np.ndarray,
+        chunk_elements: int = 2 ** 22
+):
+    """
+    Copy data into a (memory-mapped) output array one slab at a time, and accumulate its statistics on the way
+
+    The mean and rms are combined across slabs in double precision, so no full-size temporary is made. As for
+    mrcfile's set_data, all statistics are NaN if any value is.
+
+    :param out:             output array, same shape as data
+    :param data:            input array
+    :param chunk_elements:  approximate number of elements to process at a time
+    :return:                min, max, mean, rms of the written (output dtype) data
+    """
+    assert out.shape == data.shape, "Output is not the same shape as the data"
+    if data.size == 0:
+        return None
+
+    slab = max(1, chunk_elements // max(1, data[0].size))
+    low = high = None
+    has_nan = False
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    for i in range(0, len(data), slab):
+        out[i:i + slab] = data[i:i + slab]
+        chunk = out[i:i + slab]
+
+        c_low, c_high = np.min(chunk), np.max(chunk)
+        has_nan = has_nan or np.isnan(c_low)
+        low = c_low if low is None else np.fmin(low, c_low)
+        high = c_high if high is None else np.fmax(high, c_high)
+
+        # Pairwise combination of mean and squared deviation (Chan et al.)
+        c_n = chunk.size
+        c_mean = np.mean(chunk, dtype=np.float64)
+        c_m2 = np.sum(np.square(chunk - c_mean, dtype=np.float64))
+        delta = c_mean - mean
+        m2 += c_m2 + delta ** 2 * n * c_n / (n + c_n)
+        mean += delta * c_n / (n + c_n)
+        n += c_n
+
+    if has_nan:
+        return np.nan, np.nan, np.nan, np.nan
+    return low, high, mean, np.sqrt(m2 / n)
+
+
 def new_mrc(
         data: np.ndarray,
         file_name: str,
-        parent: str = None,
+        parent=None,
         vox_sz: int = None,
         verbose: bool = False,
         extra_header=None,
-        log=None
+        log=None,
+        validate: bool = False,
+        chunk_elements: int = 2 ** 22
 ):
     """
     Write data to a new mrc file, and optionally an existing (parent) file to define data parameters
@@ -81,43 +374,63 @@ def new_mrc(
     If the parent has different dimensions, the box size is assumed equal with unequal sampling.
     The voxel-size and any offset is thus adjusted so that the maps coincide.
 
+    The file is allocated up front and memory-mapped, and the data is converted to float32 and written one slab at
+    a time, so no full-size copy is made. The header statistics are computed on the way. When writing many files
+    with the same parent, pass a ParentHeader to avoid reading the parent each time.
+
     :param data:            Data to write
     :param file_name:       Output file name
-    :param parent:          Parent file name            (optional)
+    :param parent:          Parent file name or ParentHeader    (optional)
     :param vox_sz:          Output voxel size           (optional)
     :param verbose:         Be verbose                  (optional)
     :param extra_header:    String for output header    (optional)
     :param log:             Log-file name               (optional)
+    :param validate:        Validate the written file, which reads all of it again (optional)
+    :param chunk_elements:  approximate number of elements to write at a time
     :return:
     """
 
     if parent is None and vox_sz is None:
         raise ValueError('No parent or pixel-value provided for new mrc file')
 
-    offset = 0
-    factor = 1
+    if parent is not None and not isinstance(parent, ParentHeader):
+        parent = ParentHeader(parent)
 
     # Make sure the suffix is .mrc
     file_name = Path(file_name).with_suffix('')
     file_name = f'{file_name}.mrc'
 
-    # Open
-    o_file = mf.new(file_name, overwrite=True)
+    # Open, with the data block allocated on disk (mode 2 is float32)
+    o_file = mf.new_mmap(file_name, shape=np.shape(data), mrc_mode=2, overwrite=True)
 
-    # set_data() will update header info and stats
-    o_file.set_data(data.astype(np.float32))
+    # Stream the data, and set the header stats as set_data() would
+    stats = write_slabs(o_file.data, data, chunk_elements=chunk_elements)
+    if stats is None:
+        o_file.reset_header_stats()
+    else:
+        low, high, mean, rms = stats
+        if np.isnan(low):
+            warnings.warn("Data array contains NaN values", RuntimeWarning)
+        if np.isinf(low) or np.isinf(high):
+            warnings.warn("Data array contains infinite values", RuntimeWarning)
+        o_file.header.dmin = np.float32(low)
+        o_file.header.dmax = np.float32(high)
+        o_file.header.dmean = np.float32(mean)
+        o_file.header.rms = np.float32(rms)
 
     # Add labels to document what happened
     o_file.add_label(f'Created using OccuPy {__version__}')
     if extra_header is not None:
         o_file.add_label(f'{extra_header}')
 
-    adjust_to_parent(parent,file_handle=o_file)
+    if parent is not None:
+        parent.apply(o_file)
 
-    o_file.flush()
-    o_file.validate()
     o_file.close()
 
+    if validate:
+        mf.validate(file_name)
+
     if verbose:
         if log is None:
             print(f'Wrote new file {file_name}')
@@ -126,14 +439,14 @@ def new_mrc(
 
 
 def adjust_to_parent(
-        parent: str =None,
+        parent=None,
         file_name: str = None,
         file_handle: mf.mrcfile.MrcFile = None
 ):
     """
     Adjust an mrc-file to coincide with the parent, i.e. overlap their boxes by adjusting voxel-size and offset
 
-    :param parent:        Parent file name
+    :param parent:        Parent file name or ParentHeader
     :param file_name:     File name of the mrc-file to adjust
     :param file_handle:   File-handle of the mrc-file to adjust
     :return:
@@ -142,47 +455,19 @@ def adjust_to_parent(
     if parent is None:
         return
 
-    # Do not close file by default
-    close = False
+    if not isinstance(parent, ParentHeader):
+        parent = ParentHeader(parent)
 
     # Open file if necessary
     if file_handle is None:
         assert file_name is not None
+        with mf.open(file_name, 'r+') as file_handle:
+            parent.apply(file_handle)
+        return
 
-        # If open, then close
-        close = True
-
-        file_handle = mf.open(file_name,'r+')
-
-    parent_handle = mf.open(parent)
-
-    # Relative scaling
-    factor = parent_handle.header['nx'] / file_handle.header['nx']
-
-    # Map centering
-    offset_p = parent_handle.header['nxstart']
-
-    # Map scaling
-    pix_size_p = parent_handle.voxel_size.x
-
-    # Adjust
-    file_handle.voxel_size = pix_size_p * factor
-    file_handle.nstart = int(round(offset_p / factor))
-
-    # Ensure axis ordering
-    file_handle.header['mapc'] = parent_handle.header['mapc']
-    file_handle.header['mapr'] = parent_handle.header['mapr']
-    file_handle.header['maps'] = parent_handle.header['maps']
-
-    # Flush to be sure
+    parent.apply(file_handle)
     file_handle.flush()
 
-    # Close if necessary
-    parent_handle.close()
-    if close:
-        file_handle.close()
-
-
 
 def change_voxel_size(
         file: str,
@@ -254,13 +539,305 @@ def uniscale_map(
     return data
 
 
+class Histogram:
+    """
+    Equal-width histogram of an array, computed once and shared by the solvent fit, confidence and plotting
+
+    The array is read in chunks along its first axis, once for the range and once for the counts, so that no
+    full-size temporary is made. The result is identical to np.histogram(data[mask], bins=n_lev).
+
+    :param data:            input array
+    :param n_lev:           number of bins
+    :param mask:            boolean array of the voxels to include, same shape as data (optional)
+    :param chunk_elements:  approximate number of elements to process at a time
+    """
+
+    def __init__(
+            self,
+            data: np.ndarray,
+            n_lev: int = 1000,
+            mask: np.ndarray = None,
+            chunk_elements: int = 2 ** 22
+    ):
+        data = np.atleast_1d(data)
+        if mask is not None:
+            assert mask.shape == data.shape, "Histogram mask is not the same shape as the data"
+        self.n_lev = n_lev
+
+        chunks = self._chunks(data, mask, chunk_elements)
+
+        # Range, with both extrema from the same pass over each chunk
+        low = high = None
+        self.size = 0
+        for chunk in chunks():
+            if chunk.size == 0:
+                continue
+            c_low, c_high = np.min(chunk), np.max(chunk)
+            low = c_low if low is None else min(low, c_low)
+            high = c_high if high is None else max(high, c_high)
+            self.size += chunk.size
+        if self.size == 0:
+            raise ValueError('** fail ** cannot make a histogram of no data')
+        self.low = low
+        self.high = high
+
+        # Counts, with the same bins as np.histogram over the full range
+        self.counts = np.zeros(n_lev, dtype=np.intp)
+        self.edges = None
+        for chunk in chunks():
+            counts, self.edges = np.histogram(chunk, bins=n_lev, range=(low, high))
+            self.counts += counts
+
+    @staticmethod
+    def _chunks(
+            data: np.ndarray,
+            mask: np.ndarray,
+            chunk_elements: int
+    ):
+        slab = max(1, chunk_elements // max(1, data[0].size))
+
+        def chunks():
+            for i in range(0, len(data), slab):
+                if mask is None:
+                    yield data[i:i + slab]
+                else:
+                    yield data[i:i + slab][mask[i:i + slab]]
+
+        return chunks
+
+    @property
+    def density(self):
+        """
+        Histogram normalized to integrate to 1, as np.histogram(..., density=True)
+        """
+        db = np.diff(self.edges)
+        return self.counts / db / self.counts.sum()
+
+
+# Windows of at most this many elements are cached. Larger ones are made on each use, so that the cache stays
+# small in long-running processes (e.g. occupy batch workers) that see many box sizes.
+radial_window_cache_elements = 2 ** 22
+
+
+def radial_window(
+        size: int,
+        dim: int,
+        radius: float = None
+):
+    """
+    Read-only radial mask for windowing of centered (shifted) half-spectra, cached for small sizes
+
+    The window has the same layout as create_radial_mask(size, dim, radius=radius)[..., size//2 - 1:]
+
+    :param size:    Full (not half) spectrum length
+    :param dim:     Spectrum dimension
+    :param radius:  Radius of the window
+    :return:        Boolean array
+    """
+    if size ** dim // 2 > radial_window_cache_elements:
+        return _radial_window(size, dim, radius)
+    return _cached_radial_window(size, dim, radius)
+
+
+def _radial_window(
+        size: int,
+        dim: int,
+        radius: float = None
+):
+    window = create_radial_mask(size, dim=dim, radius=radius)[..., size // 2 - 1:]
+    window.setflags(write=False)
+    return window
+
+
+_cached_radial_window = functools.lru_cache(maxsize=8)(_radial_window)
+
+
+class Spectrum:
+    """
+    Spectral context of a 2D- or 3D-array, for repeated low-pass filtering and resampling
+
+    The forward transform is computed once, on first use, and kept. Each low-pass or resampling of the array then
+    costs a single inverse transform, and the radial windows are shared across all instances through radial_window.
+
+    With stacked=True, the first axis of the input instead indexes several arrays of the same size, which are all
+    transformed and filtered together.
+
+    :param in_data:     input array
+    :param workers:     number of workers for the FFT
+    :param stacked:     the first axis indexes separate arrays
+    """
+
+    def __init__(
+            self,
+            in_data: np.ndarray,
+            workers: int = 1,
+            stacked: bool = False
+    ):
+        # Test square
+        n = np.shape(in_data)
+        if stacked:
+            n = n[1:]
+        assert len(np.unique(n)) == 1, "Input array to lowpass is not square"
+
+        # Test dim
+        self.ndim = len(n)
+        assert self.ndim == 2 or self.ndim == 3, "Input array to lowpass is not 2 or 3 "
+
+        # Test even
+        self.n = n[0]
+        assert self.n % 2 == 0, "Input array size is not even"
+
+        self.data = in_data
+        self.workers = workers
+        self.axes = tuple(range(-self.ndim, 0))
+        self._f_data = None
+
+    @property
+    def f_data(self):
+        """
+        The centered (shifted) half-spectrum of the input array
+        """
+        if self._f_data is None:
+            with spfft.set_workers(self.workers):
+                # FFT forward
+                f_data = spfft.rfftn(self.data, axes=self.axes)  # *2*np.pi/n
+                f_data = spfft.fftshift(f_data, axes=self.axes[:-1])
+            self._f_data = f_data
+        return self._f_data
+
+    def _window(
+            self,
+            f_data: np.ndarray,
+            keep_shells: int,
+            resample: bool = False,
+            square: bool = False
+    ):
+        """
+        Copy the central keep_shells of a centered half-spectrum into a new (possibly resampled) one, and window it
+
+        :param f_data:          centered half-spectrum
+        :param keep_shells:     number of shells to keep, or half the output size if resampling
+        :param resample:        crop/pad the output to 2 * keep_shells
+        :param square:          use a square (not radial) window
+        :return:                windowed half-spectrum
+        """
+        ndim = self.ndim
+        mid_in = int(self.n / 2)
+
+        # Keep double precision spectra, but never promote single precision
+        c_type = np.result_type(f_data.dtype, np.complex64)
+        if resample:
+            mid_out = keep_shells
+            t = np.zeros(np.shape(f_data)[:-ndim] + (2 * keep_shells,) * ndim, dtype=c_type)
+            t = t[..., keep_shells - 1:]
+        else:
+            mid_out = mid_in
+            t = np.zeros(np.shape(f_data), dtype=c_type)
+
+        keep_shells = int(np.min([keep_shells, self.n / 2]))
+        if ndim == 3:
+            t[..., mid_out - keep_shells:mid_out + keep_shells, mid_out - keep_shells:mid_out + keep_shells, :keep_shells + 1] = \
+                f_data[..., mid_in - keep_shells:mid_in + keep_shells, mid_in - keep_shells:mid_in + keep_shells,
+                :keep_shells + 1]
+        elif ndim == 2:
+            t[..., mid_out - keep_shells:mid_out + keep_shells, :keep_shells + 1] = \
+                f_data[..., mid_in - keep_shells:mid_in + keep_shells, :keep_shells + 1]
+
+        if not square:
+            t *= radial_window(2 * mid_out, ndim, radius=keep_shells + 1)
+
+        return t
+
+    def lowpass(
+            self,
+            resolution: float = None,
+            voxel_size: float = None,
+            output_size: int = None,
+            square: bool = False,
+            resample: bool = False
+    ):
+        """
+        Low-pass and/or resample the input array, see map_tools.lowpass.
+
+        If both the output size and a cutoff resolution (and voxel size) are given, the cutoff is applied before
+        resampling. This is equivalent to low-passing and then resampling, but with a single inverse transform.
+
+        :param resolution:      spatial cutoff [Å]
+        :param output_size:     output array size [pix]
+        :param voxel_size:      input voxel size [Å]
+        :param square:          use a square (not radial) window
+        :param resample:        allow output to be cropped/padded
+
+        :return:                low-passed array, output voxel size
+        """
+        n = self.n
+        ndim = self.ndim
+
+        # Test required input
+        assert output_size is not None or voxel_size is not None, "Lowpass needs pixel size or number of pixels."
+        assert output_size is not None or resolution is not None, "Lowpass needs a cutoff resolution or number of pixels"
+
+        out_voxel_size = None
+        cutoff_shells = None
+        # If the output size is specified, then we are resampling
+        if output_size is not None:
+            keep_shells = int(output_size / 2)
+            resample = True
+            if resolution is not None and voxel_size is not None:
+                cutoff_shells = int(np.floor((n * voxel_size) / resolution))
+                if 2 * cutoff_shells > n:
+                    # Nothing to low-pass
+                    cutoff_shells = None
+        # Otherwise the voxel size must have been specified
+        else:
+            keep_shells = int(np.floor((n * voxel_size) / resolution))  # Keep this many of the lower frequencies
+            out_voxel_size = np.copy(voxel_size)
+
+        # Normalization factor for unequal input/output
+        factor = 1
+        if resample:
+            factor = output_size / n
+
+        # If we are resampling, then we may be able to provide the output voxel size
+        if resample and voxel_size is not None:
+            out_voxel_size = voxel_size * n / (2 * keep_shells)
+
+        if 2 * keep_shells > n and not resample:
+            # Padding without resampling is not possible
+            return self.data, out_voxel_size
+
+        f_data = self.f_data
+        if cutoff_shells is not None:
+            # Low-pass at the input size first. A real-valued intermediate would have Hermitian-symmetric
+            # first and last planes along the last axis, so we impose the same here.
+            f_data = self._window(f_data, cutoff_shells, resample=False, square=False)
+            plane_axes = self.axes[1:]
+            for plane in (0, -1):
+                p = f_data[..., plane]
+                f_data[..., plane] = (p + np.conj(np.roll(np.flip(p, axis=plane_axes), 1, axis=plane_axes))) / 2
+
+        t = self._window(f_data, keep_shells, resample=resample, square=square)
+
+        with spfft.set_workers(self.workers):
+            # FFT reverse
+            t = spfft.ifftshift(t, axes=self.axes[:-1])
+            t = spfft.irfftn(t, axes=self.axes)
+
+        # The FFT must be normalized
+        if resample:
+            t *= factor ** ndim
+
+        return t, out_voxel_size
+
+
 def lowpass(
         in_data: np.ndarray,
         resolution: float = None,
         voxel_size: float = None,
         output_size: int = None,
         square: bool = False,
-        resample: bool = False
+        resample: bool = False,
+        workers: int = 1
 ):
     """
     Low-pass a 2D- or 3D-array. Intended for cryo-EM reconstructions. 
@@ -271,6 +848,8 @@ def lowpass(
     One must specify either 
         1) The desired output size (implies rescale) 
         2) The cutoff frequency (resolution) AND pixel size.  
+
+    To filter the same array several times, make a Spectrum and call its lowpass instead.
     
     :param in_data:         input array to be low-passed
     :param resolution:      spatial cutoff [Å]
@@ -278,106 +857,17 @@ def lowpass(
     :param voxel_size:      input voxel size [Å]
     :param square:          use a square (not radial) window
     :param resample:        allow output to be cropped/padded
+    :param workers:         number of workers for the FFT
     
     :return:                low-passed array
     """
-
-    # Test square
-    n = np.shape(in_data)
-    assert len(np.unique(np.shape(n))) == 1, "Input array to lowpass is not square"
-
-    # Test dim
-    ndim = len(n)
-    assert ndim == 2 or ndim == 3, "Input array to lowpass is not 2 or 3 "
-
-    # Test even
-    n = n[0]
-    assert n % 2 == 0, "Input array size is not even"
-
-    # Test required input
-    assert output_size is not None or voxel_size is not None, "Lowpass needs pixel size or number of pixels."
-    assert output_size is not None or resolution is not None, "Lowpass needs a cutoff resolution or number of pixels"
-
-    out_voxel_size = None
-    # If the output size is specified, then we are resampling
-    if output_size is not None:
-        keep_shells = int(output_size / 2)
-        resample = True
-    # Otherwise the voxel size must have been specified
-    else:
-        keep_shells = int(np.floor((n * voxel_size) / resolution))  # Keep this many of the lower frequencies
-        out_voxel_size = np.copy(voxel_size)
-
-    # Normalization factor for unequal input/output
-    factor = 1
-    if resample:
-        factor = output_size / n
-
-    # More workers does not seem to have an effect on my system
-    workers = 1
-
-    f_data = []
-    with spfft.set_workers(workers):
-        # FFT forward
-        f_data = spfft.rfftn(in_data)  # *2*np.pi/n
-        if ndim==3:
-            f_data = spfft.fftshift(f_data, axes=(0, 1))
-        else:
-            f_data = spfft.fftshift(f_data, axes=(0,))
-
-    # If we are resampling, then we may be able to provide the output voxel size
-    if resample and voxel_size is not None:
-        out_voxel_size = voxel_size * n / (2 * keep_shells)
-
-    # We are going to grab central information from the input and make it central in the output
-    mid_in = int(n / 2)
-    mid_out = None
-
-    if 2 * keep_shells > n:
-        # Pad instead
-        if not resample:
-            # Padding without resampling is not possible
-            return in_data, out_voxel_size
-        t = np.zeros((2 * keep_shells, 2 * keep_shells, keep_shells + 1), dtype=np.complex64)
-        edge = int((2 * keep_shells - n) / 2)
-        t[edge:edge + n, edge:edge + n, :-edge] = f_data
-
-    if resample:
-        mid_out = keep_shells
-        t = np.zeros((2 * keep_shells * np.ones(ndim).astype(int)), dtype=np.complex64)
-        t = t[..., keep_shells - 1:]
-    else:
-        mid_out = mid_in
-        t = np.zeros(np.shape(f_data), dtype=np.complex64)
-
-    keep_shells = int(np.min([keep_shells, n / 2]))
-    if ndim == 3:
-        t[mid_out - keep_shells:mid_out + keep_shells, mid_out - keep_shells:mid_out + keep_shells, :keep_shells + 1] = \
-            f_data[mid_in - keep_shells:mid_in + keep_shells, mid_in - keep_shells:mid_in + keep_shells,
-            :keep_shells + 1]
-    elif ndim == 2:
-        t[mid_out - keep_shells:mid_out + keep_shells, :keep_shells + 1] = \
-            f_data[mid_in - keep_shells:mid_in + keep_shells, :keep_shells + 1]
-
-    if not square:
-        mask = create_radial_mask(2 * mid_out, radius=keep_shells + 1, dim=ndim)[..., mid_out - 1:]
-        t = np.multiply(t, mask)
-
-    out_data = []
-    with spfft.set_workers(workers):
-        # FFT reverse
-        if ndim==3:
-            t = spfft.ifftshift(t, axes=(0, 1))
-        else:
-            t = spfft.ifftshift(t, axes=(0,))
-
-        t = spfft.irfftn(t)
-
-    # The FFT must be normalized
-    if resample:
-        t *= factor ** ndim
-
-    return t, out_voxel_size
+    return Spectrum(in_data, workers=workers).lowpass(
+        resolution=resolution,
+        voxel_size=voxel_size,
+        output_size=output_size,
+        square=square,
+        resample=resample
+    )
 
 
 def lowpass_map(
@@ -385,7 +875,8 @@ def lowpass_map(
         cutoff: float = None,
         voxel_size: float = 1.0,
         resample: bool = False,
-        keep_scale: bool = False
+        keep_scale: bool = False,
+        workers: int = 1
 ):
     if cutoff is None:
         return data
@@ -395,9 +886,6 @@ def lowpass_map(
     ref_scale = np.max(data)
     assert ndim == 3  # TODO make work for 2D just in case
 
-    # More workers does not seem to have an effect on my system
-    workers = 1
-
     f_data = []
     with spfft.set_workers(workers):
         # FFT reverse
@@ -415,7 +903,7 @@ def lowpass_map(
         # print(t.shape,mask.shape)
         t = np.multiply(t, mask)
     else:
-        mask = create_radial_mask(n, ndim, radius=cutoff_level)[:, :, mid - 1:]
+        mask = radial_window(n, ndim, radius=cutoff_level)
         # print(f_data.shape,mask.shape,mask.sum(),mask.size,n,cutoff_level)
         t = np.multiply(f_data, mask)
 
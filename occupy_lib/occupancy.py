@@ -1,7 +1,10 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.ndimage as ndi
+from scipy.special import lambertw
 import warnings
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from occupy_lib import map_tools, solvent
 
@@ -42,14 +45,19 @@ def sigmoid_scale(x, mu, order):
 
     Where m is an order paramter >=1, and x takes values on [0,1]. Defined to have f(mu) = 0.5.
 
+    mu and order may be arrays of shape (k, 1), to evaluate k curves at once, each along the last axis.
+
     :param x:
     :param mu:
     :param order:
     :return:
     """
-    out = np.divide(mu * (1 - x), x * (1 - mu), where= x != 0)
+    x = np.asarray(x)
+    num = mu * (1 - x)
+    den = x * (1 - mu)
+    out = np.divide(num, den, out=np.zeros(np.broadcast(num, den).shape, dtype=np.result_type(num, den)), where=x != 0)
     #out = np.divide(1, out, where=out != 0)
-    if order != 1:
+    if np.any(np.asarray(order) != 1):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             out = np.power(out,order)
@@ -58,17 +66,10 @@ def sigmoid_scale(x, mu, order):
     out = np.clip(out, 0, 1)
 
     #To make sure
-    for i in np.arange(len(x)):
-        if x[i] == 0:
-            out[i] = 0
-        if x[i] == 1:
-            out[i] == 1
-
-    for i in np.arange(len(x)-1):
-        if out[i+1]<out[i]:
-            out[i+1]=out[i]
-
+    out[..., x == 0] = 0
 
+    # Monotonically increasing
+    out = np.maximum.accumulate(out, axis=-1)
 
     return out
 
@@ -89,6 +90,146 @@ def scale_mapping_sigmoid(value_cutoff, order, n=1000, save_plot=False):
     return x, s
 
 
+def scale_mapping_sigmoids(value_cutoffs, orders, n=1000):
+    """
+    Sigmoid scale mappings for several (pivot, order) pairs at once, as scale_mapping_sigmoid for each
+
+    :param value_cutoffs:   pivots, the scale values that are unchanged
+    :param orders:          orders (powers) of the sigmoids, one per pivot
+    :param n:               number of points on [0,1]
+    :return:                domain (n,) and mappings (k, n)
+    """
+    value_cutoffs = np.asarray(value_cutoffs, dtype=np.float64).reshape(-1, 1)
+    orders = np.asarray(orders, dtype=np.float64).reshape(-1, 1)
+    assert value_cutoffs.shape == orders.shape, 'Need one order per pivot'
+
+    mu = sigmoid_effective_mu(value_cutoffs, order=orders)
+    x = np.linspace(0, 1, n).astype(np.float32)
+    # Single curves take mu and the order as scalars, which evaluates in the precision of x
+    return x, sigmoid_scale(x, mu.astype(np.float32), orders.astype(np.float32))
+
+
+class ScaleMapping:
+    """
+    Output scale as a function of estimated (input) scale on [0,1], for amplification, attenuation or sigmoid modification
+
+    This is shared by the command-line modification and the GUI plots and previews, so that they agree.
+
+    The curve is tabulated at n points in x and y, for plotting. The power curves of amplification and attenuation
+    are evaluated directly at each voxel, which is both exact and faster than a table lookup. The sigmoid curve is
+    looked up in the table, with linear interpolation.
+
+    :param kind:    ampl, attn or sigm
+    :param power:   power (gamma) of the modification
+    :param pivot:   pivot of the sigmoid modification
+    :param n:       number of table points
+    """
+
+    def __init__(
+            self,
+            kind: str,
+            power: float,
+            pivot: float = None,
+            n: int = 1000
+    ):
+        assert kind in ['ampl', 'attn', 'sigm'], f'Unknown scale mapping {kind}'
+        assert n >= 2, 'A scale mapping needs at least 2 table points'
+        self.kind = kind
+        self.power = power
+        self.pivot = pivot
+        self.n = n
+
+        if kind == 'sigm':
+            assert pivot is not None, 'A sigmoid scale mapping needs a pivot'
+            x, y = scale_mapping_sigmoid(pivot, power, n=n)
+            self.exponent = None
+        else:
+            # Output scale is S^(1/power) if amplifying, S^(power) if attenuating
+            self.exponent = 1 / power if kind == 'ampl' else power
+            x = np.linspace(0, 1, n)
+            y = x ** self.exponent
+
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.x.flags.writeable = False
+        self.y.flags.writeable = False
+        self._tables = {}
+
+    def _table(
+            self,
+            dtype
+    ):
+        # Table values and steps, in the precision of the scale they are applied to
+        if dtype not in self._tables:
+            y = self.y.astype(dtype)
+            self._tables[dtype] = (y, np.append(np.diff(y), 0).astype(dtype))
+        return self._tables[dtype]
+
+    def output_scale(
+            self,
+            scale: np.ndarray
+    ):
+        """
+        The output scale of each estimated scale
+
+        :param scale:   estimated scale, on [0,1]
+        :return:        output scale
+        """
+        scale = np.abs(scale)
+        if self.exponent is not None:
+            return scale ** self.exponent
+
+        dtype = np.result_type(scale.dtype, np.float32)
+        y, dy = self._table(dtype)
+        t = scale.astype(dtype) * dtype.type(self.n - 1)
+        np.clip(t, 0, self.n - 1, out=t)
+        i = t.astype(np.intp)
+        np.minimum(i, self.n - 2, out=i)
+        t -= i
+        t *= dy[i]
+        t += y[i]
+        return t
+
+    def modification(
+            self,
+            scale: np.ndarray
+    ):
+        """
+        The factor to multiply the data by, to take each estimated scale to its output scale
+
+        Where the scale is 0, so is the modification.
+
+        :param scale:   estimated scale. Negative values are taken as their absolute, as by threshold_scale_map
+        :return:        modification
+        """
+        if self.exponent is not None:
+            # Amplification raises the scale to a negative power, which is inf at 0
+            scale = np.abs(scale)
+            with np.errstate(divide='ignore'):
+                modification = scale ** (self.exponent - 1)
+            modification[scale == 0] = 0
+            return modification
+
+        modification = self.output_scale(scale)
+        scale = np.abs(scale)
+        np.divide(modification, scale, out=modification, where=scale > 0)
+        modification[scale == 0] = 0
+        return modification
+
+
+@functools.lru_cache(maxsize=64)
+def scale_mapping(
+        kind: str,
+        power: float,
+        pivot: float = None,
+        n: int = 1000
+):
+    """
+    Cached ScaleMapping, see there.
+    """
+    return ScaleMapping(kind, power, pivot=pivot, n=n)
+
+
 def compute_tiling(
         nd,
         tile_sz,
@@ -131,7 +272,553 @@ def compute_tiling(
         print(
             f'Using {n_tiles} {tile_sz[0]}-voxel tiles, spaced by {space[0]}/{tile_step[0]} voxels and starting {edge[0]} voxels from the edge')
 
-    return tile_sz, tile_step, edge
+    return tile_sz, tile_step, edge, int(n_tiles)
+
+
+def tile_percentiles(
+        data: np.ndarray,
+        tile_origins: np.ndarray,
+        tile_sz: np.ndarray,
+        n_tau: int,
+        chunk_elements: int = 2 ** 22,
+        threads: int = 1
+):
+    """
+    Find the n_tau:th smallest value of each tile in one batched pass
+
+    Tiles are gathered from a sliding-window view of the data, so that no per-tile copies are made before the
+    gather. The order statistic is found by a single partition along the tile axis, which is equivalent to
+    sorting each tile and reading element n_tau. Several order statistics are found by the same partition. The
+    gather is done in chunks of at most chunk_elements values to keep memory bounded for large tiles or many
+    tiles. Chunks are independent, and can be run in a thread pool.
+
+    :param data:            input data array
+    :param tile_origins:    (n, dim) array of the lowest pixel index of each tile
+    :param tile_sz:         number of pixels along each dimension of a tile
+    :param n_tau:           index of the order statistic to find, or an array of them
+    :param chunk_elements:  maximum number of gathered tile values at any time (per thread)
+    :param threads:         number of threads
+    :return:                (n,) array of the n_tau:th value of each tile, or (n, len(n_tau)) for an array n_tau
+    """
+    tile_sz = tuple(int(t) for t in tile_sz)
+    n_tile_vals = int(np.prod(tile_sz))
+    single = np.ndim(n_tau) == 0
+    n_tau = np.clip(np.atleast_1d(n_tau).astype(int), 0, n_tile_vals - 1)
+    kth = np.unique(n_tau)
+
+    windows = np.lib.stride_tricks.sliding_window_view(data, tile_sz)
+
+    n = np.shape(tile_origins)[0]
+    values = np.zeros((n, len(n_tau)), dtype=data.dtype)
+    chunk = int(np.max([1, chunk_elements // n_tile_vals]))
+    if threads > 1:
+        # Make sure all threads get some tiles
+        chunk = int(np.max([1, np.min([chunk, np.ceil(n / threads)])]))
+
+    def scan(start):
+        idx = tile_origins[start:start + chunk]
+        tiles = windows[tuple(idx.T)].reshape(len(idx), n_tile_vals)
+        tiles.partition(kth, axis=1)
+        values[start:start + chunk] = tiles[:, n_tau]
+
+    starts = np.arange(0, n, chunk)
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(scan, starts))
+    else:
+        for start in starts:
+            scan(start)
+
+    if single:
+        return values[:, 0]
+    return values
+
+
+def tile_index_dtype(n_tau: int = None):
+    """
+    The structured dtype of a tile index, see TileScan.index
+
+    :param n_tau:   number of percentiles of each tile, or None for a single (scalar) one
+    :return:        np.dtype with fields ijk, center, in_sphere and value
+    """
+    return np.dtype([
+        ('ijk', np.int32, (3,)),
+        ('center', np.float64, (3,)),
+        ('in_sphere', bool),
+        ('value', np.float64, () if n_tau is None else (n_tau,))
+    ])
+
+
+class TileScan:
+    """
+    The tiles of a percentile tile scan, see tile_scan
+
+    The tiles only depend on the shape of the data, and are laid out once. The percentile tau of each tile, and
+    the normalization constant s_max (the largest of them) can then be found for several tau in one pass over
+    the tiles. The percentiles of all tiles can be kept as a tile index, to find s_max again without a scan.
+    """
+
+    def __init__(
+            self,
+            data: np.ndarray,
+            n_tiles: int,
+            tile_sz: int = None,
+            verbose: bool = False
+    ):
+        """
+        :param data:        3D input data array
+        :param n_tiles:     number of tiles across each dimension
+        :param tile_sz:     number of pixels along each dimension of the tile/input array
+        :param verbose:     be verbose
+        """
+        assert np.ndim(data) == 3, 'The tile scan needs 3D data'
+        self.data = data
+        self.tile_sz, self.tile_step, self.edge, self.n_tiles = compute_tiling(
+            np.array(np.shape(data)),
+            tile_sz,
+            n_tiles,
+            verbose=verbose
+        )
+
+        # Tile indices in scan order (i,j,k), restricted to a sphere of tiles
+        self.all_ijk = np.indices((self.n_tiles,) * 3).reshape(3, -1).T
+        tile_r = np.sqrt(np.sum((self.all_ijk - self.n_tiles / 2) ** 2, axis=1))
+        self.in_sphere = tile_r < self.n_tiles / 2 - 1
+        self.ijk = self.all_ijk[self.in_sphere]
+        self.origins = self.edge + np.multiply(self.tile_step, self.ijk)
+
+    def percentiles(
+            self,
+            tau,
+            threads: int = 1
+    ):
+        """
+        The percentile tau of each tile
+
+        :param tau:         percentile, or an array of them
+        :param threads:     number of threads
+        :return:            (n,) array for each tile, or (n, len(tau)) for an array tau
+        """
+        # Index of the smallest element in the percentile tau
+        n_tau = np.floor(np.multiply(tau, np.prod(self.tile_sz))).astype(int)
+        return tile_percentiles(self.data, self.origins, self.tile_sz, n_tau, threads=threads)
+
+    def index(
+            self,
+            tau,
+            threads: int = 1
+    ):
+        """
+        The percentile tau of every tile, as a structured array in scan order
+
+        Each tile has its (i,j,k) index, pixel center, whether it is in the sphere of scanned tiles, and value. Tiles
+        outside the sphere are not scanned, and have the value NaN.
+
+        :param tau:         percentile, or an array of them
+        :param threads:     number of threads
+        :return:            array of tile_index_dtype, with a value for each tau if an array
+        """
+        index = np.zeros(len(self.all_ijk), dtype=tile_index_dtype(None if np.ndim(tau) == 0 else np.size(tau)))
+        index['ijk'] = self.all_ijk
+        index['center'] = self.edge + np.multiply(self.tile_step, self.all_ijk) + self.tile_sz / 2
+        index['in_sphere'] = self.in_sphere
+        index['value'] = np.nan
+        if len(self.ijk) > 0:
+            index['value'][self.in_sphere] = self.percentiles(tau, threads=threads)
+        return index
+
+    def s_max(
+            self,
+            tau,
+            threads: int = 1,
+            index: np.ndarray = None
+    ):
+        """
+        The normalization constant s_max, as the largest percentile tau of any tile
+
+        :param tau:         percentile, or an array of them
+        :param threads:     number of threads
+        :param index:       tile index of the same tau, to not scan the tiles again (see index)
+        :return:            s_max, and the pixel centers of the tiles with the largest and smallest percentile as a
+                            (2, 3) array, for each tau if an array
+        """
+        # Tau is a percentile, it does not make sense to use it outside the range [0,1]
+        assert np.all((0 < np.asarray(tau)) & (np.asarray(tau) <= 1))
+
+        taus = np.atleast_1d(tau)
+        m = np.arange(len(taus))
+        extremum = np.max(self.data) * np.array([[-1], [1]]) * np.ones((2, len(taus)))
+        extremum_idx = np.zeros((2, len(taus), 3), dtype=int)
+        if len(self.ijk) > 0:
+            if index is None:
+                v = self.percentiles(taus, threads=threads)
+            else:
+                v = index['value'][self.in_sphere].reshape(len(self.ijk), len(taus))
+
+            # Largest value (first tile in scan order, if larger than the initial extremum)
+            i_max = np.argmax(v, axis=0)
+            larger = v[i_max, m] > extremum[0]
+            extremum[0, larger] = v[i_max, m][larger]
+            extremum_idx[0, larger] = self.ijk[i_max[larger]]
+
+            # Smallest value
+            i_min = np.argmin(v, axis=0)
+            smaller = v[i_min, m] < extremum[1]
+            extremum[1, smaller] = v[i_min, m][smaller]
+            extremum_idx[1, smaller] = self.ijk[i_min[smaller]]
+
+        extremum_idx_pix = np.transpose(self.edge + self.tile_step[0] * extremum_idx + self.tile_sz / 2, (1, 0, 2))
+        if np.ndim(tau) == 0:
+            return extremum[0, 0], extremum_idx_pix[0]
+        return extremum[0], extremum_idx_pix
+
+
+def label_occupancies(
+        data: np.ndarray,
+        labels: np.ndarray,
+        tiles: TileScan,
+        threads: int = 1
+):
+    """
+    The occupancy of each labelled region, as for a target mask
+
+    The occupancy of a region is its largest value over s_max, found by the tile scan at the tau of the number of
+    voxels in the region (see set_tau). The largest value and size of every region are found in one pass over the
+    labels, and s_max in one pass over the tiles for all distinct tau.
+
+    :param data:        data to estimate the occupancy of, as for the scale estimation
+    :param labels:      integer label of each voxel, same size as the data, with 0 (or less) for no region
+    :param tiles:       tiles of the scale estimation data, see TileScan
+    :param threads:     number of threads for the tile scan
+    :return:            dict of arrays, one value for each label present: label, n_voxels, tau, max_val, s_max and
+                        occupancy
+    """
+    labels = np.asarray(labels)
+    if np.shape(labels) != np.shape(data):
+        raise ValueError(f'** fail ** label map size {np.shape(labels)} is not the same size as the data {np.shape(data)}')
+    if not np.issubdtype(labels.dtype, np.integer):
+        labels = np.rint(labels)
+    labels = np.clip(labels, 0, None).astype(np.intp)
+
+    n_voxels = np.bincount(labels.reshape(-1))
+    index = np.flatnonzero(n_voxels[1:]) + 1
+    if len(index) == 0:
+        raise ValueError('** fail ** The label map has no labelled voxels (labels above 0)')
+    n_voxels = n_voxels[index]
+
+    max_val = np.array(ndi.maximum(data, labels=labels, index=index), dtype=np.float64)
+    tau = set_tau(n_v=n_voxels)
+    tau_unique, inverse = np.unique(tau, return_inverse=True)
+    s_max, _ = tiles.s_max(tau_unique, threads=threads)
+    s_max = s_max[inverse]
+
+    return {
+        'label': index,
+        'n_voxels': n_voxels,
+        'tau': tau,
+        'max_val': max_val,
+        's_max': s_max,
+        'occupancy': max_val / s_max
+    }
+
+
+def kernel_boxes(
+        kernel: np.ndarray
+):
+    """
+    Decompose a boolean kernel (footprint) into a union of boxes
+
+    Each run of True values along the last axis is grown along the remaining axes for as long as the box stays
+    inside the kernel. Boxes may overlap, which is fine for a max-filter, and boxes contained in other boxes are
+    dropped. For a spherical kernel this gives a handful of nested boxes rather than one box per kernel element.
+
+    :param kernel:  boolean kernel
+    :return:        list of (lo, hi) inclusive index bounds of each box within the kernel
+    """
+    kernel = np.asarray(kernel, dtype=bool)
+    ndim = kernel.ndim
+
+    def inside(lo, hi):
+        return np.all(kernel[tuple(slice(l, h + 1) for l, h in zip(lo, hi))])
+
+    boxes = []
+    for idx in np.ndindex(kernel.shape[:-1]):
+        row = np.concatenate(([0], kernel[idx].astype(int), [0]))
+        steps = np.diff(row)
+        for start, end in zip(np.flatnonzero(steps == 1), np.flatnonzero(steps == -1) - 1):
+            lo = list(idx) + [start]
+            hi = list(idx) + [end]
+            # Grow the run into a box, from the second-to-last axis to the first
+            for ax in reversed(range(ndim - 1)):
+                while lo[ax] > 0 and inside(lo[:ax] + [lo[ax] - 1] + lo[ax + 1:], hi[:ax] + [lo[ax] - 1] + hi[ax + 1:]):
+                    lo[ax] -= 1
+                while hi[ax] < kernel.shape[ax] - 1 and \
+                        inside(lo[:ax] + [hi[ax] + 1] + lo[ax + 1:], hi[:ax] + [hi[ax] + 1] + hi[ax + 1:]):
+                    hi[ax] += 1
+            box = (tuple(int(l) for l in lo), tuple(int(h) for h in hi))
+            if box not in boxes:
+                boxes.append(box)
+
+    # Drop boxes that are contained in another box
+    def contains(a, b):
+        return all(al <= bl and bh <= ah for al, ah, bl, bh in zip(a[0], a[1], b[0], b[1]))
+
+    return [b for b in boxes if not any(a != b and contains(a, b) for a in boxes)]
+
+
+def sliding_max(
+        data: np.ndarray,
+        length: int,
+        axis: int
+):
+    """
+    Maximum over each window of a given length along one axis
+
+    Element i of the output is the maximum of data[i : i + length] along the axis, so the output is length - 1
+    elements shorter than the input along that axis. The windows are built by doubling, so that only
+    ~log2(length) element-wise maxima of shifted views are needed, independent of the data values.
+
+    :param data:    input data array
+    :param length:  window length
+    :param axis:    axis along which to filter
+    :return:        filtered array
+    """
+    def shifted(arr, start, stop):
+        index = [slice(None)] * arr.ndim
+        index[axis] = slice(start, stop)
+        return arr[tuple(index)]
+
+    out = data
+    width = 1
+    while 2 * width <= length:
+        n = out.shape[axis]
+        out = np.maximum(shifted(out, 0, n - width), shifted(out, width, n))
+        width *= 2
+    if width < length:
+        n = out.shape[axis]
+        rest = length - width
+        out = np.maximum(shifted(out, 0, n - rest), shifted(out, rest, n))
+    return out
+
+
+def max_filter_padded(
+        padded: np.ndarray,
+        kernel: np.ndarray,
+        boxes: list = None
+):
+    """
+    Max-filter an array that has already been padded by the kernel extent, using a box decomposition of the kernel
+
+    The output has the shape of the padded input minus (kernel.shape - 1), i.e. only the elements where the
+    kernel fits entirely inside the padded input. Each box is a separable maximum, computed by sliding maxima
+    along each axis, and these passes are shared between boxes of equal side lengths. The output is the
+    element-wise maximum over all boxes, which is exactly the maximum over the kernel.
+
+    :param padded:  input array, padded by kernel.shape // 2 before and kernel.shape - 1 - kernel.shape // 2 after
+    :param kernel:  boolean kernel
+    :param boxes:   box decomposition of the kernel, from kernel_boxes (computed if not given)
+    :return:        max-filtered array
+    """
+    if boxes is None:
+        boxes = kernel_boxes(kernel)
+    if len(boxes) == 0:
+        raise ValueError('Cannot max-filter using an empty kernel')
+
+    ndim = padded.ndim
+    out_shape = tuple(np.array(padded.shape) - np.array(kernel.shape) + 1)
+    lengths = [tuple(h - l + 1 for l, h in zip(lo, hi)) for lo, hi in boxes]
+    out = None
+
+    # Walk the unique side lengths from the last axis to the first, sharing filtered arrays between boxes
+    def walk(f_data, suffix):
+        nonlocal out
+        level = ndim - 1 - len(suffix)
+        if level < 0:
+            for (lo, hi), box_len in zip(boxes, lengths):
+                if box_len == suffix:
+                    region = f_data[tuple(slice(l, l + s) for l, s in zip(lo, out_shape))]
+                    if out is None:
+                        out = np.copy(region)
+                    else:
+                        np.maximum(out, region, out=out)
+            return
+        for length in sorted(set(box_len[level] for box_len in lengths if box_len[level + 1:] == suffix)):
+            walk(sliding_max(f_data, length, level), (length,) + suffix)
+
+    walk(padded, ())
+
+    return out
+
+
+def padded_block(
+        data: np.ndarray,
+        start,
+        stop,
+        pad_before,
+        pad_after
+):
+    """
+    Extract data[start:stop] extended by pad_before/pad_after elements along each axis
+
+    Elements outside the array are filled by mirroring at the array edge (ndi 'reflect' / np.pad 'symmetric'), so
+    that a block padded this way is identical to the same block cut out of the fully padded array.
+
+    :param data:        input data array
+    :param start:       first index of the block along each axis
+    :param stop:        stop index (exclusive) of the block along each axis
+    :param pad_before:  padding before the block along each axis
+    :param pad_after:   padding after the block along each axis
+    :return:            padded block (a copy)
+    """
+    block = data
+    for axis, n in enumerate(np.shape(data)):
+        idx = np.arange(start[axis] - pad_before[axis], stop[axis] + pad_after[axis])
+        if idx[0] >= 0 and idx[-1] < n:
+            index = [slice(None)] * data.ndim
+            index[axis] = slice(idx[0], idx[-1] + 1)
+            block = block[tuple(index)]
+        else:
+            # Mirror with period 2n, which also covers padding larger than the array
+            idx = np.mod(idx, 2 * n)
+            idx = np.where(idx >= n, 2 * n - 1 - idx, idx)
+            block = np.take(block, idx, axis=axis)
+    return np.array(block, copy=True)
+
+
+def max_filter(
+        data: np.ndarray,
+        kernel: np.ndarray,
+        block: int = 32,
+        threads: int = 1,
+        out: np.ndarray = None
+):
+    """
+    Max-filter an array using a box decomposition of the kernel
+
+    This gives the same output as ndi.maximum_filter(data, footprint=kernel), using its default 'reflect'
+    boundary mode, but at a cost that scales with the number of boxes in the kernel rather than its volume.
+    The array is processed in slabs of block elements along the first axis, each padded by the kernel extent,
+    to keep intermediate arrays small. Slabs are independent, and can be run in a thread pool.
+
+    :param data:    input data array
+    :param kernel:  boolean kernel
+    :param block:   slab thickness along the first axis
+    :param threads: number of threads
+    :param out:     array to write the output to, e.g. memory-mapped (optional)
+    :return:        max-filtered array
+    """
+    kernel = np.asarray(kernel, dtype=bool)
+    assert kernel.ndim == data.ndim, 'Kernel and data must have the same number of dimensions'
+    pad_before = [s // 2 for s in kernel.shape]
+    pad_after = [s - 1 - s // 2 for s in kernel.shape]
+    nd = np.shape(data)
+
+    # The kernel is decomposed once, and shared by all slabs
+    kernel_parts = kernel_boxes(kernel)
+
+    if threads > 1:
+        # Make sure all threads get some slabs
+        block = int(np.max([1, np.min([block, np.ceil(nd[0] / threads)])]))
+
+    if out is None:
+        out = np.empty(nd, dtype=data.dtype)
+
+    def filter_slab(z):
+        stop = (np.min([z + block, nd[0]]),) + nd[1:]
+        start = (z,) + (0,) * (data.ndim - 1)
+        padded = padded_block(data, start, stop, pad_before, pad_after)
+        out[z:stop[0]] = max_filter_padded(padded, kernel, boxes=kernel_parts)
+
+    slabs = np.arange(0, nd[0], block)
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(filter_slab, slabs))
+    else:
+        for z in slabs:
+            filter_slab(z)
+
+    return out
+
+
+def max_filter_symmetric(
+        data: np.ndarray,
+        kernel: np.ndarray,
+        source: np.ndarray,
+        block: int = 32,
+        threads: int = 1,
+        out: np.ndarray = None,
+        chunk_elements: int = 2 ** 22
+):
+    """
+    Max-filter a symmetric array, only filtering the part that holds its asymmetric unit
+
+    As max_filter, the array is processed in slabs of block elements along the first axis, but each slab is cut
+    down to the bounding box of the equivalent voxels it holds. All voxels outside these boxes take the value of
+    their equivalent voxel.
+
+    :param data:            input data array
+    :param kernel:          boolean kernel
+    :param source:          flat index of a symmetry-equivalent voxel for each voxel, see symmetry.asymmetric_unit
+    :param block:           slab thickness along the first axis
+    :param threads:         number of threads
+    :param out:             array to write the output to, e.g. memory-mapped (optional)
+    :param chunk_elements:  approximate number of voxels to copy at a time
+    :return:                max-filtered array
+    """
+    kernel = np.asarray(kernel, dtype=bool)
+    assert kernel.ndim == data.ndim == 3, 'Kernel and data must be 3D'
+    pad_before = [s // 2 for s in kernel.shape]
+    pad_after = [s - 1 - s // 2 for s in kernel.shape]
+    nd = np.shape(data)
+
+    if out is None:
+        out = np.empty(nd, dtype=data.dtype)
+
+    # The kernel is decomposed once, and shared by all boxes
+    kernel_parts = kernel_boxes(kernel)
+
+    # The equivalent voxels, marked by slab and by position within a slab
+    n_slabs = int(np.ceil(nd[0] / block))
+    used = np.zeros((n_slabs,) + nd[1:], dtype=bool)
+    plane = nd[1] * nd[2]
+    chunk = max(1, chunk_elements // max(1, plane)) * plane
+    for i in range(0, np.size(source), chunk):
+        z, flat = np.divmod(source[i:i + chunk], plane)
+        used.reshape(n_slabs, -1)[z // block, flat] = True
+
+    boxes = []
+    for slab in range(n_slabs):
+        rows = np.flatnonzero(np.any(used[slab], axis=1))
+        cols = np.flatnonzero(np.any(used[slab], axis=0))
+        if len(rows) > 0:
+            start = (slab * block, rows[0], cols[0])
+            stop = (np.min([(slab + 1) * block, nd[0]]), rows[-1] + 1, cols[-1] + 1)
+            boxes.append((start, stop))
+
+    def filter_box(box):
+        start, stop = box
+        padded = padded_block(data, start, stop, pad_before, pad_after)
+        out[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] = max_filter_padded(padded, kernel, boxes=kernel_parts)
+
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(filter_box, boxes))
+    else:
+        for box in boxes:
+            filter_box(box)
+
+    # Copy the rest from the filtered boxes
+    flat = out.reshape(-1)
+    filtered = {start[0]: (start, stop) for start, stop in boxes}
+    for slab in range(n_slabs):
+        z0, z1 = slab * block, np.min([(slab + 1) * block, nd[0]])
+        copy = np.ones((z1 - z0,) + nd[1:], dtype=bool)
+        if z0 in filtered:
+            start, stop = filtered[z0]
+            copy[:, start[1]:stop[1], start[2]:stop[2]] = False
+        out[z0:z1][copy] = flat[source[z0 * plane:z1 * plane].reshape(copy.shape)[copy]]
+
+    return out
 
 
 def percentile_filter_tiled(
@@ -141,7 +828,11 @@ def percentile_filter_tiled(
         tile_sz: int = None,
         tau: float = 0.95,
         s0: bool = False,
-        verbose: bool = False
+        threads: int = 1,
+        verbose: bool = False,
+        block: int = 32,
+        out: np.ndarray = None,
+        source: np.ndarray = None
 ):
     """
     Penerate the components of a normalized max-filter on the input data
@@ -153,6 +844,9 @@ def percentile_filter_tiled(
 
         s_i, s_max
 
+    along with the tiles that defined s_max, the percentile of every tile (see TileScan.index), and the TileScan to
+    find s_max at other tau without laying out the tiles again.
+
     The normalized max-filter can be computed as
 
        clip(s_i/s_max, 0, 1)
@@ -162,11 +856,59 @@ def percentile_filter_tiled(
     :param n_tiles:     number of tiles across each dimension
     :param tile_sz:     number of pixels along each dimension of the tile/input array
     :param tau:         the percentile of the max-vlue distribution to use to establish s_max
+    :param threads:     number of threads for the max-filter and tile scan
+    :param verbose:     be verbose
+    :param block:       slab thickness of the max-filter
+    :param out:         array to write s_i to, e.g. memory-mapped (optional)
+    :param source:      symmetry-equivalent voxels, to only filter the asymmetric unit (see max_filter_symmetric)
+    :return:   s_i,  s_max,  the max and min tiles and radius (or None),  the tile index (or None),  and the TileScan
+               (or None)
+    """
+    norm_val, extremum_idx_pix, tile_index, tiles = tile_scan(
+        data,
+        n_tiles,
+        tile_sz=tile_sz,
+        tau=tau,
+        s0=s0,
+        threads=threads,
+        verbose=verbose
+    )
+
+    # Establish s_i
+    if source is None:
+        maxi = max_filter(data, kernel, block=block, threads=threads, out=out)
+    else:
+        maxi = max_filter_symmetric(data, kernel, source, block=block, threads=threads, out=out)
+
+    return maxi, norm_val, extremum_idx_pix, tile_index, tiles
+
+
+def tile_scan(
+        data: np.ndarray,
+        n_tiles: int,
+        tile_sz: int = None,
+        tau: float = 0.95,
+        s0: bool = False,
+        threads: int = 1,
+        verbose: bool = False
+):
+    """
+    Establish the normalization constant s_max of a normalized max-filter, see percentile_filter_tiled
+
+    :param data:        input data array
+    :param n_tiles:     number of tiles across each dimension
+    :param tile_sz:     number of pixels along each dimension of the tile/input array
+    :param tau:         the percentile of the max-vlue distribution to use to establish s_max
+    :param s0:          use the simple normalization tau * max(data) instead of the tile scan
+    :param threads:     number of threads for the tile scan
     :param verbose:     be verbose
-    :return:   s_i   and    s_max
+    :return:            s_max, the pixel coordinates of the tile that defined it (or None), the tile index of
+                        all tiles (or None, see TileScan.index), and the TileScan (or None)
     """
     norm_val = 1.0
     extremum_idx_pix = None
+    tile_index = None
+    tiles = None
     if s0:
         # Simpler normalization
         if verbose:
@@ -178,86 +920,24 @@ def percentile_filter_tiled(
         # Tau is a percentile, it does not make sense to use it outside the range [0,1]
         assert 0 < tau <= 1
 
-        # Sizes
-        nd = np.array(np.shape(data))
-        dim = len(nd)
+        if verbose:
+            print(f'Percentile tile scan... ', end='\r')
 
-        tile_sz, tile_step, edge = compute_tiling(
-            nd,
-            tile_sz,
-            n_tiles,
-            verbose=verbose
-        )
+        # SCipy.ndimage has a percentile filter, but we only need non-exhaustive sampling and this is faster.
+        # All tiles are gathered and partitioned in one batched pass, see TileScan
+        tiles = TileScan(data, n_tiles, tile_sz=tile_sz, verbose=verbose)
+        tile_index = tiles.index(tau, threads=threads)
+        norm_val, extremum_idx_pix = tiles.s_max(tau, index=tile_index)
 
-        # Index of the smallest element in the percentile Tau
-        n_tau = int(np.floor(tau * np.product(tile_sz)))
-
-        # Prepare the output array
-        # s_tau_tiles = np.zeros(n_tiles * np.ones(dim).astype(int), dtype=np.float32)
-
-        # SCipy.ndimage has a percentile filter, but we only need non-exhaustive sampling and this is faster
-        # despite using a for-loop structure.
-        # There's probably a faster/better way of doing it, but at the moment this is negligible in execution time
-        extremum = np.max(data) * np.array([-1, 1])
-        extremum_idx = np.zeros((2, 3)).astype(int)
-
-        if dim == 2:
-            for i in np.arange(n_tiles):
-                for j in np.arange(n_tiles):
-                    low_edge = edge + np.multiply(tile_step, [i, j])
-                    high_edge = low_edge + tile_sz
-                    r = np.copy(data[
-                                low_edge[0]: high_edge[0],
-                                low_edge[1]: high_edge[1]]).flatten()
-                    s = np.sort(r)
-                    s_tau_tiles[i][j] = np.copy(s[n_tau])
-        else:
-            if verbose:
-                print(f'Percentile tile scan... ', end='\r')
-            c = 0
-            for i in np.arange(n_tiles):
-                for j in np.arange(n_tiles):
-                    for k in np.arange(n_tiles):
-                        c += 1
-                        #if verbose:
-                        #    print(f'Percentile tile scan {int(100 * c / (n_tiles ** 3))}% complete.', end='\r')
-                        tile_r = np.sqrt((i - n_tiles / 2) ** 2 + (j - n_tiles / 2) ** 2 + (k - n_tiles / 2) ** 2)
-                        if tile_r < n_tiles / 2 - 1:
-                            low_edge = edge + np.multiply(tile_step, [i, j, k])
-                            high_edge = low_edge + tile_sz
-                            r = np.copy(data[
-                                        low_edge[0]: high_edge[0],
-                                        low_edge[1]: high_edge[1],
-                                        low_edge[2]: high_edge[2]]).flatten()
-                            s = np.sort(r)
-                            v = s[n_tau]
-                            # s_tau_tiles[i][j][k] = np.copy(v)
-
-                            # Largest value
-                            if v > extremum[0]:
-                                extremum[0] = v
-                                extremum_idx[0, :] = np.array([i, j, k])
-
-                            # Smallest value
-                            if v < extremum[1]:
-                                extremum[1] = v
-                                extremum_idx[1, :] = np.array([i, j, k])
-
-        extremum_idx_pix = edge + tile_step[0] * extremum_idx + tile_sz / 2
         if verbose:
             print(f'Percentile tile scan completed.      \n')
             print(
-                f'The largest value in percentile tile was {extremum[0]:.3f} in region {extremum_idx[0, :]} (pixel center {extremum_idx_pix[0, :]})')
-            # print(f'The smallest value in percentile tile was {extremum[1]} in region {extremum_idx[1, :]} (pixel center {extremum_idx_pix[1,:]})')
+                f'The largest value in percentile tile was {norm_val:.3f} (pixel center {extremum_idx_pix[0, :]})')
 
-        extremum_idx_pix = np.vstack((extremum_idx_pix, tile_sz / 2))
-        # Establish s_max
-        norm_val = extremum[0]  # np.max(s_tau_tiles)
+        # The tile radius, after the centers
+        extremum_idx_pix = np.vstack((extremum_idx_pix, tiles.tile_sz / 2))
 
-    # Establish s_i
-    maxi = ndi.maximum_filter(data, footprint=kernel)
-
-    return maxi, norm_val, extremum_idx_pix
+    return norm_val, extremum_idx_pix, tile_index, tiles
 
 
 def percentile_filter(
@@ -267,7 +947,11 @@ def percentile_filter(
         tiles: int = 20,
         tile_sz: int = 12,
         s0: bool = False,
-        verbose: bool = False
+        threads: int = 1,
+        verbose: bool = False,
+        block: int = 32,
+        out: np.ndarray = None,
+        source: np.ndarray = None
 ):
     # Tau is a percentile, it does not make sense to use it outside the range [0,1]
     assert 0 < tau <= 1
@@ -279,7 +963,11 @@ def percentile_filter(
         tile_sz=tile_sz,
         tau=tau,
         s0=s0,
-        verbose=verbose
+        threads=threads,
+        verbose=verbose,
+        block=block,
+        out=out,
+        source=source
     )
 
 
@@ -377,26 +1065,27 @@ def modify_scale_gamma(
     assert not amplify_gamma == attenuate_gamma, "Cannot both amplify and attenuate"
 
     if amplify_gamma or not attenuate_gamma:
-        gamma = 1 / gamma - 1
+        return scale_mapping('ampl', gamma).modification(scale)
     else:  # attenuate
-        gamma = gamma - 1
-    return np.abs(scale) ** gamma
+        return scale_mapping('attn', gamma).modification(scale)
 
 
 def modify_scale_sigmoid(
         scale: np.ndarray,
         nu: float,
-        mu: float
+        mu: float,
+        n: int = 1000
 ):
-    n = 100
-
-    domain, mapping = scale_mapping_sigmoid(mu, nu, n)
-
-    scale_idx = (np.abs(scale) * n - 1).astype(int)
-
-    modification = np.divide(mapping[scale_idx], scale, where=scale > 0)
+    """
+    The modification that takes each estimated scale to its sigmoid-modified scale, see ScaleMapping
 
-    return modification
+    :param scale:   estimated scale
+    :param nu:      power of the sigmoid
+    :param mu:      pivot of the sigmoid
+    :param n:       number of points in the sigmoid table
+    :return:        modification
+    """
+    return scale_mapping('sigm', nu, pivot=mu, n=n).modification(scale)
 
 
 def get_map_scale(
@@ -407,7 +1096,11 @@ def get_map_scale(
         s0: bool = False,
         tile_size: int = 12,
         scale_mode: str = None,
-        verbose: bool = True
+        threads: int = 1,
+        verbose: bool = True,
+        block: int = 32,
+        out: np.ndarray = None,
+        source: np.ndarray = None
 ):
     """
     Estimate the local scale of each array element with respect to the global gray scale (distribution)
@@ -418,20 +1111,31 @@ def get_map_scale(
         :param sol_mask:
         :param sol_threshold:
         :param save_occ_map:
+        :param threads:     number of threads for the max-filter and tile scan
         :param verbose:
+        :param block:       slab thickness of the max-filter
+        :param out:         array to write the scale to, e.g. memory-mapped (optional)
+        :param source:      symmetry-equivalent voxels, to only filter the asymmetric unit (optional)
+        :return:            scale, s_max, the max and min tiles, the tile index and the TileScan, see
+                            percentile_filter_tiled
     """
 
     # Calculate the local scale and normalisation constant based on desired percentile confidence
-    scale_map, map_val_at_full_scale, extr_tiles = percentile_filter(
+    scale_map, map_val_at_full_scale, extr_tiles, tile_index, tiles = percentile_filter(
         data,
         scale_kernel,
         tau=tau,
         s0=s0,
         tile_sz=tile_size,
-        verbose=verbose)
+        threads=threads,
+        verbose=verbose,
+        block=block,
+        out=out,
+        source=source)
 
-    # Perform max-filter normalisation
-    scale_map = np.clip(scale_map / map_val_at_full_scale, 0, 1)
+    # Perform max-filter normalisation, in place
+    scale_map /= map_val_at_full_scale
+    np.clip(scale_map, 0, 1, out=scale_map)
 
     if s0:
         scale_mode = f'naive_{scale_mode}'
@@ -444,7 +1148,7 @@ def get_map_scale(
             verbose=verbose,
             extra_header=f'occupy scale: {scale_mode}'
         )
-    return scale_map, map_val_at_full_scale, extr_tiles
+    return scale_map, map_val_at_full_scale, extr_tiles, tile_index, tiles
 
 
 def modify(
@@ -458,11 +1162,17 @@ def modify(
         sol_mask: np.ndarray = None,
         scale_threshold: float = None,
         save_modified_map: bool = False,
+        confidence: np.ndarray = None,
+        unmodified: np.ndarray = None,
+        exclude_solvent: bool = False,
+        mapping_size: int = 1000,
+        chunk_elements: int = 2 ** 22,
         verbose: bool = True
 ):
     """
     Modify an input array by applying a power-scaled scale-estimate
 
+    This is modify_many for a single modification, see there.
 
     :param data:
     :param scale:
@@ -472,17 +1182,92 @@ def modify(
     :param scale_threshold:
     :param attenuate:
     :param save_modified_map:
+    :param confidence:          suppress modification outside the confidence, as solvent.suppress (optional)
+    :param unmodified:          data to add back solvent from, when suppressing
+    :param exclude_solvent:     do not add back solvent, when suppressing
+    :param mapping_size:        number of table points of the sigmoid scale mapping
+    :param chunk_elements:      approximate number of voxels to process at a time
     :param verbose:
     :return:
     """
+    modification = {
+        'amplify_gamma': amplify_gamma,
+        'attenuate_gamma': attenuate_gamma,
+        'sigmoid_gamma': sigmoid_gamma,
+        'sigmoid_pivot': sigmoid_pivot,
+        'fake_solvent': fake_solvent
+    }
+    modified_maps = modify_many(
+        data,
+        scale,
+        {'modification': modification},
+        sol_mask=sol_mask,
+        scale_threshold=scale_threshold,
+        save_modified_map=save_modified_map,
+        confidence=confidence,
+        unmodified=unmodified,
+        exclude_solvent=exclude_solvent,
+        mapping_size=mapping_size,
+        chunk_elements=chunk_elements,
+        verbose=verbose
+    )
+    return modified_maps['modification']
+
+
+def modify_many(
+        data: np.ndarray,
+        scale: np.ndarray,
+        modifications: dict,
+        sol_mask: np.ndarray = None,
+        scale_threshold: float = None,
+        save_modified_map: bool = False,
+        confidence: np.ndarray = None,
+        unmodified: np.ndarray = None,
+        exclude_solvent: bool = False,
+        mapping_size: int = 1000,
+        chunk_elements: int = 2 ** 22,
+        verbose: bool = True,
+        parent=None,
+        empty=np.empty
+):
+    """
+    Modify an input array by several power-scaled or sigmoid scale-estimates, in a single pass
 
-    do_amplify = amplify_gamma is not None
-    do_attenuate = attenuate_gamma is not None
-    do_sigmoid = sigmoid_gamma is not None and sigmoid_pivot is not None
+    Each modification is a dict with exactly one of amplify_gamma, attenuate_gamma or sigmoid_gamma (with
+    sigmoid_pivot) set, and optionally the fake_solvent to add where the map is attenuated.
 
-    # Expect separate calls, so that we dont do more than one thing
-    actions = do_amplify + do_attenuate + do_sigmoid
-    assert actions == 1, f'A modify call should only perform one action: ampl={do_amplify}, attn={do_attenuate}, sigm={do_sigmoid}'
+    The modifications, fake solvent and (if confidence is given) solvent suppression are all done for one slab of
+    chunk_elements voxels at a time, so that the temporaries are slab-sized. The thresholded scale and the
+    unmodified solvent to add back are computed once per slab, and shared by all modifications. The result is the
+    same as modifying the whole array and then calling solvent.suppress, for each modification.
+
+    :param data:                input array
+    :param scale:               estimated scale
+    :param modifications:       name and settings of each modification (dict of dicts)
+    :param sol_mask:            only modify inside this solvent mask (optional)
+    :param scale_threshold:     scale below which no modification is done
+    :param save_modified_map:   write the modification to modification.mrc, or each to modification_<name>.mrc
+    :param confidence:          suppress modification outside the confidence, as solvent.suppress (optional)
+    :param unmodified:          data to add back solvent from, when suppressing
+    :param exclude_solvent:     do not add back solvent, when suppressing
+    :param mapping_size:        number of table points of the sigmoid scale mapping
+    :param chunk_elements:      approximate number of voxels to process at a time
+    :param verbose:             be verbose
+    :param parent:              parent file name or map_tools.ParentHeader, for the header of saved maps (optional)
+    :param empty:               allocates the full-size outputs, called as np.empty (e.g. to memory-map them)
+    :return:                    modified arrays (dict with the same names as modifications)
+    """
+
+    settings = {}
+    for name, m in modifications.items():
+        do_amplify = m.get('amplify_gamma') is not None
+        do_attenuate = m.get('attenuate_gamma') is not None
+        do_sigmoid = m.get('sigmoid_gamma') is not None and m.get('sigmoid_pivot') is not None
+
+        # Expect separate modifications, so that we dont do more than one thing in each
+        actions = do_amplify + do_attenuate + do_sigmoid
+        assert actions == 1, f'A modification should only perform one action: ampl={do_amplify}, attn={do_attenuate}, sigm={do_sigmoid}'
+        settings[name] = (do_amplify, do_attenuate, m)
 
     # Scale threshold stops very small estimated scales from being modified.
     if scale_threshold is None:
@@ -493,73 +1278,161 @@ def modify(
     elif verbose:
         print(f'Applying provided strict occupancy threshold of {100 * scale_threshold:.1f}%.')
 
-    # Supply threshold (set scale below threshold to 1, i.e. don't modify)
-    thresholded_scale_map = threshold_scale_map(scale, scale_threshold)
-
     # Solvent mask option that isn't really used at the moment
-    if sol_mask is not None:
+    if sol_mask is not None and verbose:
+        print('Using solvent mask when equalising occupancy.')
+
+    if confidence is not None:
+        assert exclude_solvent or unmodified is not None, 'Cannot add back solvent without unmodified data'
         if verbose:
-            print('Using solvent mask when equalising occupancy.')
-        thresholded_scale_map = (1 - sol_mask) + np.multiply(sol_mask, thresholded_scale_map)
-
-    # Construct modification as dependent on scaling and gamma-coefficient
-    modification = []
-    if do_amplify:
-        modification = modify_scale_gamma(
-            thresholded_scale_map,
-            amplify_gamma,
-            attenuate_gamma=do_attenuate)
-
-    if do_attenuate:
-        modification = modify_scale_gamma(
-            thresholded_scale_map,
-            attenuate_gamma,
-            attenuate_gamma=do_attenuate)
-
-    if do_sigmoid:
-        # Construct modification as dependent on scaling and gamma-coefficient
-        modification = modify_scale_sigmoid(
-            scale,
-            sigmoid_gamma,
-            sigmoid_pivot)
-
-    # Amplify or attenuate map
-    modified_map = np.multiply(data, modification)
+            print('Using confidence based on solvent model to suppress modified solvent.')
+            if exclude_solvent:
+                print('Not retaining input solvent.')
+            else:
+                print('Retaining solvent from input.')
+
+    modified_maps = dict.fromkeys(modifications)
+    modification_maps = dict.fromkeys(modifications)
+    slab = max(1, chunk_elements // max(1, data[0].size))
+    for i in range(0, len(data), slab):
+        sl = np.s_[i:i + slab]
+
+        # Supply threshold (set scale below threshold to 1, i.e. don't modify)
+        thresholded_scale_map = threshold_scale_map(scale[sl], scale_threshold)
+        if sol_mask is not None:
+            thresholded_scale_map = (1 - sol_mask[sl]) + np.multiply(sol_mask[sl], thresholded_scale_map)
+
+        # Unmodified solvent to add back
+        retained_solvent = None
+        if confidence is not None and not exclude_solvent:
+            retained_solvent = np.multiply(unmodified[sl], 1 - confidence[sl])
+
+        for name, (do_amplify, do_attenuate, m) in settings.items():
+
+            # Construct modification as dependent on scaling and gamma-coefficient
+            if do_amplify:
+                modification = modify_scale_gamma(
+                    thresholded_scale_map,
+                    m['amplify_gamma'],
+                    attenuate_gamma=False)
+            elif do_attenuate:
+                modification = modify_scale_gamma(
+                    thresholded_scale_map,
+                    m['attenuate_gamma'],
+                    attenuate_gamma=True)
+            else:
+                modification = modify_scale_sigmoid(
+                    scale[sl],
+                    m['sigmoid_gamma'],
+                    m['sigmoid_pivot'],
+                    n=mapping_size)
+
+            # Amplify or attenuate map
+            modified = np.multiply(data[sl], modification)
+
+            # Fake solvent is drawn from solvent model distribution
+            # Fake solvent is None if amplifying
+            if m.get('fake_solvent') is not None:
+                # CURRENT METHOD:  This is only active if attenuating, in which case the modification is on [0,1]
+                modified += np.multiply(m['fake_solvent'][sl], np.clip(1 - modification, 0, 1))
+
+            # Suppress modification of solvent, and add back unmodified solvent unless excluded
+            # (as solvent.suppress)
+            if confidence is not None:
+                modified = np.multiply(modified, confidence[sl])
+                if retained_solvent is not None:
+                    modified += retained_solvent
+
+            if modified_maps[name] is None:
+                modified_maps[name] = empty(np.shape(data), dtype=modified.dtype)
+            modified_maps[name][sl] = modified
+
+            if save_modified_map:
+                if modification_maps[name] is None:
+                    modification_maps[name] = empty(np.shape(data), dtype=np.float32)
+                modification_maps[name][sl] = modification
 
     # Optional output with --save-all-maps
     if save_modified_map:
-        map_tools.new_mrc(modification.astype(np.float32), 'modification.mrc', vox_sz=1)
-
-    # Fake solvent is drawn from solvent model distribution
-    # Fake solvent is None if amplifying
-    if fake_solvent is not None:
-        # CURRENT METHOD:  This is only active if attenuating, in which case the modification is on [0,1]
-        modified_map += np.multiply(fake_solvent, np.clip(1 - modification,0,1))
-
-        '''
-        # OPTIONAL METHOD, make an attenuation mask (1-mod).clip(0,1), and combine with confidence. Add solvent there.
-        region = np.multiply(confidence, np.clip(1 - modification,0,1))
-
-        # Option to blend the added noise into the noise background by low-pass. 
-        # Not as good as expected in tests - inactive
-        blended_sol = modified_map + np.multiply(fake_solvent, region)
-        blended_sol, _ = map_tools.lowpass(
-            blended_sol,
-            resolution=5.0,
-            voxel_size=1.0
-        )
+        for name, modification_map in modification_maps.items():
+            file_name = 'modification.mrc' if len(modifications) == 1 else f'modification_{name}.mrc'
+            map_tools.new_mrc(modification_map, file_name, parent=parent, vox_sz=1)
+
+    '''
+    # OPTIONAL METHOD, make an attenuation mask (1-mod).clip(0,1), and combine with confidence. Add solvent there.
+    region = np.multiply(confidence, np.clip(1 - modification,0,1))
+
+    # Option to blend the added noise into the noise background by low-pass. 
+    # Not as good as expected in tests - inactive
+    blended_sol = modified_map + np.multiply(fake_solvent, region)
+    blended_sol, _ = map_tools.lowpass(
+        blended_sol,
+        resolution=5.0,
+        voxel_size=1.0
+    )
+
+    modified_map = np.multiply(modified_map, 1-region) + np.multiply(blended_sol, region)
+    '''
+
+    return modified_maps
+
+
+def confidence_envelope(
+        content_fraction: np.ndarray
+):
+    """
+    Make the content fraction of each histogram bin a confidence that decreases with decreasing map value
 
-        modified_map = np.multiply(modified_map, 1-region) + np.multiply(blended_sol, region)
-        '''
+    Going down from the highest bin, each value is limited to the current one, and the decrease per bin is
+    never allowed to get smaller. Below the highest bin with non-positive content fraction, the confidence is 0.
 
-    return modified_map
+    Between bins where the content fraction limits the confidence, the confidence decreases linearly, so each
+    such stretch is filled in at once rather than bin by bin.
+
+    :param content_fraction:    content fraction of each bin
+    :return:                    confidence of each bin
+    """
+    n = np.size(content_fraction)
+    out = np.copy(content_fraction)
+
+    # The highest bin at or below zero, apart from the top two, ends the envelope
+    below = np.flatnonzero(content_fraction[:n - 2] <= 0)
+    stop = below[-1] if below.size > 0 else None
+    low = 0 if stop is None else stop + 1
+
+    anchor = n - 1
+    dt = 0.0
+    while anchor > low:
+        # Continue down from the anchor with the current derivative
+        line = np.subtract.accumulate(np.r_[out[anchor], np.full(anchor - low, dt)])[1:]
+        below_line = np.flatnonzero(content_fraction[low:anchor][::-1] < line)
+        if below_line.size == 0:
+            out[low:anchor] = line[::-1]
+            break
+
+        # The content fraction limits the confidence at the next anchor, which sets a larger derivative
+        k = below_line[0]
+        out[anchor - k:anchor] = line[:k][::-1]
+        anchor -= k + 1
+        dt = out[anchor + 1] - out[anchor]
+
+    # Lower map values should be left 0
+    if stop is not None:
+        out[:stop] = 0
+    elif n > 1 and out[-1] <= 0:
+        out[:-1] = 0
+
+    return out
 
 
 def estimate_confidence(
         data,
         solvent_paramters,
         hedge_confidence=None,
-        n_lev=1000
+        n_lev=1000,
+        histogram=None,
+        chunk_elements=2 ** 22,
+        out=None
 ):
     """
     Estimate the confidence of each voxel, given the data and the solvent model
@@ -569,17 +1442,19 @@ def estimate_confidence(
     :param data:                input array
     :param solvent_paramters:   solvent model parameters, gaussian (scale, mean, var)
     :param hedge_confidence:    take the estimated confidence to this power to hedge
-    :param n_lev:               how many levels to use for the histogram
+    :param n_lev:               how many levels to use for the histogram, if not given one
+    :param histogram:           map_tools.Histogram of the data (optional)
+    :param chunk_elements:      approximate number of voxels to map to confidence at a time
+    :param out:                 float32 array to write the confidence to, e.g. memory-mapped (optional)
     :return:
 
     """
 
     # Establish histogram for the data without solvent masked
-    a, b = np.histogram(
-        data,
-        bins=n_lev,
-        density=True
-    )
+    if histogram is None:
+        histogram = map_tools.Histogram(data, n_lev=n_lev)
+    n_lev = histogram.n_lev
+    a, b = histogram.density, histogram.edges
 
     # Find intersection of solvent model and content
     solvent_model = solvent.onecomponent_solvent(
@@ -596,38 +1471,70 @@ def estimate_confidence(
     content_fraction_all = np.divide((a + 0.01 - fit[:-1]), a + 0.01)
 
     # Enforce monotonically decreasing confidence with decreasing map scale
-    out = np.copy(content_fraction_all)
-    dt = 0
-    for i in np.flip(np.arange(np.size(out) - 1)):
+    mapping = confidence_envelope(content_fraction_all)
 
-        # The out[i+1]-dt teem enforces monotonically decreasing *derivative* of confidence with decreasing map scale
-        a = [out[i], out[i + 1], out[i + 1] - dt]
+    # Hedge if requested
+    if hedge_confidence is not None:
+        if hedge_confidence > 1:
+            mapping = mapping ** hedge_confidence
 
-        out[i] = np.min(a)
+    # Clip output to [0,1]  (This should not be necessary, but is legacy and untested)
+    lut = np.clip(mapping.astype(np.float32), 0.0, 1.0)
 
-        # The current derivative
-        dt = out[i + 1] - out[i]
+    # Generate output from mapping, one slab at a time
+    confidence = out
+    if confidence is None:
+        confidence = np.empty(np.shape(data), dtype=np.float32)
+    if confidence.size > 0:
+        slab = max(1, chunk_elements // max(1, data[0].size))
 
-        # Lower map values should be left 0
-        if out[i - 1] <= 0:
-            out[:i - 1] = 0
-            break
+        # The same scaling as uniscale_map(data, move=True), without copying the data
+        data_range = histogram.high - histogram.low
+        offset = histogram.low / data_range
+        for i in range(0, len(data), slab):
+            indx = data[i:i + slab] / data_range
+            indx -= offset
+            indx *= n_lev
+            indx -= 1
+            np.take(lut, indx.astype(int), out=confidence[i:i + slab])
 
-    # generate the mapping of data to confidence
-    indx = (map_tools.uniscale_map(np.copy(data), move=True) * n_lev - 1).astype(int)
+    return confidence, mapping
 
-    # Hedge if requested
-    if hedge_confidence is not None:
-        if hedge_confidence > 1:
-            out = out ** hedge_confidence
 
-    # Generate ouput from mapping
-    confidence = (out[indx]).astype(np.float32)
+@functools.lru_cache(maxsize=None)
+def _tau_root(n_v: int):
+    return float(solve_tau(np.array([n_v]))[0])
 
-    # Clip output to [0,1]  (This should not be necessary, but is legacy and untested)
-    confidence = np.clip(confidence, 0.0, 1.0)
 
-    return confidence, out
+def solve_tau(
+        n_v: np.ndarray,
+        tol: float = 1e-15,
+        max_iter: int = 50
+):
+    """
+    The only positive real root of x**n + x - 1 == 0, for each n in an array
+
+    Newton iterations start from the root of the asymptotic equation (1 - y)**n ~ exp(-n*y) = y, with x = 1 - y,
+    which is x0 = 1 - W(n)/n for the Lambert W function. This is close enough for a few iterations to converge to
+    machine precision, for any n >= 1.
+
+    :param n_v:         number of samples, array of integers >= 1
+    :param tol:         convergence limit of the Newton step
+    :param max_iter:    maximum number of Newton iterations
+    :return:            percentile, for each n_v
+    """
+    n = np.asarray(n_v, dtype=np.float64)
+    if np.any(n < 1):
+        raise ValueError(f'** fail ** Cannot set tau for fewer than 1 sample')
+
+    x = 1 - np.real(lambertw(n)) / n
+    for _ in range(max_iter):
+        x_n1 = np.exp((n - 1) * np.log(x))
+        step = (x_n1 * x + x - 1) / (n * x_n1 + 1)
+        x = x - step
+        if np.all(np.abs(step) < tol):
+            break
+    return x
 
 
 def set_tau(
@@ -643,8 +1550,10 @@ def set_tau(
 
     x**n + x - 1 == 0
 
+    by Newton iterations (see solve_tau). Single values of n_v are cached, and an array of n_v is solved at once.
+
     :param kernel:
-    :param n_v:
+    :param n_v:     number of samples, or an array of them
     :return: percentile
     """
 
@@ -657,146 +1566,9 @@ def set_tau(
     if kernel is not None:
         n_v = np.sum(kernel)
 
-    # Solving is too slow for the GUI responsiveness.
-    """
-    # Solve for the only real and positive root of x^n = 1 - x
-    # which is the same as x^n + x -1 = 0
-    v = np.zeros(n_v + 1)  # n_v + 1 degree polynomial with coefficients
-    v[0] += 1  # x^n_v
-    v[-2] += 1  # x^1
-    v[-1] = -1  # x^0
-    rt = np.roots(v)
-
-    # Select positive
-    rt = rt[rt.real > 0]
-
-    # SElect the real root, as the root with the smallest imaginary value, in case there's issues in precision
-    r = np.argsort(np.abs(rt.imag))
-
-    # Make sure it's real
-    tau = rt[r[0]].real
-
-    return tau
-    """
-    tau = None
-    if n_v <= 1000:
-        tau_presolved = \
-            [0.5000, 0.6180, 0.6823, 0.7245, 0.7549, 0.7781, 0.7965, 0.8117, 0.8243, 0.8351,
-             0.8444, 0.8526, 0.8598, 0.8662, 0.8720, 0.8772, 0.8819, 0.8862, 0.8902, 0.8939,
-             0.8973, 0.9004, 0.9034, 0.9061, 0.9087, 0.9111, 0.9134, 0.9155, 0.9175, 0.9195,
-             0.9213, 0.9230, 0.9246, 0.9262, 0.9277, 0.9291, 0.9305, 0.9318, 0.9330, 0.9342,
-             0.9354, 0.9365, 0.9375, 0.9386, 0.9396, 0.9405, 0.9414, 0.9423, 0.9432, 0.9440,
-             0.9448, 0.9456, 0.9463, 0.9470, 0.9477, 0.9484, 0.9491, 0.9497, 0.9504, 0.9510,
-             0.9516, 0.9522, 0.9527, 0.9533, 0.9538, 0.9543, 0.9548, 0.9553, 0.9558, 0.9563,
-             0.9567, 0.9572, 0.9576, 0.9581, 0.9585, 0.9589, 0.9593, 0.9597, 0.9601, 0.9604,
-             0.9608, 0.9612, 0.9615, 0.9619, 0.9622, 0.9625, 0.9629, 0.9632, 0.9635, 0.9638,
-             0.9641, 0.9644, 0.9647, 0.9650, 0.9653, 0.9655, 0.9658, 0.9661, 0.9663, 0.9666,
-             0.9668, 0.9671, 0.9673, 0.9676, 0.9678, 0.9680, 0.9683, 0.9685, 0.9687, 0.9689,
-             0.9691, 0.9694, 0.9696, 0.9698, 0.9700, 0.9702, 0.9704, 0.9706, 0.9708, 0.9709,
-             0.9711, 0.9713, 0.9715, 0.9717, 0.9718, 0.9720, 0.9722, 0.9724, 0.9725, 0.9727,
-             0.9728, 0.9730, 0.9732, 0.9733, 0.9735, 0.9736, 0.9738, 0.9739, 0.9741, 0.9742,
-             0.9744, 0.9745, 0.9746, 0.9748, 0.9749, 0.9750, 0.9752, 0.9753, 0.9754, 0.9756,
-             0.9757, 0.9758, 0.9759, 0.9761, 0.9762, 0.9763, 0.9764, 0.9765, 0.9766, 0.9768,
-             0.9769, 0.9770, 0.9771, 0.9772, 0.9773, 0.9774, 0.9775, 0.9776, 0.9777, 0.9778,
-             0.9779, 0.9780, 0.9781, 0.9782, 0.9783, 0.9784, 0.9785, 0.9786, 0.9787, 0.9788,
-             0.9789, 0.9790, 0.9791, 0.9792, 0.9793, 0.9794, 0.9794, 0.9795, 0.9796, 0.9797,
-             0.9798, 0.9799, 0.9799, 0.9800, 0.9801, 0.9802, 0.9803, 0.9803, 0.9804, 0.9805,
-             0.9806, 0.9807, 0.9807, 0.9808, 0.9809, 0.9810, 0.9810, 0.9811, 0.9812, 0.9812,
-             0.9813, 0.9814, 0.9815, 0.9815, 0.9816, 0.9817, 0.9817, 0.9818, 0.9819, 0.9819,
-             0.9820, 0.9821, 0.9821, 0.9822, 0.9822, 0.9823, 0.9824, 0.9824, 0.9825, 0.9826,
-             0.9826, 0.9827, 0.9827, 0.9828, 0.9828, 0.9829, 0.9830, 0.9830, 0.9831, 0.9831,
-             0.9832, 0.9832, 0.9833, 0.9834, 0.9834, 0.9835, 0.9835, 0.9836, 0.9836, 0.9837,
-             0.9837, 0.9838, 0.9838, 0.9839, 0.9839, 0.9840, 0.9840, 0.9841, 0.9841, 0.9842,
-             0.9842, 0.9843, 0.9843, 0.9844, 0.9844, 0.9845, 0.9845, 0.9846, 0.9846, 0.9846,
-             0.9847, 0.9847, 0.9848, 0.9848, 0.9849, 0.9849, 0.9850, 0.9850, 0.9850, 0.9851,
-             0.9851, 0.9852, 0.9852, 0.9853, 0.9853, 0.9853, 0.9854, 0.9854, 0.9855, 0.9855,
-             0.9855, 0.9856, 0.9856, 0.9857, 0.9857, 0.9857, 0.9858, 0.9858, 0.9859, 0.9859,
-             0.9859, 0.9860, 0.9860, 0.9860, 0.9861, 0.9861, 0.9862, 0.9862, 0.9862, 0.9863,
-             0.9863, 0.9863, 0.9864, 0.9864, 0.9864, 0.9865, 0.9865, 0.9865, 0.9866, 0.9866,
-             0.9866, 0.9867, 0.9867, 0.9867, 0.9868, 0.9868, 0.9868, 0.9869, 0.9869, 0.9869,
-             0.9870, 0.9870, 0.9870, 0.9871, 0.9871, 0.9871, 0.9872, 0.9872, 0.9872, 0.9873,
-             0.9873, 0.9873, 0.9873, 0.9874, 0.9874, 0.9874, 0.9875, 0.9875, 0.9875, 0.9875,
-             0.9876, 0.9876, 0.9876, 0.9877, 0.9877, 0.9877, 0.9877, 0.9878, 0.9878, 0.9878,
-             0.9879, 0.9879, 0.9879, 0.9879, 0.9880, 0.9880, 0.9880, 0.9880, 0.9881, 0.9881,
-             0.9881, 0.9881, 0.9882, 0.9882, 0.9882, 0.9883, 0.9883, 0.9883, 0.9883, 0.9884,
-             0.9884, 0.9884, 0.9884, 0.9884, 0.9885, 0.9885, 0.9885, 0.9885, 0.9886, 0.9886,
-             0.9886, 0.9886, 0.9887, 0.9887, 0.9887, 0.9887, 0.9888, 0.9888, 0.9888, 0.9888,
-             0.9888, 0.9889, 0.9889, 0.9889, 0.9889, 0.9890, 0.9890, 0.9890, 0.9890, 0.9890,
-             0.9891, 0.9891, 0.9891, 0.9891, 0.9892, 0.9892, 0.9892, 0.9892, 0.9892, 0.9893,
-             0.9893, 0.9893, 0.9893, 0.9893, 0.9894, 0.9894, 0.9894, 0.9894, 0.9894, 0.9895,
-             0.9895, 0.9895, 0.9895, 0.9895, 0.9896, 0.9896, 0.9896, 0.9896, 0.9896, 0.9897,
-             0.9897, 0.9897, 0.9897, 0.9897, 0.9898, 0.9898, 0.9898, 0.9898, 0.9898, 0.9899,
-             0.9899, 0.9899, 0.9899, 0.9899, 0.9899, 0.9900, 0.9900, 0.9900, 0.9900, 0.9900,
-             0.9900, 0.9901, 0.9901, 0.9901, 0.9901, 0.9901, 0.9902, 0.9902, 0.9902, 0.9902,
-             0.9902, 0.9902, 0.9903, 0.9903, 0.9903, 0.9903, 0.9903, 0.9903, 0.9904, 0.9904,
-             0.9904, 0.9904, 0.9904, 0.9904, 0.9905, 0.9905, 0.9905, 0.9905, 0.9905, 0.9905,
-             0.9906, 0.9906, 0.9906, 0.9906, 0.9906, 0.9906, 0.9906, 0.9907, 0.9907, 0.9907,
-             0.9907, 0.9907, 0.9907, 0.9908, 0.9908, 0.9908, 0.9908, 0.9908, 0.9908, 0.9908,
-             0.9909, 0.9909, 0.9909, 0.9909, 0.9909, 0.9909, 0.9909, 0.9910, 0.9910, 0.9910,
-             0.9910, 0.9910, 0.9910, 0.9910, 0.9911, 0.9911, 0.9911, 0.9911, 0.9911, 0.9911,
-             0.9911, 0.9912, 0.9912, 0.9912, 0.9912, 0.9912, 0.9912, 0.9912, 0.9912, 0.9913,
-             0.9913, 0.9913, 0.9913, 0.9913, 0.9913, 0.9913, 0.9914, 0.9914, 0.9914, 0.9914,
-             0.9914, 0.9914, 0.9914, 0.9914, 0.9915, 0.9915, 0.9915, 0.9915, 0.9915, 0.9915,
-             0.9915, 0.9915, 0.9916, 0.9916, 0.9916, 0.9916, 0.9916, 0.9916, 0.9916, 0.9916,
-             0.9917, 0.9917, 0.9917, 0.9917, 0.9917, 0.9917, 0.9917, 0.9917, 0.9917, 0.9918,
-             0.9918, 0.9918, 0.9918, 0.9918, 0.9918, 0.9918, 0.9918, 0.9919, 0.9919, 0.9919,
-             0.9919, 0.9919, 0.9919, 0.9919, 0.9919, 0.9919, 0.9920, 0.9920, 0.9920, 0.9920,
-             0.9920, 0.9920, 0.9920, 0.9920, 0.9920, 0.9921, 0.9921, 0.9921, 0.9921, 0.9921,
-             0.9921, 0.9921, 0.9921, 0.9921, 0.9921, 0.9922, 0.9922, 0.9922, 0.9922, 0.9922,
-             0.9922, 0.9922, 0.9922, 0.9922, 0.9923, 0.9923, 0.9923, 0.9923, 0.9923, 0.9923,
-             0.9923, 0.9923, 0.9923, 0.9923, 0.9924, 0.9924, 0.9924, 0.9924, 0.9924, 0.9924,
-             0.9924, 0.9924, 0.9924, 0.9924, 0.9925, 0.9925, 0.9925, 0.9925, 0.9925, 0.9925,
-             0.9925, 0.9925, 0.9925, 0.9925, 0.9925, 0.9926, 0.9926, 0.9926, 0.9926, 0.9926,
-             0.9926, 0.9926, 0.9926, 0.9926, 0.9926, 0.9927, 0.9927, 0.9927, 0.9927, 0.9927,
-             0.9927, 0.9927, 0.9927, 0.9927, 0.9927, 0.9927, 0.9927, 0.9928, 0.9928, 0.9928,
-             0.9928, 0.9928, 0.9928, 0.9928, 0.9928, 0.9928, 0.9928, 0.9928, 0.9929, 0.9929,
-             0.9929, 0.9929, 0.9929, 0.9929, 0.9929, 0.9929, 0.9929, 0.9929, 0.9929, 0.9929,
-             0.9930, 0.9930, 0.9930, 0.9930, 0.9930, 0.9930, 0.9930, 0.9930, 0.9930, 0.9930,
-             0.9930, 0.9930, 0.9931, 0.9931, 0.9931, 0.9931, 0.9931, 0.9931, 0.9931, 0.9931,
-             0.9931, 0.9931, 0.9931, 0.9931, 0.9931, 0.9932, 0.9932, 0.9932, 0.9932, 0.9932,
-             0.9932, 0.9932, 0.9932, 0.9932, 0.9932, 0.9932, 0.9932, 0.9933, 0.9933, 0.9933,
-             0.9933, 0.9933, 0.9933, 0.9933, 0.9933, 0.9933, 0.9933, 0.9933, 0.9933, 0.9933,
-             0.9933, 0.9934, 0.9934, 0.9934, 0.9934, 0.9934, 0.9934, 0.9934, 0.9934, 0.9934,
-             0.9934, 0.9934, 0.9934, 0.9934, 0.9934, 0.9935, 0.9935, 0.9935, 0.9935, 0.9935,
-             0.9935, 0.9935, 0.9935, 0.9935, 0.9935, 0.9935, 0.9935, 0.9935, 0.9935, 0.9936,
-             0.9936, 0.9936, 0.9936, 0.9936, 0.9936, 0.9936, 0.9936, 0.9936, 0.9936, 0.9936,
-             0.9936, 0.9936, 0.9936, 0.9936, 0.9937, 0.9937, 0.9937, 0.9937, 0.9937, 0.9937,
-             0.9937, 0.9937, 0.9937, 0.9937, 0.9937, 0.9937, 0.9937, 0.9937, 0.9937, 0.9938,
-             0.9938, 0.9938, 0.9938, 0.9938, 0.9938, 0.9938, 0.9938, 0.9938, 0.9938, 0.9938,
-             0.9938, 0.9938, 0.9938, 0.9938, 0.9938, 0.9939, 0.9939, 0.9939, 0.9939, 0.9939,
-             0.9939, 0.9939, 0.9939, 0.9939, 0.9939, 0.9939, 0.9939, 0.9939, 0.9939, 0.9939,
-             0.9939, 0.9940, 0.9940, 0.9940, 0.9940, 0.9940, 0.9940, 0.9940, 0.9940, 0.9940,
-             0.9940, 0.9940, 0.9940, 0.9940, 0.9940, 0.9940, 0.9940, 0.9940, 0.9941, 0.9941,
-             0.9941, 0.9941, 0.9941, 0.9941, 0.9941, 0.9941, 0.9941, 0.9941, 0.9941, 0.9941,
-             0.9941, 0.9941, 0.9941, 0.9941, 0.9941, 0.9941, 0.9942, 0.9942, 0.9942, 0.9942,
-             0.9942, 0.9942, 0.9942, 0.9942, 0.9942, 0.9942, 0.9942, 0.9942, 0.9942, 0.9942,
-             0.9942, 0.9942, 0.9942, 0.9942, 0.9943, 0.9943, 0.9943, 0.9943, 0.9943, 0.9943,
-             0.9943, 0.9943, 0.9943, 0.9943, 0.9943, 0.9943, 0.9943, 0.9943, 0.9943, 0.9943,
-             0.9943, 0.9943, 0.9943, 0.9944, 0.9944, 0.9944, 0.9944, 0.9944, 0.9944, 0.9944,
-             0.9944, 0.9944, 0.9944, 0.9944, 0.9944, 0.9944, 0.9944, 0.9944, 0.9944, 0.9944,
-             0.9944, 0.9944, 0.9944, 0.9945, 0.9945, 0.9945, 0.9945, 0.9945, 0.9945, 0.9945,
-             0.9945, 0.9945, 0.9945, 0.9945, 0.9945, 0.9945, 0.9945, 0.9945, 0.9945, 0.9945,
-             0.9945, 0.9945, 0.9945, 0.9946, 0.9946, 0.9946, 0.9946, 0.9946, 0.9946, 0.9946,
-             0.9946, 0.9946, 0.9946, 0.9946, 0.9946, 0.9946, 0.9946, 0.9946, 0.9946, 0.9946,
-             0.9946, 0.9946, 0.9946, 0.9946, 0.9946, 0.9947, 0.9947, 0.9947, 0.9947, 0.9947,
-             0.9947, 0.9947, 0.9947, 0.9947, 0.9947, 0.9947, 0.9947, 0.9947, 0.9947, 0.9947,
-             0.9947, 0.9947, 0.9947, 0.9947, 0.9947, 0.9947, 0.9947, 0.9948, 0.9948, 0.9948
-        ]
-        tau = tau_presolved[n_v-1]
-    elif n_v <= 7000:
-        tau_presolved_from1100_incr100_to7000 = [
-            0.99516, 0.99551, 0.99580, 0.99605, 0.99628, 0.99648, 0.99665, 0.99681, 0.99696, 0.99709,
-            0.99720, 0.99731, 0.99741, 0.99751, 0.99759, 0.99767, 0.99775, 0.99781, 0.99788, 0.99794,
-            0.99800, 0.99805, 0.99810, 0.99815, 0.99820, 0.99824, 0.99828, 0.99832, 0.99836, 0.99839,
-            0.99843, 0.99846, 0.99849, 0.99852, 0.99855, 0.99858, 0.99860, 0.99863, 0.99865, 0.99868,
-            0.99870, 0.99872, 0.99874, 0.99876, 0.99878, 0.99880, 0.99882, 0.99884, 0.99885, 0.99887,
-            0.99889, 0.99890, 0.99892, 0.99893, 0.99895, 0.99896, 0.99897, 0.99899, 0.99900, 0.99901
-        ]
-        idx = (n_v-1000)//100
-        tau = tau_presolved_from1100_incr100_to7000[idx]
-    else: # n_v > 7000
-        tau = 0.999
-    return tau
+    if np.ndim(n_v) > 0:
+        return solve_tau(n_v)
+    return _tau_root(int(n_v))
 
 
 def spherical_kernel(
@@ -1,9 +1,10 @@
 import os
+import sys
 import numpy as np
 import mrcfile as mf
 from pathlib import Path
 
-from occupy_lib import estimate, args, occupy_gui   # for terminal use
+from occupy_lib import estimate, args, batch, occupy_gui   # for terminal use
 from skimage.exposure import match_histograms
 
 from typing import Optional
@@ -16,7 +17,11 @@ if __name__ == '__main__':
 
 
 def app():
-    typer.run(args.parse_and_run)
+    # occupy batch <maps> [options] runs many maps, anything else is a single run
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch.app(sys.argv[2:])
+    else:
+        typer.run(args.parse_and_run)
 
 def app_gui():
     import sys
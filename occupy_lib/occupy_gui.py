@@ -146,16 +146,17 @@ class MplWidget(QtWidgets.QWidget):
     def plot_modification(self):
 
         self.canvas.ax.clear()
-        x = np.linspace(0, 1, 100)
         if self.amplify:
-            self.canvas.ax.plot(x, x ** (1 / self.amplification_power), 'C0')
+            mapping = occupancy.scale_mapping('ampl', self.amplification_power)
+            self.canvas.ax.plot(mapping.x, mapping.y, 'C0')
 
         if self.attenuate:
-            self.canvas.ax.plot(x, x ** (self.attenuation_power), 'C1')
+            mapping = occupancy.scale_mapping('attn', self.attenuation_power)
+            self.canvas.ax.plot(mapping.x, mapping.y, 'C1')
 
         if self.sigmoid:
-            x, y = occupancy.scale_mapping_sigmoid(self.sigmoid_pivot,self.sigmoid_power)
-            self.canvas.ax.plot(x, y, 'C2')
+            mapping = occupancy.scale_mapping('sigm', self.sigmoid_power, pivot=self.sigmoid_pivot)
+            self.canvas.ax.plot(mapping.x, mapping.y, 'C2')
             self.canvas.ax.plot(self.sigmoid_pivot, self.sigmoid_pivot, 'ko')
 
         self.canvas.ax.plot([0, 1], [0, 1], 'k--')
@@ -1313,15 +1314,11 @@ class Ui_MainWindow(object):
             did_something = False
 
             scale_data = mf.mmap(scale_file_name)
-            scale_index = (scale_data.data*(N-1)).astype(np.int16)
 
             if self.groupBox_attenuation.isChecked() and self.MplWidget_viewModification.attenuation_power > 1:
-                x = np.linspace(0, 1, N)
-                s_attn = x ** (self.MplWidget_viewModification.attenuation_power-1)
+                mapping = occupancy.scale_mapping('attn', self.MplWidget_viewModification.attenuation_power, n=N)
 
-                s_attn =np.clip(s_attn,0,1)
-
-                sub_mask_attn = s_attn[scale_index]
+                sub_mask_attn = np.clip(mapping.modification(scale_data.data), 0, 1)
                 sub_mask_attn_name = f'subtraction_mask_attn_' \
                                      f'{self.MplWidget_viewModification.attenuation_power}.' \
                                      f'mrc'
@@ -1333,18 +1330,13 @@ class Ui_MainWindow(object):
 
 
             if self.groupBox_sigmoid.isChecked() and self.MplWidget_viewModification.sigmoid_power > 1:
-                x, s_sigm = occupancy.scale_mapping_sigmoid(self.MplWidget_viewModification.sigmoid_pivot,
-                                                        self.MplWidget_viewModification.sigmoid_power, n=N)
+                mapping = occupancy.scale_mapping('sigm', self.MplWidget_viewModification.sigmoid_power,
+                                                  pivot=self.MplWidget_viewModification.sigmoid_pivot, n=N)
 
                 # No amplification permitted during subtraction, limit sigmoid above pivot
-                n_pivot = int(N * self.MplWidget_viewModification.sigmoid_pivot)
-                s_sigm[n_pivot:] = 1
-                s_sigm[0]=0
-
-                s_sigm[1:n_pivot] = np.divide(s_sigm[1:n_pivot], x[1:n_pivot])
-                s_sigm = np.clip(s_sigm,0,1)
-
-                sub_mask_sigm = s_sigm[scale_index]
+                sub_mask_sigm = mapping.modification(scale_data.data)
+                sub_mask_sigm[scale_data.data >= self.MplWidget_viewModification.sigmoid_pivot] = 1
+                sub_mask_sigm = np.clip(sub_mask_sigm, 0, 1)
                 sub_mask_sigm_name = f'subtraction_mask_sigm_' \
                                      f'{self.MplWidget_viewModification.sigmoid_pivot}.' \
                                      f'{self.MplWidget_viewModification.sigmoid_power}.' \
@@ -2267,17 +2259,17 @@ class Ui_MainWindow(object):
                 #print(input_t.shape, scale_t.shape)
                 if not input_t.shape == scale_t.shape:
                     input_t = ndi.zoom(input_t,float(scale_n)/float(input_n),order=1)
-                N = 100
                 mode = self.do_modify()
 
-                x = np.linspace(0,1,N)
-                s = []
+                # The same scale mappings as used to modify the map
+                mapping = None
                 if mode == 1: #Amplify
-                    s = x ** (1/self.MplWidget_viewModification.amplification_power)
+                    mapping = occupancy.scale_mapping('ampl', self.MplWidget_viewModification.amplification_power)
                 elif mode == 2: #Attenuate
-                    s = x ** (self.MplWidget_viewModification.attenuation_power)
+                    mapping = occupancy.scale_mapping('attn', self.MplWidget_viewModification.attenuation_power)
                 elif mode == 3: #Sigmoid
-                    x,s = occupancy.scale_mapping_sigmoid(self.MplWidget_viewModification.sigmoid_pivot,self.MplWidget_viewModification.sigmoid_power,n=N)
+                    mapping = occupancy.scale_mapping('sigm', self.MplWidget_viewModification.sigmoid_power,
+                                                      pivot=self.MplWidget_viewModification.sigmoid_pivot)
 
                 operations=['amplifying', 'attenuating', 'sigmoiding']
                 self.update_can_modify()
@@ -2285,7 +2277,7 @@ class Ui_MainWindow(object):
 
                     #print(f'{operations[mode-1]}')
                     #s = np.divide(s,x,where=x!=0)
-                    mapped = s[(scale_t*N).astype(int)-1]
+                    mapped = mapping.output_scale(scale_t)
                     mod_slice = np.copy(input_t)
                     d_scale_t = (scale_t<0.01).astype(float)
                     d_scale_t += scale_t
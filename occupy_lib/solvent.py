@@ -2,6 +2,8 @@ import numpy as np
 import pylab as plt
 from scipy.optimize import curve_fit
 
+from occupy_lib import map_tools
+
 def cauchy(
         x: np.ndarray,
         c: float,
@@ -85,10 +87,10 @@ def fit_solvent_to_histogram(
     """
     Fit a single gaussian to the main peak of the array histogram
 
-    :param data:        input data
+    :param data:        input data, or its map_tools.Histogram
     :param verbose:     be verbose
     :param plot:        plot output
-    :param n_lev:       number of bins for histogram
+    :param n_lev:       number of bins for histogram, if not given one
     :return:
     """
 
@@ -97,13 +99,16 @@ def fit_solvent_to_histogram(
     # Set a tolerance for numerical stability
     tol = 0.001 #TODO make input?
 
+    if not isinstance(data, map_tools.Histogram):
+        data = map_tools.Histogram(data, n_lev=n_lev)
+    n_lev = data.n_lev
+
     # Some constants
-    vol = np.size(data)
-    low = np.min(data)
-    high = np.max(data)
+    low = data.low
+    high = data.high
 
     # Estimate solvent distribution initial parameters (to be refined by fitting)
-    a, b = np.histogram(data, bins=n_lev, density=True)
+    a, b = data.density, data.edges
 
     # step
     d_domain = b[1] - b[0]
@@ -227,6 +232,51 @@ def suppress(
 
     return out_data
 
+
+def random_solvent(
+        n: int,
+        solvent_parameters: np.ndarray,
+        dtype: type = None,
+        out: np.ndarray = None,
+        chunk_elements: int = 2 ** 22
+):
+    """
+    Draw fake solvent from the solvent model, as a cubic array
+
+    When writing to out, the array is drawn one slab at a time. Consecutive draws continue the same random stream,
+    so the result is the same as drawing it all at once.
+
+    :param n:                   array size [pix]
+    :param solvent_parameters:  fitted solvent model, the mean and width are used
+    :param dtype:               generate directly in this precision (default: float64)
+    :param out:                 (n, n, n) array of dtype to write to, e.g. memory-mapped (optional)
+    :param chunk_elements:      approximate number of elements to draw at a time, when writing to out
+    :return:                    random array
+    """
+    if out is None:
+        if dtype is None or dtype == np.float64:
+            fake_solvent = np.random.randn(n, n, n)
+        else:
+            fake_solvent = np.random.default_rng().standard_normal((n, n, n), dtype=dtype)
+        fake_solvent *= solvent_parameters[2]
+        fake_solvent += solvent_parameters[1]
+        return fake_solvent
+
+    rng = None
+    if not (dtype is None or dtype == np.float64):
+        rng = np.random.default_rng()
+    slab = max(1, chunk_elements // (n * n))
+    for i in range(0, n, slab):
+        shape = (min(slab, n - i), n, n)
+        if rng is None:
+            out[i:i + slab] = np.random.randn(*shape)
+        else:
+            out[i:i + slab] = rng.standard_normal(shape, dtype=dtype)
+        out[i:i + slab] *= solvent_parameters[2]
+        out[i:i + slab] += solvent_parameters[1]
+    return out
+
+
 def warn_bad(
         lowest_confident_scale,
         file=None,
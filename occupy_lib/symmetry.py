@@ -0,0 +1,251 @@
+import functools
+
+import numpy as np
+
+
+def rotation(
+        axis,
+        angle: float
+):
+    """
+    Rotation matrix about an axis
+
+    :param axis:    rotation axis (x, y, z), need not be normalized
+    :param angle:   rotation angle [rad]
+    :return:        3x3 matrix acting on column vectors (x, y, z)
+    """
+    x, y, z = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+    c, s = np.cos(angle), np.sin(angle)
+    t = 1 - c
+    return np.array([
+        [c + x * x * t, x * y * t - z * s, x * z * t + y * s],
+        [y * x * t + z * s, c + y * y * t, y * z * t - x * s],
+        [z * x * t - y * s, z * y * t + x * s, c + z * z * t]
+    ])
+
+
+def group_closure(generators):
+    """
+    All rotations generated by a set of rotations
+
+    :param generators:  list of 3x3 rotation matrices
+    :return:            (n, 3, 3) array of the group elements, identity first
+    """
+    elements = [np.eye(3)]
+    new = [np.eye(3)]
+    while len(new) > 0:
+        found = []
+        for g in new:
+            for h in generators:
+                m = h @ g
+                if not any(np.allclose(m, e, atol=1e-8) for e in elements):
+                    elements.append(m)
+                    found.append(m)
+        new = found
+    return np.array(elements)
+
+
+@functools.lru_cache(maxsize=None)
+def point_group(sym: str):
+    """
+    The rotations of a point group, in map coordinates (x, y, z)
+
+    C<n> has its n-fold axis along z, and D<n> adds a 2-fold axis along x. T, O and I have 2-fold (T, I) or
+    4-fold (O) axes along x, y and z, and a 3-fold axis along (1, 1, 1). I has a 5-fold axis along (0, 1, φ),
+    so that its 2-fold axes are those of the standard (Crowther 2-2-2) orientation.
+
+    :param sym:     symmetry, e.g. C1, C7, D3, T, O or I
+    :return:        (n, 3, 3) array of rotations, identity first
+    """
+    s = str(sym).strip().upper()
+    if s[:1] in ['C', 'D'] and s[1:].isdigit() and int(s[1:]) > 0:
+        n = int(s[1:])
+        generators = [rotation([0, 0, 1], 2 * np.pi / n)]
+        if s[0] == 'D':
+            generators.append(rotation([1, 0, 0], np.pi))
+    elif s == 'T':
+        generators = [rotation([0, 0, 1], np.pi), rotation([1, 0, 0], np.pi), rotation([1, 1, 1], 2 * np.pi / 3)]
+    elif s == 'O':
+        generators = [rotation([0, 0, 1], np.pi / 2), rotation([1, 1, 1], 2 * np.pi / 3)]
+    elif s == 'I':
+        phi = (1 + np.sqrt(5)) / 2
+        generators = [rotation([0, 0, 1], np.pi), rotation([1, 1, 1], 2 * np.pi / 3), rotation([0, 1, phi], 2 * np.pi / 5)]
+    else:
+        raise ValueError(f'** fail ** Unknown symmetry {sym}, use C<n>, D<n>, T, O or I')
+
+    operators = group_closure(generators)
+    operators.flags.writeable = False
+    return operators
+
+
+def array_operators(
+        operators: np.ndarray,
+        axis_order=None
+):
+    """
+    Rotations in array index coordinates, from rotations in map coordinates (x, y, z)
+
+    :param operators:   (n, 3, 3) rotations in map coordinates
+    :param axis_order:  mapc, mapr, maps of the map (default 1, 2, 3)
+    :return:            (n, 3, 3) rotations acting on array indices
+    """
+    if axis_order is None:
+        axis_order = [1, 2, 3]
+
+    # Array axes are (section, row, column), which hold the map axes maps, mapr and mapc
+    p = np.zeros((3, 3))
+    for axis, map_axis in enumerate(np.flip(np.asarray(axis_order))):
+        p[int(map_axis) - 1, axis] = 1
+    return np.einsum('ji,njk,kl->nil', p, operators, p)
+
+
+def on_grid(
+        operators: np.ndarray,
+        center: np.ndarray
+):
+    """
+    Whether the rotations about the center map the voxel grid onto itself
+
+    Only then are symmetry mates exact voxels. Otherwise (e.g. for 3-, 5- and 6-fold axes), asymmetric_unit rounds
+    them to the nearest voxel.
+
+    :param operators:   (k, 3, 3) rotations in array index coordinates
+    :param center:      symmetry center in array indices
+    :return:            bool
+    """
+    shift = np.asarray(center) - np.einsum('kij,j->ki', operators, center)
+    return bool(np.allclose(operators, np.rint(operators), atol=1e-6) and np.allclose(shift, np.rint(shift), atol=1e-6))
+
+
+def reference(operators: np.ndarray):
+    """
+    The symmetry mates R_k v of the reference point v that defines the asymmetric unit
+
+    :param operators:   (k, 3, 3) rotations
+    :return:            (k, 3) mates
+    """
+    # A reference point off all symmetry axes. Positions closest to it form the asymmetric unit (a Dirichlet
+    # domain), and R_k^T r is in it for the R_k with the largest r . R_k v.
+    v = np.array([0.29, 0.47, 0.83])
+    v /= np.linalg.norm(v)
+    return np.einsum('kij,j->ki', operators, v)
+
+
+def inscribed_radius(
+        n: int,
+        center: np.ndarray
+):
+    """
+    Radius of the largest sphere about the center whose voxels have all their symmetry mates inside the box
+
+    :param n:       edge length of the box
+    :param center:  symmetry center in array indices
+    :return:        radius [pix]
+    """
+    return float(np.min(np.minimum(center, n - 1 - center))) - 0.5
+
+
+def cell_operators(
+        n: int,
+        operators: np.ndarray,
+        center: np.ndarray,
+        cell: int
+):
+    """
+    Which rotation takes each cell of a cubic box into the asymmetric unit, and where it takes the cell center
+
+    Cells are cubes of cell voxels, and the choice is made for the cell center. Cells outside the inscribed sphere
+    are moved radially into it first, far enough for any rotation to keep them inside the box. Rotations that would
+    take any voxel of a cell near the edge of the sphere outside the box are not considered, and a cell that no
+    rotation keeps inside is left where it is.
+
+    :param n:           edge length of the box
+    :param operators:   (k, 3, 3) rotations in array index coordinates
+    :param center:      symmetry center in array indices
+    :param cell:        edge length of the cells
+    :return:            rotation index (m, m, m), and rotated cell center (m, m, m, 3), with m = ceil(n / cell)
+    """
+    m = int(np.ceil(n / cell))
+    g = (np.arange(m) + 0.5) * cell - 0.5
+    cells = np.stack(np.meshgrid(g, g, g, indexing='ij'), axis=-1).reshape(-1, 3)
+    r = cells - center
+    norm = np.linalg.norm(r, axis=1)
+
+    # Any rotation keeps all voxels of cells within the safe radius inside the sphere, and so inside the box
+    radius = inscribed_radius(n, center)
+    safe = radius - (cell - 1) * np.sqrt(3) / 2
+    if safe <= 0:
+        raise ValueError(f'** fail ** The symmetry center {tuple(center)} is too close to the edge of the box')
+    corner = norm > radius
+    edge = np.flatnonzero((norm > safe) & ~corner)
+    r[corner] *= (safe / norm[corner])[:, None]
+
+    score = r @ reference(operators).T
+
+    # The rotated centers of cells near the edge, and the extent of the rotated cells to their outermost voxels
+    k = len(operators)
+    p = (r[edge] @ np.moveaxis(operators, 0, 1).reshape(3, 3 * k)).reshape(-1, k, 3) + center
+    half = (cell - 1) / 2 * np.sum(np.abs(operators), axis=1)
+    outside = np.any((p - half < 0) | (p + half > n - 1), axis=2)
+    score[edge[outside.nonzero()[0]], outside.nonzero()[1]] = -np.inf
+
+    best = np.argmax(score, axis=1)
+    stay = edge[np.all(outside, axis=1)]
+    best[stay] = 0
+    rotated = np.einsum('ci,cij->cj', r, operators[best]) + center
+    rotated[stay] = cells[stay]
+    return best.reshape(m, m, m), rotated.reshape(m, m, m, 3)
+
+
+def asymmetric_unit(
+        n: int,
+        operators: np.ndarray,
+        center=None,
+        cell: int = 4,
+        chunk_elements: int = 2 ** 20,
+        out: np.ndarray = None
+):
+    """
+    For each voxel of a cubic box, a symmetry-equivalent voxel in the asymmetric unit
+
+    The box is divided into cells of cell voxels, and each cell is rotated into the asymmetric unit about its
+    center (see cell_operators), rounding each voxel to the nearest one. Voxels near the edges of the asymmetric
+    unit may thus be placed just outside it. The corners of the box outside the inscribed sphere have no complete
+    set of symmetry mates, so their cells are moved radially into the sphere first, i.e. they take the values near
+    its edge.
+
+    :param n:               edge length of the box
+    :param operators:       (k, 3, 3) rotations in array index coordinates, see array_operators
+    :param center:          symmetry center in array indices (default n/2 along each axis)
+    :param cell:            edge length of the cells that share a rotation
+    :param chunk_elements:  approximate number of voxels to process at a time
+    :param out:             int array of n**3 elements to write to, e.g. memory-mapped (optional)
+    :return:                flat index of the equivalent voxel, for each (flat) voxel
+    """
+    if center is None:
+        center = np.full(3, n / 2)
+    center = np.asarray(center, dtype=np.float64)
+    if out is None:
+        out = np.empty(n ** 3, dtype=np.intp)
+
+    best, rotated = cell_operators(n, operators, center, cell)
+    m = len(best)
+
+    # The rotated voxel offsets from the cell center, for each rotation
+    c = np.arange(cell) - (cell - 1) / 2
+    offsets = np.stack(np.meshgrid(c, c, c, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets = np.matmul(offsets, operators).astype(np.float32)
+    rotated = rotated.astype(np.float32)
+
+    layers = max(1, chunk_elements // (cell * n ** 2))
+    for i in range(0, m, layers):
+        # Voxel positions by cell (layer, row, column, voxel in cell, axis)
+        p = rotated[i:i + layers, :, :, None, :] + offsets[best[i:i + layers]]
+        p = np.rint(p, out=p).astype(np.intp)
+        flat = (p[..., 0] * n + p[..., 1]) * n + p[..., 2]
+
+        # Back to array order, dropping any voxels of partial cells beyond the box
+        flat = flat.reshape(flat.shape[:3] + (cell, cell, cell)).transpose(0, 3, 1, 4, 2, 5)
+        flat = flat.reshape(flat.shape[0] * cell, m * cell, m * cell)[:n - i * cell, :n, :n]
+        out[i * cell * n ** 2:i * cell * n ** 2 + flat.size] = flat.reshape(-1)
+    return out
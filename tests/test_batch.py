@@ -0,0 +1,61 @@
+import csv
+
+from occupy_lib import batch
+from test_estimate import write_test_map
+
+
+def test_batch_writes_per_map_output_and_summary(tmp_path):
+    write_test_map(str(tmp_path / 'a.mrc'))
+    write_test_map(str(tmp_path / 'b.mrc'))
+    (tmp_path / 'maps.txt').write_text('a.mrc\n# skipped\nb.mrc\nmissing.mrc\n')
+    out = tmp_path / 'out'
+
+    rows = batch.run_batch(
+        str(tmp_path / 'maps.txt'),
+        ['--amplify', '2', '--chimerax-silent'],
+        jobs=2,
+        output_dir=str(out),
+        quiet=True
+    )
+
+    assert [r['status'] for r in rows[:2]] == ['ok', 'ok']
+    assert rows[2]['status'].startswith('failed')
+    assert (out / 'a' / 'ampl_2.0_a.mrc').exists()
+    assert (out / 'b' / 'scale_res_b.mrc').exists()
+
+    with open(out / 'occupy_batch_summary.csv') as f:
+        summary = list(csv.DictReader(f))
+    assert len(summary) == 3
+    assert float(summary[0]['max_val']) == rows[0]['max_val']
+
+
+def test_batch_paths_are_relative_to_where_it_runs(tmp_path, monkeypatch):
+    import mrcfile as mf
+    import numpy as np
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'sub').mkdir()
+    write_test_map('a.mrc')
+    write_test_map('sub/a.mrc')
+    solvent_def = np.zeros((48, 48, 48), dtype=np.float32)
+    solvent_def[8:40, 8:40, 8:40] = 1
+    with mf.new('sd.mrc') as f:
+        f.set_data(solvent_def)
+        f.voxel_size = 1.5
+    (tmp_path / 'maps.txt').write_text('a.mrc\nsub/a.mrc\n')
+
+    rows = batch.run_batch(
+        'maps.txt',
+        ['--amplify', '2', '--chimerax-silent', '--solvent-def', 'sd.mrc', '--cache-dir', 'cc'],
+        output_dir='out',
+        quiet=True
+    )
+
+    # Maps of the same name do not share an output directory
+    assert [r['status'] for r in rows] == ['ok', 'ok']
+    assert rows[0]['output_dir'] != rows[1]['output_dir']
+    for r in rows:
+        assert (tmp_path / r['output_dir'] / 'ampl_2.0_a.mrc').exists()
+
+    assert (tmp_path / 'cc').is_dir()
+    assert not any((tmp_path / r['output_dir'] / 'cc').exists() for r in rows)
@@ -0,0 +1,240 @@
+import numpy as np
+import mrcfile as mf
+import pytest
+import typer
+import scipy.ndimage as ndi
+
+from occupy_lib import estimate, args, occupancy
+
+
+def write_test_map(file_name, n=48, voxel_size=1.5):
+    rng = np.random.default_rng(0)
+    data = np.zeros((n, n, n), dtype=np.float32)
+    # Blobs of different occupancy in solvent noise
+    for c, occ in zip([(16, 16, 24), (32, 30, 20), (24, 24, 34)], [1.0, 0.6, 0.3]):
+        data[c] = occ
+    data = ndi.gaussian_filter(data, 3) * 100
+    data += 0.05 * rng.standard_normal((n, n, n))
+    with mf.new(file_name, overwrite=True) as f:
+        f.set_data(data.astype(np.float32))
+        f.voxel_size = voxel_size
+
+
+def read_map(file_name):
+    with mf.open(file_name) as f:
+        return np.copy(f.data)
+
+
+def occ_options(**kwargs):
+    options = args.occupy_options(quiet=True, chimerax=False, **kwargs)
+    options.scale_mode = 'occ'
+    return options
+
+
+@pytest.fixture
+def map_data(tmp_path, monkeypatch):
+    """
+    The test map as map.mrc in an empty working directory, and its data and voxel size
+    """
+    monkeypatch.chdir(tmp_path)
+    write_test_map('map.mrc')
+    with mf.open('map.mrc') as f:
+        return np.copy(f.data), f.voxel_size.x
+
+
+def run_scale(tmp_path, monkeypatch, precision):
+    run_dir = tmp_path / precision
+    run_dir.mkdir()
+    monkeypatch.chdir(run_dir)
+    write_test_map('map.mrc')
+    options = args.occupy_options(input_map='map.mrc', quiet=True, chimerax=False, precision=precision)
+    options.scale_mode = 'occ'
+    options.lp_scale = True
+    estimate.occupy_run(options)
+    with mf.open('scale_occ_map.mrc') as f:
+        return np.copy(f.data)
+
+
+def test_single_precision_scale_agrees_with_double(tmp_path, monkeypatch):
+    single = run_scale(tmp_path, monkeypatch, 'single')
+    double = run_scale(tmp_path, monkeypatch, 'double')
+
+    # The scale is on [0,1], so this is a relative tolerance
+    assert np.max(np.abs(single - double)) < 1e-5
+
+
+def test_estimate_arrays_matches_file_output(tmp_path, map_data):
+    data, voxel_size = map_data
+
+    # The input is used without copying, and must not be modified
+    data.flags.writeable = False
+    np.random.seed(0)
+    result = estimate.estimate_arrays(data, voxel_size, occ_options(amplify=2.0))
+
+    # Nothing is written without a sink
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['map.mrc']
+
+    np.random.seed(0)
+    estimate.occupy_run(occ_options(input_map='map.mrc', amplify=2.0))
+    assert np.array_equal(read_map('scale_occ_map.mrc'), result.scale.astype(np.float32))
+    assert np.array_equal(read_map('ampl_2.0_map.mrc'), result.modified['ampl'].astype(np.float32))
+
+
+def test_options_are_not_changed_by_estimate(map_data):
+    data, voxel_size = map_data
+
+    # The kernel and low-pass are calculated for each map, from its own voxel size
+    options = occ_options(amplify=2.0)
+    first = estimate.estimate_arrays(data, voxel_size, options)
+    assert options.kernel_size is None and options.lowpass_input is None and options.lp_scale is None
+    second = estimate.estimate_arrays(data, 2 * voxel_size, options)
+    assert first.options.kernel_size != second.options.kernel_size
+    assert first.options.lp_scale and first.options is not options
+
+
+def test_cached_estimate_gives_same_modification(tmp_path, map_data):
+    data, voxel_size = map_data
+
+    results = []
+    for cache_dir in [None, 'cache', 'cache']:
+        results.append(estimate.estimate_arrays(data, voxel_size, occ_options(amplify=2.0, cache_dir=cache_dir)))
+    assert len(list((tmp_path / 'cache').iterdir())) == 1
+
+    for result in results[1:]:
+        assert np.array_equal(result.scale, results[0].scale)
+        assert np.array_equal(result.confidence, results[0].confidence)
+        assert result.max_val == results[0].max_val
+        assert np.array_equal(result.modified['ampl'], results[0].modified['ampl'])
+
+    # Modification settings are not part of the key, estimation settings are
+    estimate.estimate_arrays(data, voxel_size, occ_options(attenuate=3.0, cache_dir='cache'))
+    assert len(list((tmp_path / 'cache').iterdir())) == 1
+    estimate.estimate_arrays(data, voxel_size, occ_options(amplify=2.0, tau=0.9, cache_dir='cache'))
+    assert len(list((tmp_path / 'cache').iterdir())) == 2
+
+
+def test_out_of_core_matches_in_core(map_data):
+    data, voxel_size = map_data
+
+    results = []
+    for memory_limit in [None, 1]:
+        np.random.seed(0)
+        results.append(estimate.estimate_arrays(data, voxel_size, occ_options(amplify=2.0, memory_limit=memory_limit)))
+    in_core, out_of_core = results
+
+    # Slabs of the 48-pixel map, memory-mapped to temporary files
+    assert isinstance(out_of_core.scale, np.memmap)
+    assert np.max(np.abs(out_of_core.scale - in_core.scale)) < 1e-5
+    assert np.max(np.abs(out_of_core.confidence - in_core.confidence)) < 1e-3
+    assert np.allclose(out_of_core.modified['ampl'], in_core.modified['ampl'], rtol=0, atol=1e-3)
+
+
+def test_out_of_core_without_full_scale_voxels(map_data, monkeypatch):
+    data, voxel_size = map_data
+
+    # A scale that is nowhere full leaves the variability limit undefined, as in memory
+    get_map_scale = occupancy.get_map_scale
+
+    def partial_scale(*args, **kwargs):
+        scale, *rest = get_map_scale(*args, **kwargs)
+        scale *= 0.5
+        return (scale, *rest)
+
+    monkeypatch.setattr(occupancy, 'get_map_scale', partial_scale)
+    with pytest.warns(RuntimeWarning, match='full scale'):
+        result = estimate.estimate_arrays(data, voxel_size, occ_options(memory_limit=1))
+    assert np.isnan(result.variability_limit)
+
+
+def test_targets_use_the_tiles_of_the_scale_estimate(map_data, monkeypatch):
+    data, voxel_size = map_data
+
+    scans = []
+
+    class RecordedTileScan(occupancy.TileScan):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            scans.append(self)
+
+    monkeypatch.setattr(occupancy, 'TileScan', RecordedTileScan)
+
+    target_mask = np.zeros_like(data)
+    target_mask[28:36, 26:34, 16:24] = 1
+    result = estimate.estimate_arrays(
+        data,
+        voxel_size,
+        occ_options(tile_size=8),
+        target_mask=target_mask,
+        target_labels=target_mask.astype(np.int16)
+    )
+
+    # One scan with the given tile size, so that a mask and the same region as a label agree
+    assert len(scans) == 1 and np.all(scans[0].tile_sz == 8)
+    assert result.label_occupancies['occupancy'][0] == result.target_occupancy
+
+
+def test_roi_is_pasted_into_full_box(map_data):
+    data, voxel_size = map_data
+
+    roi_mask = np.zeros_like(data)
+    roi_mask[14:36, 12:34, 16:38] = 1
+    with mf.new('roi.mrc') as f:
+        f.set_data(roi_mask)
+
+    np.random.seed(0)
+    result = estimate.estimate_arrays(data, voxel_size, occ_options(amplify=2.0, roi_pad=3.0), roi_mask=roi_mask)
+    assert result.roi.size == 32  # The smallest region
+    assert result.scale.shape == result.modified['ampl'].shape == data.shape
+
+    # Nothing is estimated or modified outside the region
+    outside = np.ones(data.shape, dtype=bool)
+    outside[result.roi.slices] = False
+    assert np.all(result.scale[outside] == 0)
+    assert np.array_equal(result.modified['ampl'][outside], data[outside])
+
+    # The written maps are pasted into the full box as well
+    np.random.seed(0)
+    estimate.occupy_run(occ_options(input_map='map.mrc', roi_mask='roi.mrc', amplify=2.0, roi_pad=3.0))
+    assert np.array_equal(read_map('scale_occ_map.mrc'), result.scale.astype(np.float32))
+    assert np.array_equal(read_map('ampl_2.0_map.mrc'), result.modified['ampl'].astype(np.float32))
+
+
+def test_sweep_matches_single_runs(map_data):
+    data, voxel_size = map_data
+
+    np.random.seed(0)
+    sweep = estimate.estimate_arrays(data, voxel_size, occ_options(amplify=[2.0, 4.0], attenuate='2,3')).modified
+    assert sorted(sweep) == ['ampl_2', 'ampl_4', 'attn_2', 'attn_3']
+
+    for amplify, attenuate in [(4.0, 3.0), (2.0, 2.0)]:
+        np.random.seed(0)
+        single = estimate.estimate_arrays(data, voxel_size, occ_options(amplify=amplify, attenuate=attenuate)).modified
+        assert np.array_equal(single['ampl'], sweep[f'ampl_{amplify:g}'])
+        assert np.array_equal(single['attn'], sweep[f'attn_{attenuate:g}'])
+
+
+def test_sigmoid_sweep_syntax():
+    assert args.sigmoid_sweep('3:0.1,4', pivot=0.2) == [(3.0, 0.1), (4.0, 0.2)]
+    assert args.sigmoid_sweep(3.0, pivot=0.2) == [(3.0, 0.2)]
+    assert args.sweep_values('2,4,8') == [2.0, 4.0, 8.0]
+    assert args.sigmoid_sweep([(3.0, 0.1), (4.0, None)], pivot=0.2) == [(3.0, 0.1), (4.0, 0.2)]
+
+    # Through the command line, the sigmoid option is parsed along with --pivot only once
+    for value, expected in [('3,4', [(3.0, 0.2), (4.0, 0.2)]), ('3:0.1,4', [(3.0, 0.1), (4.0, 0.2)]), ('3', [(3.0, 0.2)])]:
+        options = args.options_from_args(['--sigmoid', value, '--pivot', '0.2'])
+        assert args.modification_sweep(options)['sigm'] == expected
+
+
+def test_sweep_labels_are_distinct():
+    # A single value keeps the rounded label, values of a sweep are labelled exactly
+    assert args.modification_label('ampl', 1.75) == 'ampl_1.8'
+    assert [args.modification_label('ampl', v, sweep=True) for v in args.sweep_values('1.75,1.8')] == ['ampl_1.75', 'ampl_1.8']
+    assert args.modification_label('sigm', (3.0, 0.101), sweep=True) != args.modification_label('sigm', (3.0, 0.104), sweep=True)
+
+    for option, value in [('--amplify', '2,2'), ('--attenuate', '2,2.0'), ('--sigmoid', '3:0.1,3:0.10'), ('--sigmoid', '3,3')]:
+        with pytest.raises(typer.BadParameter, match='repeated'):
+            args.options_from_args([option, value])
+
+    # A power without pivot uses --pivot, and may then repeat a power:pivot pair
+    with pytest.raises(ValueError, match='Repeated'):
+        args.modification_sweep(args.options_from_args(['--sigmoid', '3,3:0.2', '--pivot', '0.2']))
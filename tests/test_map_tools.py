@@ -0,0 +1,160 @@
+import numpy as np
+
+from occupy_lib import map_tools
+
+
+def test_spectrum_matches_lowpass():
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((32, 32, 32)).astype(np.float32)
+    spectrum = map_tools.Spectrum(data)
+    for resolution in [4.0, 6.0, 9.0]:
+        ref, ref_vox = map_tools.lowpass(data, resolution, voxel_size=1.5)
+        out, out_vox = spectrum.lowpass(resolution, voxel_size=1.5)
+        assert np.array_equal(out, ref)
+        assert out_vox == ref_vox
+
+
+def test_fused_lowpass_and_resample():
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((32, 32, 32)).astype(np.float32)
+    for output_size in [24, 48]:
+        lp, _ = map_tools.lowpass(data, 6.0, voxel_size=1.5)
+        ref, _ = map_tools.lowpass(lp, output_size=output_size, square=True, resample=True)
+        out, _ = map_tools.lowpass(data, 6.0, voxel_size=1.5, output_size=output_size, square=True)
+        assert np.allclose(out, ref, atol=1e-5 * np.abs(ref).max())
+
+
+def test_radial_window_only_caches_small_windows(monkeypatch):
+    small = map_tools.radial_window(32, 3, radius=10)
+    assert small is map_tools.radial_window(32, 3, radius=10)
+    assert not small.flags.writeable
+
+    monkeypatch.setattr(map_tools, 'radial_window_cache_elements', 1000)
+    large = map_tools.radial_window(32, 3, radius=10)
+    assert large is not map_tools.radial_window(32, 3, radius=10)
+    assert np.array_equal(large, small)
+    assert not large.flags.writeable
+
+
+def test_histogram_matches_numpy():
+    rng = np.random.default_rng(3)
+    data = rng.standard_normal((20, 21, 22)).astype(np.float32)
+    mask = rng.random(data.shape) < 0.3
+    for m in [None, mask]:
+        h = map_tools.Histogram(data, n_lev=100, mask=m, chunk_elements=1000)
+        a, b = np.histogram(data if m is None else data[m], bins=100, density=True)
+        assert np.array_equal(h.density, a)
+        assert np.array_equal(h.edges, b)
+
+
+def test_stacked_spectrum_matches_single():
+    rng = np.random.default_rng(4)
+    data = rng.standard_normal((3, 32, 32, 32)).astype(np.float32)
+    for kw in [dict(resolution=5.0, voxel_size=1.5), dict(output_size=24, resolution=6.0, voxel_size=1.5)]:
+        stacked, _ = map_tools.Spectrum(data, stacked=True).lowpass(**kw)
+        for single_data, out in zip(data, stacked):
+            single, _ = map_tools.Spectrum(single_data).lowpass(**kw)
+            assert np.array_equal(out, single)
+
+
+def test_parent_header_matches_adjust_to_parent(tmp_path):
+    import mrcfile as mf
+
+    parent_name = str(tmp_path / 'parent.mrc')
+    with mf.new(parent_name) as f:
+        f.set_data(np.zeros((40, 40, 40), dtype=np.float32))
+        f.voxel_size = 1.3
+        f.nstart = -20
+
+    data = np.random.default_rng(1).standard_normal((20, 20, 20)).astype(np.float32)
+    ref_name = str(tmp_path / 'ref.mrc')
+    map_tools.new_mrc(data, ref_name, vox_sz=1)
+    map_tools.adjust_to_parent(parent_name, file_name=ref_name)
+
+    out_name = str(tmp_path / 'out.mrc')
+    map_tools.new_mrc(data, out_name, parent=map_tools.ParentHeader(parent_name))
+
+    with mf.open(ref_name) as ref, mf.open(out_name) as out:
+        assert out.voxel_size == ref.voxel_size
+        assert out.voxel_size.x == np.float32(2.6)
+        assert out.nstart == ref.nstart
+        assert np.array_equal(out.data, data)
+
+
+def test_input_map_is_read_only(tmp_path):
+    import mrcfile as mf
+
+    data = np.random.default_rng(2).standard_normal((10, 12, 14)).astype(np.float32)
+    file_name = str(tmp_path / 'in.mrc')
+    with mf.new(file_name) as f:
+        f.set_data(data)
+        f.voxel_size = 1.1
+
+    with map_tools.InputMap(file_name) as in_map:
+        assert np.array_equal(in_map.data, data)
+        assert not in_map.data.flags.writeable
+        assert in_map.voxel_size == np.float32(1.1)
+        assert np.array_equal(map_tools.value_range(in_map.data, chunk_elements=100), [data.min(), data.max()])
+
+
+def test_streamed_mrc_matches_set_data(tmp_path):
+    import mrcfile as mf
+
+    data = (np.random.default_rng(3).standard_normal((12, 10, 8)) + 4).astype(np.float64)
+    out_name = str(tmp_path / 'out.mrc')
+    map_tools.new_mrc(data, out_name, vox_sz=1, chunk_elements=150)
+
+    with mf.new(str(tmp_path / 'ref.mrc')) as ref, mf.open(out_name) as out:
+        ref.set_data(data.astype(np.float32))
+        assert np.array_equal(out.data, ref.data)
+        assert out.header.dmin == ref.header.dmin
+        assert out.header.dmax == ref.header.dmax
+        assert np.isclose(out.header.dmean, ref.header.dmean, rtol=1e-6)
+        assert np.isclose(out.header.rms, ref.header.rms, rtol=1e-6)
+
+
+def test_streamed_mrc_detects_nan_in_any_slab(tmp_path):
+    import mrcfile as mf
+    import pytest
+
+    data = np.random.default_rng(3).standard_normal((12, 10, 8)).astype(np.float32)
+    data[-1, 2, 3] = np.nan
+    assert np.all(np.isnan(map_tools.value_range(data, chunk_elements=150)))
+
+    out_name = str(tmp_path / 'out.mrc')
+    with pytest.warns(RuntimeWarning, match='NaN'):
+        map_tools.new_mrc(data, out_name, vox_sz=1, chunk_elements=150)
+    with mf.open(out_name, permissive=True) as out:
+        assert np.isnan(out.header.dmin) and np.isnan(out.header.dmax) and np.isnan(out.header.dmean)
+
+
+def test_roi_from_mask_crop_and_paste(tmp_path):
+    import mrcfile as mf
+
+    mask = np.zeros((40, 40, 40), dtype=np.float32)
+    mask[30:37, 4:9, 10:21] = 1
+    roi = map_tools.roi_from_mask(mask, pad=2, chunk_elements=1000)
+
+    # Cubic, even and padded around the longest extent, shifted to stay inside the box
+    assert roi.size == 16
+    assert np.array_equal(roi.start, [24, 0, 7])
+    assert np.array_equal(roi.crop(mask)[6:13, 4:9, 3:14], np.ones((7, 5, 11)))
+
+    data = np.random.default_rng(2).standard_normal((40, 40, 40)).astype(np.float32)
+    pasted = roi.paste(roi.crop(data) * 2, fill=data, chunk_elements=1000)
+    outside = np.ones(data.shape, dtype=bool)
+    outside[roi.slices] = False
+    assert np.array_equal(pasted[outside], data[outside])
+    assert np.array_equal(pasted[roi.slices], 2 * data[roi.slices])
+
+    # A cropped header places a region at its start in the parent box
+    parent_name = str(tmp_path / 'parent.mrc')
+    with mf.new(parent_name) as f:
+        f.set_data(data)
+        f.voxel_size = 1.3
+        f.nstart = -20
+    out_name = str(tmp_path / 'out.mrc')
+    map_tools.new_mrc(roi.crop(data), out_name, parent=map_tools.ParentHeader(parent_name).crop(roi.start, roi.size))
+    with mf.open(out_name) as out:
+        assert out.voxel_size.x == np.float32(1.3)
+        assert (out.header.nxstart, out.header.nystart, out.header.nzstart) == (-13, -20, 4)
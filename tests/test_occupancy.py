@@ -0,0 +1,287 @@
+import numpy as np
+import scipy.ndimage as ndi
+
+from occupy_lib import occupancy, map_tools, solvent, symmetry
+
+
+def test_tile_percentiles_matches_sorted_tiles():
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((40, 40, 40)).astype(np.float32)
+    tile_sz = np.array([6, 6, 6])
+    origins = np.array([[0, 0, 0], [3, 7, 11], [34, 34, 34], [10, 0, 20]])
+    n_tau = 190
+
+    v = occupancy.tile_percentiles(data, origins, tile_sz, n_tau, chunk_elements=500)
+
+    for o, v_i in zip(origins, v):
+        tile = data[o[0]:o[0] + 6, o[1]:o[1] + 6, o[2]:o[2] + 6]
+        assert v_i == np.sort(tile.flatten())[n_tau]
+
+
+def test_tile_scan_several_tau():
+    rng = np.random.default_rng(5)
+    data = rng.standard_normal((40, 40, 40)).astype(np.float32)
+    taus = np.array([0.5, 0.9, 0.99])
+
+    tiles = occupancy.TileScan(data, 10, tile_sz=6)
+    s_max, centers = tiles.s_max(taus)
+    for tau, s, c in zip(taus, s_max, centers):
+        s_single, c_single, *_ = occupancy.tile_scan(data, 10, tile_sz=6, tau=tau)
+        assert s == s_single
+        assert np.array_equal(c, c_single[:2])
+
+    # More tiles than fit in the box are reduced
+    s, c, *_ = occupancy.tile_scan(data[:24, :24, :24], 20, tile_sz=12, tau=0.9)
+    assert np.shape(c) == (3, 3)
+
+
+def test_tile_index():
+    rng = np.random.default_rng(7)
+    data = rng.standard_normal((40, 40, 40)).astype(np.float32)
+    taus = np.array([0.5, 0.9, 0.99])
+    tiles = occupancy.TileScan(data, 10, tile_sz=6)
+
+    index = tiles.index(taus)
+    assert len(index) == 10 ** 3
+    assert np.array_equal(index['ijk'][index['in_sphere']], tiles.ijk)
+    assert np.all(np.isnan(index['value'][~index['in_sphere']]))
+    assert np.array_equal(index['value'][index['in_sphere']], tiles.percentiles(taus))
+
+    # s_max from the index is that of a new scan, for each tau and for one of them
+    s_max, centers = tiles.s_max(taus)
+    s_max_index, centers_index = tiles.s_max(taus, index=index)
+    assert np.array_equal(s_max, s_max_index)
+    assert np.array_equal(centers, centers_index)
+    assert tiles.s_max(0.9, index=tiles.index(0.9))[0] == s_max[1]
+    i_max = np.nanargmax(index['value'][:, 1])
+    assert np.array_equal(index['center'][i_max], centers[1, 0])
+
+
+def test_label_occupancies_matches_single_targets():
+    rng = np.random.default_rng(6)
+    data = rng.standard_normal((40, 40, 40)).astype(np.float32)
+    labels = np.zeros((40, 40, 40), dtype=np.int16)
+    labels[5:10, 5:10, 5:10] = 1
+    labels[20:30, 10:20, 10:15] = 4
+    labels[30:32, 30:40, 30:40] = 7
+    labels[0, 0, :4] = 9
+
+    tiles = occupancy.TileScan(data, 10, tile_sz=6)
+    occ = occupancy.label_occupancies(data, labels, tiles)
+    assert np.array_equal(occ['label'], [1, 4, 7, 9])
+    for i, label in enumerate(occ['label']):
+        sel = data[labels == label]
+        tau = occupancy.set_tau(n_v=len(sel))
+        s_max, *_ = occupancy.tile_scan(data, 10, tile_sz=6, tau=tau)
+        assert occ['n_voxels'][i] == len(sel)
+        assert occ['occupancy'][i] == np.max(sel) / s_max
+
+
+def test_max_filter_matches_footprint_filter():
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((21, 18, 25)).astype(np.float32)
+    for size, radius in [(3, None), (5, 2.67), (9, 4.5)]:
+        kernel, _ = occupancy.spherical_kernel(size, radius=radius)
+        ref = ndi.maximum_filter(data, footprint=kernel)
+        assert np.array_equal(occupancy.max_filter(data, kernel, block=7), ref)
+
+    # Arbitrary footprints, including even sizes
+    for _ in range(10):
+        kernel = rng.random(tuple(rng.integers(1, 6, 3))) < 0.5
+        if kernel.any():
+            ref = ndi.maximum_filter(data, footprint=kernel)
+            assert np.array_equal(occupancy.max_filter(data, kernel), ref)
+
+
+def test_set_tau_solves_root():
+    n_v = np.array([1, 2, 3, 257, 1000, 7000, 10 ** 6])
+    tau = occupancy.set_tau(n_v=n_v)
+    assert np.allclose(tau ** n_v + tau - 1, 0, atol=1e-12)
+    assert np.allclose(tau[:2], [0.5, (np.sqrt(5) - 1) / 2])
+
+    # Previously tabulated to 4 decimals
+    assert np.array_equal(np.round(tau[2:5], 4), [0.6823, 0.9840, 0.9948])
+
+    # The exact root moves some tile percentiles by one order statistic from the rounded table, e.g. for a
+    # --target-mask of 1000 voxels in 12-voxel tiles (table 0.9948, 1719)
+    assert np.isclose(tau[4], 0.99476196, rtol=0, atol=1e-8)
+    assert int(np.floor(tau[4] * 12 ** 3)) == 1718
+    assert occupancy.set_tau(n_v=257) == tau[3]
+    assert occupancy.set_tau(kernel=np.ones((3, 3, 3), dtype=bool)) == occupancy.set_tau(n_v=27)
+
+
+def test_point_groups():
+    for sym, n in [('C1', 1), ('C7', 7), ('D3', 6), ('T', 12), ('O', 24), ('I', 60)]:
+        operators = symmetry.point_group(sym)
+        assert len(operators) == n
+        assert np.allclose(np.matmul(operators, np.transpose(operators, (0, 2, 1))), np.eye(3))
+
+    # Only some groups map the voxel grid onto itself, and only about a voxel
+    center = np.full(3, 20.0)
+    for sym, exact in [('C2', True), ('C4', True), ('D4', True), ('T', True), ('O', True), ('C3', False),
+                       ('C6', False), ('D3', False), ('I', False)]:
+        assert symmetry.on_grid(symmetry.array_operators(symmetry.point_group(sym)), center) == exact
+    assert not symmetry.on_grid(symmetry.array_operators(symmetry.point_group('O')), center + [0.5, 0, 0])
+
+
+def test_max_filter_symmetric_matches_max_filter():
+    rng = np.random.default_rng(4)
+    n = 40
+    kernel, _ = occupancy.spherical_kernel(5)
+    r = np.indices((n, n, n)).reshape(3, -1).T - n / 2
+    inside = np.linalg.norm(r, axis=1) < n / 2 - 4
+
+    # Point groups whose operators map the sampling grid onto itself give the same filtered values (up to rounding)
+    for sym in ['C4', 'O']:
+        operators = symmetry.array_operators(symmetry.point_group(sym))
+        points = np.concatenate(rng.uniform(-n / 4, n / 4, (4, 3)) @ operators)
+        data = np.zeros(n ** 3)
+        for p in points:
+            data += np.exp(-np.sum((r - p) ** 2, axis=1) / 8)
+        data = data.reshape(n, n, n).astype(np.float32)
+
+        source = symmetry.asymmetric_unit(n, operators)
+        assert len(np.unique(source)) < n ** 3 / 2
+        ref = occupancy.max_filter(data, kernel)
+        out = occupancy.max_filter_symmetric(data, kernel, source, block=8)
+        assert np.allclose(out.reshape(-1)[inside], ref.reshape(-1)[inside], rtol=1e-6, atol=1e-6)
+
+
+def test_threaded_scale_matches_serial():
+    rng = np.random.default_rng(2)
+    data = ndi.gaussian_filter(rng.standard_normal((40, 40, 40)), 1.5).astype(np.float32)
+    kernel, _ = occupancy.spherical_kernel(5)
+    serial, s_max, tiles, index, _ = occupancy.percentile_filter_tiled(data, kernel, n_tiles=10, tile_sz=6)
+    threaded, s_max_t, tiles_t, index_t, _ = occupancy.percentile_filter_tiled(data, kernel, n_tiles=10, tile_sz=6, threads=4)
+    assert np.array_equal(serial, threaded)
+    assert s_max == s_max_t
+    assert np.array_equal(tiles, tiles_t)
+    assert np.array_equal(index['value'], index_t['value'], equal_nan=True)
+
+
+def test_confidence_envelope_matches_bin_loop():
+    rng = np.random.default_rng(4)
+    x = np.linspace(-3, 3, 1000)
+    for _ in range(20):
+        content_fraction = 1 / (1 + np.exp(-rng.uniform(0.5, 3) * x)) - rng.uniform(0, 0.3)
+        content_fraction += rng.normal(0, 0.02, x.size)
+
+        # Reference: the bin-by-bin envelope
+        ref = np.copy(content_fraction)
+        dt = 0
+        for i in np.flip(np.arange(np.size(ref) - 1)):
+            ref[i] = np.min([ref[i], ref[i + 1], ref[i + 1] - dt])
+            dt = ref[i + 1] - ref[i]
+            if ref[i - 1] <= 0:
+                ref[:i - 1] = 0
+                break
+
+        assert np.allclose(occupancy.confidence_envelope(content_fraction), ref, rtol=0, atol=1e-10)
+
+
+def test_chunked_confidence_mapping():
+    rng = np.random.default_rng(5)
+    data = rng.standard_normal((20, 20, 20)).astype(np.float32) + 0.5 * (rng.random((20, 20, 20)) < 0.2)
+    params = [0.4, 0.0, 1.0]
+    confidence, mapping = occupancy.estimate_confidence(data, params, chunk_elements=1000)
+
+    indx = (map_tools.uniscale_map(np.copy(data), move=True) * 1000 - 1).astype(int)
+    assert confidence.dtype == np.float32
+    assert np.array_equal(confidence, np.clip(mapping[indx].astype(np.float32), 0.0, 1.0))
+
+
+def test_chunked_modify_matches_full_chain():
+    rng = np.random.default_rng(6)
+    data = rng.standard_normal((16, 16, 16)).astype(np.float32)
+    scale = np.clip(rng.random((16, 16, 16)), 0.01, 1).astype(np.float32)
+    confidence = rng.random((16, 16, 16)).astype(np.float32)
+    fake_solvent = rng.standard_normal((16, 16, 16)).astype(np.float32)
+
+    for kw in [dict(amplify_gamma=2.0), dict(attenuate_gamma=3.0), dict(sigmoid_gamma=2.0, sigmoid_pivot=0.3)]:
+        thresholded = occupancy.threshold_scale_map(scale, 0.05)
+        if 'amplify_gamma' in kw:
+            modification = occupancy.modify_scale_gamma(thresholded, 2.0, attenuate_gamma=False)
+        elif 'attenuate_gamma' in kw:
+            modification = occupancy.modify_scale_gamma(thresholded, 3.0, attenuate_gamma=True)
+        else:
+            modification = occupancy.modify_scale_sigmoid(scale, 2.0, 0.3)
+        ref = data * modification + fake_solvent * np.clip(1 - modification, 0, 1)
+        ref = solvent.suppress(ref, data, confidence)
+
+        out = occupancy.modify(data, scale, fake_solvent=fake_solvent, scale_threshold=0.05, confidence=confidence,
+                               unmodified=data, chunk_elements=300, verbose=False, **kw)
+        assert np.array_equal(out, ref)
+
+
+def test_modify_many_matches_modify():
+    rng = np.random.default_rng(7)
+    data = rng.standard_normal((16, 16, 16)).astype(np.float32)
+    scale = np.clip(rng.random((16, 16, 16)), 0.01, 1).astype(np.float32)
+    confidence = rng.random((16, 16, 16)).astype(np.float32)
+    fake_solvent = rng.standard_normal((16, 16, 16)).astype(np.float32)
+
+    modifications = {
+        'ampl_2': dict(amplify_gamma=2.0),
+        'ampl_4': dict(amplify_gamma=4.0),
+        'attn_3': dict(attenuate_gamma=3.0, fake_solvent=fake_solvent),
+        'sigm_2': dict(sigmoid_gamma=2.0, sigmoid_pivot=0.3, fake_solvent=fake_solvent)
+    }
+    out = occupancy.modify_many(data, scale, modifications, scale_threshold=0.05, confidence=confidence,
+                                unmodified=data, chunk_elements=300, verbose=False)
+    for name, kw in modifications.items():
+        ref = occupancy.modify(data, scale, scale_threshold=0.05, confidence=confidence, unmodified=data,
+                               verbose=False, **kw)
+        assert np.array_equal(out[name], ref)
+
+
+def test_scale_mapping():
+    scale = np.linspace(0, 1, 37).astype(np.float32)
+
+    # Power curves are exact
+    ampl = occupancy.scale_mapping('ampl', 2.0)
+    assert np.array_equal(ampl.modification(scale[1:]), scale[1:] ** (1 / 2.0 - 1))
+
+    # Where the scale is 0, so is the modification, without a divide-by-zero warning under -W error
+    for kind in ['ampl', 'attn']:
+        modification = occupancy.scale_mapping(kind, 2.0).modification(scale)
+        assert modification[0] == 0 and modification.dtype == scale.dtype
+
+    # The sigmoid table interpolates, so a finer table changes little
+    coarse = occupancy.ScaleMapping('sigm', 3.0, pivot=0.3, n=1000).output_scale(scale)
+    fine = occupancy.ScaleMapping('sigm', 3.0, pivot=0.3, n=100000).output_scale(scale)
+    assert np.max(np.abs(coarse - fine)) < 1e-3
+    assert occupancy.scale_mapping('sigm', 3.0, pivot=0.3) is occupancy.scale_mapping('sigm', 3.0, pivot=0.3)
+
+    modification = occupancy.modify_scale_sigmoid(scale, 3.0, 0.3)
+    assert modification[0] == 0
+    assert np.allclose(modification[1:] * scale[1:], coarse[1:])
+
+
+def test_sigmoid_scale_matches_loop():
+    x = np.linspace(0, 1, 500).astype(np.float32)
+    for pivot, order in [(0.05, 1.0), (0.3, 3.0), (0.5, 1.5), (0.95, 30.0)]:
+        mu = occupancy.sigmoid_effective_mu(pivot, order=order)
+
+        # Reference: the element-wise loops
+        ref = np.divide(mu * (1 - x), x * (1 - mu), out=np.zeros_like(x), where=x != 0)
+        if order != 1:
+            with np.errstate(over='ignore'):
+                ref = np.power(ref, order)
+        ref = ref + 1
+        ref = np.divide(1, ref, where=ref != 0)
+        ref = np.clip(ref, 0, 1)
+        for i in np.arange(len(x)):
+            if x[i] == 0:
+                ref[i] = 0
+        for i in np.arange(len(x) - 1):
+            if ref[i + 1] < ref[i]:
+                ref[i + 1] = ref[i]
+
+        assert np.array_equal(occupancy.sigmoid_scale(x, mu, order), ref)
+
+    # Many curves at once
+    pivots, orders = [0.05, 0.3, 0.3, 0.95], [1.0, 3.0, 5.0, 30.0]
+    x, curves = occupancy.scale_mapping_sigmoids(pivots, orders, n=500)
+    assert curves.shape == (4, 500)
+    for pivot, order, curve in zip(pivots, orders, curves):
+        assert np.allclose(curve, occupancy.scale_mapping_sigmoid(pivot, order, n=500)[1], rtol=0, atol=1e-4)